@@ -3,9 +3,10 @@
 基于原 agent.py (v2.8) 改造，移除全局配置依赖，改为 __init__ 传参。
 """
 
+import asyncio
 import re
 import time
-from typing import List, Dict, Any, Tuple, NamedTuple, Set
+from typing import List, Dict, Any, Tuple, NamedTuple, Set, Optional, AsyncIterator
 from dataclasses import dataclass, field, asdict
 
 from langchain_core.documents import Document
@@ -13,6 +14,8 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.language_models import BaseLanguageModel
 
+from src.core.llm_cache import CachedChain, LLMCache
+
 
 # === Data Structures ===
 
@@ -40,6 +43,15 @@ class AgentResult:
     history_cleaned: bool = True
 
 
+@dataclass
+class AgentEvent:
+    # step: 新的思维链步骤; token: 最终回答的增量文本; result: 完整结果 (最后一个事件)
+    kind: str
+    step: Optional[AgentStep] = None
+    token: str = ""
+    result: Optional[AgentResult] = None
+
+
 # === Prompts (Kept same as updated logic) ===
 # 为了节省空间，此处简略引用，实际代码中包含完整的 prompt 内容
 
@@ -100,7 +112,24 @@ class EvaluateDecision(NamedTuple):
     next_query: str
 
 
+_CJK = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+
 class AgentHelpers:
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """粗略估计 token 数: 中日韩字符各算一个，其余约 4 个字符一个"""
+        cjk = len(_CJK.findall(text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+    @staticmethod
+    def truncate_to_tokens(text: str, budget: int) -> str:
+        """按估计的 token 数截断，保留开头"""
+        tokens = AgentHelpers.estimate_tokens(text)
+        if tokens <= budget:
+            return text
+        return text[:max(0, len(text) * budget // tokens)] + "..."
+
     @staticmethod
     def format_docs_for_prompt(docs: List[Document]) -> Tuple[str, Dict[int, str]]:
         if not docs:
@@ -169,24 +198,96 @@ class AgentHelpers:
         return match.group(1).strip() if match else text.strip()
 
 
+class TokenStream:
+    """
+    在后台任务中消费 chain.astream，已收到的片段缓存下来。
+    投机启动的最终回答可以先生成，确认采用后再从头回放并继续接收后续片段。
+    """
+
+    def __init__(self, chunks: AsyncIterator[str]):
+        self.chunks: List[str] = []
+        self._updated = asyncio.Event()
+        self._task = asyncio.create_task(self._pump(chunks))
+
+    async def _pump(self, chunks: AsyncIterator[str]):
+        try:
+            async for chunk in chunks:
+                self.chunks.append(chunk)
+                self._updated.set()
+        finally:
+            self._updated.set()
+
+    def cancel(self):
+        self._task.cancel()
+
+    def done(self) -> bool:
+        return self._task.done()
+
+    async def __aiter__(self):
+        i = 0
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self._task.done():
+                # 传播生成过程中的异常
+                self._task.result()
+                return
+            self._updated.clear()
+            await self._updated.wait()
+
+    async def text(self) -> str:
+        async for _ in self:
+            pass
+        return "".join(self.chunks)
+
+
 class DndAgentExecutor:
-    def __init__(self, llm: BaseLanguageModel, retriever, settings: Dict[str, Any] = None):
+    def __init__(self, llm: BaseLanguageModel, retriever, settings: Dict[str, Any] = None,
+                 cache: Optional[LLMCache] = None):
         self.llm = llm
         self.retriever = retriever
         # 配置参数注入
         self.settings = settings or {}
         self.doc_pool_limit = 8
         self.max_loops = 2
+        # 拼入 query / final 提示词的对话历史的 token 上限，从最近一轮往前取
+        self.history_token_budget = self.settings.get("history_token_budget", 1500)
 
         # Memory
         self.chat_history: List[Tuple[str, str]] = []
         self.doc_pool: List[Document] = []
 
-        # Chains
-        self.chain_query = PROMPT_QUERY | self.llm | StrOutputParser()
-        self.chain_blacklist = PROMPT_BLACKLIST | self.llm | StrOutputParser()
-        self.chain_evaluate = PROMPT_EVALUATE | self.llm | StrOutputParser()
-        self.chain_final = PROMPT_COT3 | self.llm | StrOutputParser()
+        # Chains: 传入 cache 时相同输入直接复用上次的回复
+        self.cache = cache
+        self.chain_query = self._make_chain("query", PROMPT_QUERY)
+        self.chain_blacklist = self._make_chain("blacklist", PROMPT_BLACKLIST)
+        self.chain_evaluate = self._make_chain("evaluate", PROMPT_EVALUATE)
+        self.chain_final = self._make_chain("final", PROMPT_COT3)
+
+    def _make_chain(self, name: str, prompt: ChatPromptTemplate):
+        if self.cache is not None:
+            return CachedChain(name, prompt, self.llm, self.cache)
+        return prompt | self.llm | StrOutputParser()
+
+    def load_history(self, turns: List[Tuple[str, str]]):
+        """用已保存的 (用户问题, 回答) 恢复对话历史 (如从会话记录中)"""
+        self.chat_history = list(turns)
+        self._trim_history()
+
+    def _trim_history(self):
+        """只保留能放进 token 预算的最近几轮；最近一轮单独超出预算时截断其回答"""
+        kept, used = [], 0
+        for h, a in reversed(self.chat_history):
+            cost = AgentHelpers.estimate_tokens(h) + AgentHelpers.estimate_tokens(a)
+            if used + cost > self.history_token_budget:
+                if not kept:
+                    budget = max(0, self.history_token_budget - AgentHelpers.estimate_tokens(h))
+                    kept.append((h, AgentHelpers.truncate_to_tokens(a, budget)))
+                break
+            kept.append((h, a))
+            used += cost
+        self.chat_history = kept[::-1]
 
     def load_history_str(self) -> str:
         if not self.chat_history:
@@ -197,6 +298,64 @@ class DndAgentExecutor:
             lines.append(f"AI: {a}")
         return "\n".join(lines)
 
+    def _initial_query_skipped(self, user_input: str, trace: List[AgentStep]) -> bool:
+        # 简单判断，如果太短可能就是关键词
+        if len(user_input) > 30:
+            return False
+        trace.append(AgentStep("Think", "Initial Query", "输入简短，直接作为查询词"))
+        return True
+
+    def _set_initial_query(self, raw_q: str, trace: List[AgentStep]) -> str:
+        next_query = AgentHelpers.parse_query(raw_q)
+        trace.append(AgentStep("Think", "Initial Query", f"提炼关键词: {next_query}"))
+        return next_query
+
+    def _search(self, query: str, blacklist_paths: List[str]) -> List[Document]:
+        top_k = self.settings.get("top_k", 10)
+        return self.retriever.search(query=query, blacklist_paths=blacklist_paths, top_k=top_k)
+
+    def _update_pool(self, new_docs: List[Document], trace: List[AgentStep]):
+        prev_len = len(self.doc_pool)
+        self.doc_pool = AgentHelpers.update_doc_pool(self.doc_pool, new_docs, limit=self.doc_pool_limit)
+        trace.append(AgentStep("System", "Pool Update", f"Docs: {prev_len} -> {len(self.doc_pool)}"))
+
+    def _apply_blacklist(self, bl_raw: str, id_map: Dict[int, str], blacklist_session: Set[str],
+                         trace: List[AgentStep]) -> bool:
+        """按审核结果拉黑文档，返回文档池是否有变化"""
+        bad_ids = AgentHelpers.parse_blacklist(bl_raw)
+        removed_paths = []
+        for bid in bad_ids:
+            if bid in id_map:
+                path = id_map[bid]
+                if path not in blacklist_session:
+                    blacklist_session.add(path)
+                    removed_paths.append(path)
+
+        if removed_paths:
+            self.doc_pool = [d for d in self.doc_pool if
+                             d.metadata.get('full_path') not in blacklist_session]
+            trace.append(AgentStep("Action", "Blacklist", f"拉黑 {len(removed_paths)} 个文档"))
+        return bool(removed_paths)
+
+    def _final_inputs(self, history_str: str, user_input: str) -> Dict[str, str]:
+        final_ctx, _ = AgentHelpers.format_docs_for_prompt(self.doc_pool)
+        return {"history": history_str, "input": user_input, "context": final_ctx}
+
+    def _finish(self, user_input: str, cot3_raw: str, trace: List[AgentStep]) -> AgentResult:
+        final_answer = AgentHelpers.parse_final_answer(cot3_raw)
+
+        # Save history
+        self.chat_history.append((user_input, final_answer))
+        self._trim_history()
+
+        final_snapshots = [
+            DocSnapshot(id=i, path=d.metadata.get('full_path', ''), snippet=d.page_content[:100],
+                        source=d.metadata.get('source_title', ''))
+            for i, d in enumerate(self.doc_pool)
+        ]
+
+        return AgentResult(answer=final_answer, final_pool=final_snapshots, trace_log=trace)
+
     def invoke(self, user_input: str) -> AgentResult:
         trace = []
         history_str = self.load_history_str()
@@ -204,13 +363,9 @@ class DndAgentExecutor:
 
         # 1. Initial Query
         next_query = user_input
-        # 简单判断，如果太短可能就是关键词
-        if len(user_input) > 30:
+        if not self._initial_query_skipped(user_input, trace):
             raw_q = self.chain_query.invoke({"history": history_str, "input": user_input})
-            next_query = AgentHelpers.parse_query(raw_q)
-            trace.append(AgentStep("Think", "Initial Query", f"提炼关键词: {next_query}"))
-        else:
-            trace.append(AgentStep("Think", "Initial Query", "输入简短，直接作为查询词"))
+            next_query = self._set_initial_query(raw_q, trace)
 
         # 2. Loop
         loop_count = 0
@@ -218,37 +373,15 @@ class DndAgentExecutor:
             loop_count += 1
             trace.append(AgentStep("Loop", f"Round {loop_count}", f"开始检索: {next_query}"))
 
-            # Search
-            top_k = self.settings.get("top_k", 10)
-            new_docs = self.retriever.search(
-                query=next_query,
-                blacklist_paths=list(blacklist_session),
-                top_k=top_k
-            )
-
-            # Update Pool
-            prev_len = len(self.doc_pool)
-            self.doc_pool = AgentHelpers.update_doc_pool(self.doc_pool, new_docs, limit=self.doc_pool_limit)
-            trace.append(AgentStep("System", "Pool Update", f"Docs: {prev_len} -> {len(self.doc_pool)}"))
+            # Search & Update Pool
+            new_docs = self._search(next_query, list(blacklist_session))
+            self._update_pool(new_docs, trace)
 
             # Blacklist Check
             ctx_str, id_map = AgentHelpers.format_docs_for_prompt(self.doc_pool)
             if self.doc_pool:
                 bl_raw = self.chain_blacklist.invoke({"input": user_input, "context": ctx_str})
-                bad_ids = AgentHelpers.parse_blacklist(bl_raw)
-                if bad_ids:
-                    removed_paths = []
-                    for bid in bad_ids:
-                        if bid in id_map:
-                            path = id_map[bid]
-                            if path not in blacklist_session:
-                                blacklist_session.add(path)
-                                removed_paths.append(path)
-
-                    if removed_paths:
-                        self.doc_pool = [d for d in self.doc_pool if
-                                         d.metadata.get('full_path') not in blacklist_session]
-                        trace.append(AgentStep("Action", "Blacklist", f"拉黑 {len(removed_paths)} 个文档"))
+                self._apply_blacklist(bl_raw, id_map, blacklist_session, trace)
 
             # Evaluate
             clean_ctx_str, _ = AgentHelpers.format_docs_for_prompt(self.doc_pool)
@@ -265,24 +398,149 @@ class DndAgentExecutor:
 
         # 3. Final
         trace.append(AgentStep("Think", "Final Generate", "生成最终回答"))
-        final_ctx, _ = AgentHelpers.format_docs_for_prompt(self.doc_pool)
-
-        cot3_raw = self.chain_final.invoke({
-            "history": history_str,
-            "input": user_input,
-            "context": final_ctx
-        })
-        final_answer = AgentHelpers.parse_final_answer(cot3_raw)
+        cot3_raw = self.chain_final.invoke(self._final_inputs(history_str, user_input))
+        return self._finish(user_input, cot3_raw, trace)
+
+    async def ainvoke(self, user_input: str) -> AgentResult:
+        """invoke 的异步版本，结果与 invoke 一致 (见 astream_events)"""
+        async for event in self.astream_events(user_input):
+            if event.kind == "result":
+                return event.result
+
+    async def astream_events(self, user_input: str) -> AsyncIterator[AgentEvent]:
+        """
+        以事件流的形式执行一次问答: 思维链步骤产生即发出，最终回答按 chain_final.astream 的片段逐段发出，
+        最后发出完整的 AgentResult。各 LLM 阶段投机并发 (settings["speculative"] 为 False 时关闭):
+        - 审核与评估同时发出，评估先基于审核前的文档池；审核没有拉黑文档时直接采用，否则按清洗后的文档池重新评估
+        - 评估给出 NEXT 后立即在后台预取下一轮检索；黑名单随后有变化则丢弃预取结果重新检索
+        - 最后一轮的最终回答与审核、评估同时生成，审核拉黑了文档时按清洗后的文档池重新生成
+        """
+        trace = []
+        emitted = 0
+        history_str = self.load_history_str()
+        blacklist_session: Set[str] = set()
+        speculative = self.settings.get("speculative", True)
 
-        # Save history
-        self.chat_history.append((user_input, final_answer))
-        if len(self.chat_history) > 5:
-            self.chat_history = self.chat_history[-5:]
+        def new_steps():
+            nonlocal emitted
+            steps, emitted = trace[emitted:], len(trace)
+            return [AgentEvent("step", step=step) for step in steps]
 
-        final_snapshots = [
-            DocSnapshot(id=i, path=d.metadata.get('full_path', ''), snippet=d.page_content[:100],
-                        source=d.metadata.get('source_title', ''))
-            for i, d in enumerate(self.doc_pool)
-        ]
+        # 1. Initial Query
+        next_query = user_input
+        if not self._initial_query_skipped(user_input, trace):
+            raw_q = await self.chain_query.ainvoke({"history": history_str, "input": user_input})
+            next_query = self._set_initial_query(raw_q, trace)
+        for event in new_steps():
+            yield event
 
-        return AgentResult(answer=final_answer, final_pool=final_snapshots, trace_log=trace)
\ No newline at end of file
+        # 2. Loop
+        prefetch = None  # (查询词, 发起时的黑名单, 检索任务)
+        final_stream: Optional[TokenStream] = None
+        # 本次调用发起的所有任务，异常或提前结束时统一取消
+        tasks: List[asyncio.Task] = []
+
+        def spawn(coro) -> asyncio.Task:
+            task = asyncio.create_task(coro)
+            tasks.append(task)
+            return task
+
+        def start_final() -> TokenStream:
+            return TokenStream(self.chain_final.astream(self._final_inputs(history_str, user_input)))
+
+        try:
+            loop_count = 0
+            while loop_count < self.max_loops:
+                loop_count += 1
+                last_round = loop_count >= self.max_loops
+                trace.append(AgentStep("Loop", f"Round {loop_count}", f"开始检索: {next_query}"))
+                for event in new_steps():
+                    yield event
+
+                # Search & Update Pool: 预取的查询词与黑名单都一致时直接复用
+                if prefetch and prefetch[0] == next_query and prefetch[1] == blacklist_session:
+                    new_docs = await prefetch[2]
+                else:
+                    if prefetch:
+                        prefetch[2].cancel()
+                    new_docs = await asyncio.to_thread(self._search, next_query, list(blacklist_session))
+                prefetch = None
+                self._update_pool(new_docs, trace)
+                for event in new_steps():
+                    yield event
+
+                # Blacklist Check 与投机评估并行
+                ctx_str, id_map = AgentHelpers.format_docs_for_prompt(self.doc_pool)
+                eval_task = None
+                if speculative:
+                    eval_task = spawn(self.chain_evaluate.ainvoke({"input": user_input, "context": ctx_str}))
+                    if last_round:
+                        # 最后一轮无论评估结果如何都会生成最终回答
+                        final_stream = start_final()
+                if self.doc_pool:
+                    bl_task = spawn(self.chain_blacklist.ainvoke({"input": user_input, "context": ctx_str}))
+                    if eval_task is not None:
+                        prefetch = await self._prefetch_while(bl_task, eval_task, next_query,
+                                                              blacklist_session, last_round, spawn)
+                    if self._apply_blacklist(await bl_task, id_map, blacklist_session, trace) \
+                            and eval_task is not None:
+                        # 文档池已变化，投机评估与最终回答作废
+                        eval_task.cancel()
+                        eval_task = None
+                        if final_stream is not None:
+                            final_stream.cancel()
+                            final_stream = None
+                    for event in new_steps():
+                        yield event
+
+                # Evaluate
+                if eval_task is None:
+                    clean_ctx_str, _ = AgentHelpers.format_docs_for_prompt(self.doc_pool)
+                    eval_task = spawn(
+                        self.chain_evaluate.ainvoke({"input": user_input, "context": clean_ctx_str}))
+                if speculative and last_round and final_stream is None:
+                    final_stream = start_final()
+                decision = AgentHelpers.parse_evaluate(await eval_task)
+                trace.append(AgentStep("Decision", "Evaluation", f"{decision.action} | {decision.next_query}"))
+                for event in new_steps():
+                    yield event
+
+                if decision.action == "STOP":
+                    break
+                elif decision.action == "NEXT":
+                    if not decision.next_query or decision.next_query == next_query:
+                        break
+                    next_query = decision.next_query
+
+            # 3. Final
+            trace.append(AgentStep("Think", "Final Generate", "生成最终回答"))
+            for event in new_steps():
+                yield event
+            if final_stream is None:
+                final_stream = start_final()
+            async for chunk in final_stream:
+                yield AgentEvent("token", token=chunk)
+            cot3_raw = "".join(final_stream.chunks)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            if final_stream is not None and not final_stream.done():
+                final_stream.cancel()
+        yield AgentEvent("result", result=self._finish(user_input, cot3_raw, trace))
+
+    async def _prefetch_while(self, bl_task: asyncio.Task, eval_task: asyncio.Task, query: str,
+                              blacklist_session: Set[str], last_round: bool, spawn):
+        """
+        等待审核期间，若投机评估先给出 NEXT 新查询词，立即在后台发起下一轮检索。
+        返回 (查询词, 发起时的黑名单快照, 检索任务) 或 None。
+        """
+        done, _ = await asyncio.wait({bl_task, eval_task}, return_when=asyncio.FIRST_COMPLETED)
+        if last_round or eval_task not in done or eval_task.exception() is not None:
+            return None
+        decision = AgentHelpers.parse_evaluate(eval_task.result())
+        if decision.action != "NEXT" or not decision.next_query or decision.next_query == query:
+            return None
+        snapshot = set(blacklist_session)
+        task = spawn(asyncio.to_thread(self._search, decision.next_query, list(snapshot)))
+        return decision.next_query, snapshot, task
@@ -0,0 +1,573 @@
+"""
+模块: BM25 Index
+基于倒排索引的 BM25 引擎，评分公式与 rank_bm25.BM25Okapi 完全一致。
+倒排表以紧凑数组存储: term -> [doc_id...] / [tf...]，查询时只访问命中词的倒排表。
+Top-K 查询使用 Block-Max MaxScore 动态剪枝，结果与全量打分完全一致。
+
+磁盘格式 (vector_store/):
+  index.json      版本号与语料统计，最后写入，存在即代表索引完整
+  vocab.json      term 列表，下标即 term_id
+  *.npy           倒排表 / 文档长度 / 块上界等数组，加载时以 memmap 只读打开
+"""
+import json
+import os
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    O(n) 选出得分 > 0 的前 k 个文档 (argpartition)，按得分降序、doc_id 升序返回。
+    边界处同分时取 doc_id 较小者，保证结果确定。
+    """
+    positive = np.flatnonzero(scores > 0)
+    if k <= 0 or not len(positive):
+        return np.zeros(0, dtype=np.int64)
+    if len(positive) > k:
+        cand = scores[positive]
+        kth = cand[np.argpartition(-cand, k - 1)[k - 1]]
+        above = positive[cand > kth]
+        ties = positive[cand == kth][:k - len(above)]
+        positive = np.concatenate([above, ties])
+    order = np.lexsort((positive, -scores[positive]))
+    return positive[order]
+
+
+def calc_idf(doc_freqs: np.ndarray, corpus_size: int, epsilon: float) -> np.ndarray:
+    """
+    复刻 BM25Okapi._calc_idf: 负 idf 以 epsilon * average_idf 兜底。
+    df 为 0 的词 (合并或删除后已无文档) 不计入平均值，idf 记为 0
+    """
+    idf = np.zeros(len(doc_freqs), dtype=np.float64)
+    present = doc_freqs > 0
+    if not present.any():
+        return idf
+    df = doc_freqs[present].astype(np.float64)
+    values = np.log(corpus_size - df + 0.5) - np.log(df + 0.5)
+    average_idf = values.sum() / len(values)
+    values[values < 0] = epsilon * average_idf
+    idf[present] = values
+    return idf
+
+
+class BM25Index:
+    FORMAT_VERSION = 1
+    MANIFEST_FILE = "index.json"
+    VOCAB_FILE = "vocab.json"
+    ARRAYS = ("term_offsets", "post_docs", "post_tfs", "doc_lens",
+              "term_block_offsets", "block_last_doc", "block_max")
+    # 每个倒排块包含的 posting 数，块内最大得分作为该块的上界
+    BLOCK_SIZE = 128
+    BLOCK_CHUNK = 8192
+    # 浮点累加误差的安全余量，上界判断偏保守以保证结果精确
+    UB_SLACK = 1 + 1e-9
+    # 用于估计初始门槛的种子文档数
+    SEED_SIZE = 64
+    # 剪枝代价估计的权重，以全量打分扫描一个 posting 为单位 (100k 文档 Zipf 语料上实测拟合)
+    ESSENTIAL_COST = 1.5  # 必要词的 posting: 累加之外还要标记候选
+    LOOKUP_COST = 1.5     # 一个候选在一个非必要词上的块上界与二分查表
+
+    def __init__(self, vocab: Dict[str, int], term_offsets: np.ndarray, post_docs: np.ndarray,
+                 post_tfs: np.ndarray, doc_lens: np.ndarray,
+                 k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25,
+                 blocks: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+                 build_avgdl: Optional[float] = None):
+        """
+        vocab: term -> term_id
+        term_offsets: 长度 n_terms + 1，term_id 的倒排表位于 post_docs[offsets[i]:offsets[i+1]]
+        post_docs / post_tfs: 所有倒排表按 term_id 顺序拼接，表内 doc_id 升序
+        blocks: 已持久化的 (term_block_offsets, block_last_doc, block_max)，为空时现场计算
+        build_avgdl: 持久化的块上界对应的 avgdl
+        """
+        self.vocab = vocab
+        self.term_offsets = term_offsets
+        self.post_docs = post_docs
+        self.post_tfs = post_tfs
+        self.doc_lens = doc_lens
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+
+        self.corpus_size = len(doc_lens)
+        avgdl = float(doc_lens.sum()) / self.corpus_size if self.corpus_size else 0.0
+        # 计算 block_max 时使用的 avgdl，语料统计变化后用于放缩块上界
+        self.build_avgdl = avgdl if build_avgdl is None else build_avgdl
+        self.set_corpus_stats(avgdl, calc_idf(np.diff(term_offsets), self.corpus_size, epsilon))
+        if blocks is None:
+            self._build_blocks()
+        else:
+            self.term_block_offsets, self.block_last_doc, self.block_max = blocks
+
+    def set_corpus_stats(self, avgdl: float, idf: np.ndarray):
+        """
+        设置打分使用的语料统计。分段索引中由 IndexStore 传入全库的 avgdl 与按全库 df 算出的 idf，
+        使各段得分与单一索引一致。
+        """
+        self.avgdl = avgdl
+        self.idf = idf
+        # 长度归一化项只依赖文档，预先算好
+        if self.corpus_size and avgdl:
+            self.norm = self.k1 * (1 - self.b + self.b * self.doc_lens.astype(np.float64) / avgdl)
+        else:
+            self.norm = np.zeros(self.corpus_size, dtype=np.float64)
+        # avgdl 变大时文档的相对长度变短、得分变高，块上界按比例放大仍然成立
+        self.block_scale = max(1.0, avgdl / self.build_avgdl) if self.build_avgdl else 1.0
+
+    # === Build ===
+
+    @classmethod
+    def build(cls, tokenized_corpus: Iterable[Sequence[str]], **params) -> "BM25Index":
+        """从分词后的语料构建索引"""
+        vocab: Dict[str, int] = {}
+        term_docs: List[array] = []
+        term_tfs: List[array] = []
+        doc_lens = array('i')
+
+        for doc_id, tokens in enumerate(tokenized_corpus):
+            doc_lens.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                tid = vocab.get(term)
+                if tid is None:
+                    tid = vocab[term] = len(term_docs)
+                    term_docs.append(array('i'))
+                    term_tfs.append(array('i'))
+                term_docs[tid].append(doc_id)
+                term_tfs[tid].append(tf)
+
+        return cls._from_postings(vocab, term_docs, term_tfs, doc_lens, **params)
+
+    @classmethod
+    def from_bm25okapi(cls, model) -> "BM25Index":
+        """将旧版 pickle 的 BM25Okapi 模型转换为倒排索引 (用于旧库迁移)"""
+        vocab: Dict[str, int] = {}
+        term_docs: List[array] = []
+        term_tfs: List[array] = []
+
+        for doc_id, freqs in enumerate(model.doc_freqs):
+            for term, tf in freqs.items():
+                tid = vocab.get(term)
+                if tid is None:
+                    tid = vocab[term] = len(term_docs)
+                    term_docs.append(array('i'))
+                    term_tfs.append(array('i'))
+                term_docs[tid].append(doc_id)
+                term_tfs[tid].append(tf)
+
+        return cls._from_postings(vocab, term_docs, term_tfs, array('i', model.doc_len),
+                                  k1=model.k1, b=model.b, epsilon=model.epsilon)
+
+    @classmethod
+    def _from_postings(cls, vocab, term_docs, term_tfs, doc_lens, **params) -> "BM25Index":
+        lengths = np.fromiter((len(p) for p in term_docs), dtype=np.int64, count=len(term_docs))
+        term_offsets = np.zeros(len(term_docs) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=term_offsets[1:])
+
+        post_docs = np.empty(int(term_offsets[-1]), dtype=np.int32)
+        post_tfs = np.empty(int(term_offsets[-1]), dtype=np.int32)
+        for tid, (docs, tfs) in enumerate(zip(term_docs, term_tfs)):
+            s, e = term_offsets[tid], term_offsets[tid + 1]
+            post_docs[s:e] = np.frombuffer(docs, dtype=np.int32)
+            post_tfs[s:e] = np.frombuffer(tfs, dtype=np.int32)
+
+        return cls(vocab, term_offsets, post_docs, post_tfs,
+                   np.frombuffer(doc_lens, dtype=np.int32).copy(), **params)
+
+    def _build_blocks(self):
+        """
+        将每个倒排表切成 BLOCK_SIZE 大小的块，记录块内最后一个 doc_id 与块内最大的 tf 归一化得分
+        (不含 idf)，查询时乘以 idf 即得该块的得分上界。
+        """
+        lengths = np.diff(self.term_offsets)
+        n_blocks = (lengths + self.BLOCK_SIZE - 1) // self.BLOCK_SIZE
+        self.term_block_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(n_blocks, out=self.term_block_offsets[1:])
+
+        total = int(self.term_block_offsets[-1])
+        if not total:
+            self.block_last_doc = np.zeros(0, dtype=np.int32)
+            self.block_max = np.zeros(0, dtype=np.float64)
+            return
+
+        block_term = np.repeat(np.arange(len(lengths)), n_blocks)
+        block_rank = np.arange(total) - self.term_block_offsets[block_term]
+        starts = self.term_offsets[block_term] + block_rank * self.BLOCK_SIZE
+        ends = np.minimum(starts + self.BLOCK_SIZE, self.term_offsets[block_term + 1])
+
+        self.block_last_doc = np.asarray(self.post_docs[ends - 1])
+        self.block_max = np.empty(total, dtype=np.float64)
+        # 分段计算，临时数组大小受 BLOCK_CHUNK 限制 (倒排可能是 memmap)
+        for i in range(0, total, self.BLOCK_CHUNK):
+            j = min(i + self.BLOCK_CHUNK, total)
+            lo, hi = starts[i], ends[j - 1]
+            tfs = np.asarray(self.post_tfs[lo:hi], dtype=np.float64)
+            tf_part = tfs * (self.k1 + 1) / (tfs + self.norm[self.post_docs[lo:hi]])
+            self.block_max[i:j] = np.maximum.reduceat(tf_part, starts[i:j] - lo)
+
+    # === Query ===
+
+    def _contrib(self, tid: int, count: int, docs: np.ndarray, tfs: np.ndarray) -> np.ndarray:
+        """单个词对给定 posting 的得分贡献 (count = 该词在 query 中的出现次数)"""
+        tfs = tfs.astype(np.float64)
+        return count * (self.idf[tid] * (tfs * (self.k1 + 1) / (tfs + self.norm[docs])))
+
+    def _block_bounds(self, tid: int, count: int) -> np.ndarray:
+        """某个词每个倒排块的得分上界"""
+        bs, be = self.term_block_offsets[tid], self.term_block_offsets[tid + 1]
+        return count * self.idf[tid] * self.block_max[bs:be] * (self.block_scale * self.UB_SLACK)
+
+    def _query_terms(self, query_tokens: Sequence[str]) -> List[Tuple[int, int, float]]:
+        """
+        解析 query 为 (term_id, count, upper_bound) 列表，按上界降序排列。
+        这是得分的规范累加顺序，全量打分与剪枝查询的最终得分都按此顺序计算，保证浮点结果逐位一致。
+        """
+        terms = []
+        for term, count in Counter(query_tokens).items():
+            tid = self.vocab.get(term)
+            # 无倒排或 idf 为 0 (分段索引中已被全部删除) 的词不影响得分
+            if tid is None or self.term_offsets[tid] == self.term_offsets[tid + 1] or self.idf[tid] == 0:
+                continue
+            terms.append((tid, count, float(self._block_bounds(tid, count).max())))
+        terms.sort(key=lambda t: (-t[2], t[0]))
+        return terms
+
+    def get_scores(self, query_tokens: Sequence[str]) -> np.ndarray:
+        """对全库打分，结果与 BM25Okapi.get_scores 相同"""
+        scores = np.zeros(self.corpus_size, dtype=np.float64)
+        for tid, count, _ in self._query_terms(query_tokens):
+            s, e = self.term_offsets[tid], self.term_offsets[tid + 1]
+            docs = self.post_docs[s:e]
+            # 同一个词在 query 中重复出现时，BM25Okapi 会重复累加
+            scores[docs] += self._contrib(tid, count, docs, self.post_tfs[s:e])
+        return scores
+
+    def top_k(self, query_tokens: Sequence[str], k: int,
+              exclude: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        返回得分 > 0 的前 k 个 (doc_ids, scores)，exclude 为需要屏蔽的文档布尔数组。
+        MaxScore: 先估计第 k 名得分的下界 threshold，把倒排最长、上界之和低于 threshold 的词
+        划为非必要词。只出现在非必要词中的文档不可能进入 Top K，因此只需扫描必要 (稀有) 词的倒排，
+        非必要 (高频) 词只对候选文档查表。
+        Block-Max: 查表前用候选所在块的上界进一步淘汰候选。
+        高频词较多时候选接近全库，查表比直接扫描更慢，按代价估计退回全量打分。
+        """
+        terms = self._query_terms(query_tokens)
+        if k <= 0 or not terms:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        if len(terms) == 1 or min(self.idf[tid] for tid, _, _ in terms) <= 0:
+            # 单个词无可剪枝; 负权重会破坏上界的单调性，退回全量打分
+            return self._exhaustive_top_k(query_tokens, k, exclude)
+
+        threshold = self._seed_threshold(terms, k, exclude)
+
+        # 按倒排长度从长到短，尽可能多地划入非必要词
+        non_essential, ne_ub = [], 0.0
+        for term in sorted(terms, key=lambda t: self.term_offsets[t[0]] - self.term_offsets[t[0] + 1]):
+            if ne_ub + term[2] >= threshold:
+                break
+            non_essential.append(term)
+            ne_ub += term[2]
+        if not non_essential:
+            return self._exhaustive_top_k(query_tokens, k, exclude)
+        essential = [t for t in terms if t not in non_essential]
+        if not self._pruning_pays_off(essential, non_essential):
+            return self._exhaustive_top_k(query_tokens, k, exclude)
+        non_essential.sort(key=lambda t: (-t[2], t[0]))
+
+        # 阶段 1: 必要词完整累加，出现过的文档即候选
+        acc = np.zeros(self.corpus_size, dtype=np.float64)
+        seen = np.zeros(self.corpus_size, dtype=bool)
+        for tid, count, _ in essential:
+            s, e = self.term_offsets[tid], self.term_offsets[tid + 1]
+            docs = self.post_docs[s:e]
+            acc[docs] += self._contrib(tid, count, docs, self.post_tfs[s:e])
+            seen[docs] = True
+        if exclude is not None:
+            seen &= ~exclude
+        cand = np.flatnonzero(seen)
+        threshold = max(threshold, self._kth_score(acc, cand, k))
+
+        # 阶段 2: 先用非必要词的全局上界粗筛，再用块级上界细筛
+        cand = cand[acc[cand] + ne_ub >= threshold / self.UB_SLACK]
+        bounds = acc[cand].copy()
+        for tid, count, _ in non_essential:
+            bounds += self._candidate_block_bounds(tid, count, cand)
+        cand = cand[bounds >= threshold / self.UB_SLACK]
+
+        # 阶段 3: 非必要词对候选查表，得分上升后门槛随之提高，继续淘汰候选
+        for j, (tid, count, _) in enumerate(non_essential):
+            acc[cand] += self._lookup_contrib(tid, count, cand)
+            if len(cand) > k:
+                threshold = max(threshold, self._kth_score(acc, cand, k))
+                rest_ub = sum(t[2] for t in non_essential[j + 1:])
+                cand = cand[acc[cand] + rest_ub >= threshold / self.UB_SLACK]
+
+        # 按规范顺序重算存活候选的得分，与 get_scores 逐位一致
+        scores = self._exact_scores(terms, cand)
+        order = top_k_indices(scores, k)
+        return cand[order], scores[order]
+
+    def _pruning_pays_off(self, essential, non_essential) -> bool:
+        """
+        比较剪枝与全量打分的估计代价。全量打分扫描全部倒排; 剪枝扫描必要词的倒排，
+        再对每个候选逐个非必要词查表。候选数按必要词在文档中独立出现估计 (其倒排的并集大小)。
+        """
+        def length(term):
+            return int(self.term_offsets[term[0] + 1] - self.term_offsets[term[0]])
+
+        essential_postings = sum(map(length, essential))
+        scan = essential_postings + sum(map(length, non_essential))
+        miss = 1.0
+        for term in essential:
+            miss *= 1 - length(term) / self.corpus_size
+        n_cand = self.corpus_size * (1 - miss)
+        cost = self.ESSENTIAL_COST * essential_postings + self.LOOKUP_COST * n_cand * len(non_essential)
+        return cost < scan
+
+    def _exact_scores(self, terms, cand: np.ndarray) -> np.ndarray:
+        scores = np.zeros(len(cand), dtype=np.float64)
+        for tid, count, _ in terms:
+            scores += self._lookup_contrib(tid, count, cand)
+        return scores
+
+    def _seed_threshold(self, terms, k, exclude) -> float:
+        """
+        取倒排最短的词中贡献最高的少量文档计算完整得分，
+        其第 k 名即为最终第 k 名得分的下界，让剪枝在扫描倒排之前就能生效。
+        """
+        lengths = [int(self.term_offsets[t + 1] - self.term_offsets[t]) for t, _, _ in terms]
+        usable = [i for i, n in enumerate(lengths) if n >= k]
+        if not usable:
+            return 0.0
+        tid, count, _ = terms[min(usable, key=lengths.__getitem__)]
+        s, e = self.term_offsets[tid], self.term_offsets[tid + 1]
+        docs, tfs = self.post_docs[s:e], self.post_tfs[s:e]
+        if exclude is not None:
+            keep = ~exclude[docs]
+            docs, tfs = docs[keep], tfs[keep]
+        if len(docs) < k:
+            return 0.0
+        if len(docs) > self.SEED_SIZE:
+            contrib = self._contrib(tid, count, docs, tfs)
+            docs = np.sort(docs[np.argpartition(-contrib, self.SEED_SIZE - 1)[:self.SEED_SIZE]])
+
+        scores = self._exact_scores(terms, docs)
+        return float(np.partition(scores, len(scores) - k)[len(scores) - k])
+
+    def _lookup_contrib(self, tid: int, count: int, cand: np.ndarray) -> np.ndarray:
+        """在某个词的倒排表中二分查找候选文档，返回与 cand 对齐的得分贡献 (未命中为 0)"""
+        s, e = self.term_offsets[tid], self.term_offsets[tid + 1]
+        docs = self.post_docs[s:e]
+        pos = np.minimum(docs.searchsorted(cand), len(docs) - 1) + s
+        # tf 取 0 时贡献恰为 0，累加后得分逐位不变
+        tfs = np.where(self.post_docs[pos] == cand, self.post_tfs[pos], 0)
+        return self._contrib(tid, count, cand, tfs)
+
+    def _exhaustive_top_k(self, query_tokens, k, exclude):
+        scores = self.get_scores(query_tokens)
+        if exclude is not None:
+            scores[exclude] = 0
+        ids = top_k_indices(scores, k)
+        return ids, scores[ids]
+
+    @staticmethod
+    def _kth_score(acc: np.ndarray, cand: np.ndarray, k: int) -> float:
+        """候选文档当前部分得分中的第 k 名，作为最终第 k 名得分的下界"""
+        if len(cand) < k:
+            return 0.0
+        return float(np.partition(acc[cand], len(cand) - k)[len(cand) - k])
+
+    def _candidate_block_bounds(self, tid: int, count: int, cand: np.ndarray) -> np.ndarray:
+        """候选文档在某个词上的块级得分上界，不在该词倒排范围内的为 0"""
+        bs, be = self.term_block_offsets[tid], self.term_block_offsets[tid + 1]
+        block_ub = self._block_bounds(tid, count)
+        idx = np.searchsorted(self.block_last_doc[bs:be], cand)
+        out = np.zeros(len(cand), dtype=np.float64)
+        inside = idx < (be - bs)
+        out[inside] = block_ub[idx[inside]]
+        return out
+
+    # === Persistence ===
+
+    @classmethod
+    def exists(cls, index_dir: str) -> bool:
+        return os.path.exists(os.path.join(index_dir, cls.MANIFEST_FILE))
+
+    def save(self, index_dir: str):
+        os.makedirs(index_dir, exist_ok=True)
+        for name in self.ARRAYS:
+            path = os.path.join(index_dir, f"{name}.npy")
+            arr = getattr(self, name)
+            # BM25IndexWriter 直接写好的 memmap 无需再写一遍
+            if isinstance(arr, np.memmap) and arr.filename and os.path.abspath(arr.filename) == os.path.abspath(path):
+                arr.flush()
+                continue
+            np.save(path, np.ascontiguousarray(arr))
+
+        terms = sorted(self.vocab, key=self.vocab.get)
+        with open(os.path.join(index_dir, self.VOCAB_FILE), 'w', encoding='utf-8') as f:
+            json.dump(terms, f, ensure_ascii=False)
+
+        manifest = {
+            "version": self.FORMAT_VERSION,
+            "n_docs": self.corpus_size,
+            "n_terms": len(terms),
+            "n_postings": int(self.term_offsets[-1]),
+            "avgdl": self.build_avgdl,
+            "k1": self.k1,
+            "b": self.b,
+            "epsilon": self.epsilon,
+            "block_size": self.BLOCK_SIZE,
+        }
+        # manifest 最后原子写入，读到它即说明数组文件已完整
+        tmp_path = os.path.join(index_dir, self.MANIFEST_FILE + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(index_dir, self.MANIFEST_FILE))
+
+    @classmethod
+    def load(cls, index_dir: str) -> "BM25Index":
+        """以 memmap 方式打开索引，倒排数据按需从页缓存读取"""
+        with open(os.path.join(index_dir, cls.MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get("version") != cls.FORMAT_VERSION:
+            raise ValueError(f"Unsupported index version: {manifest.get('version')}")
+
+        with open(os.path.join(index_dir, cls.VOCAB_FILE), 'r', encoding='utf-8') as f:
+            terms = json.load(f)
+        # allow_pickle=False: 索引文件只包含纯数值数组
+        arrays = {name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode='r', allow_pickle=False)
+                  for name in cls.ARRAYS}
+        return cls(
+            {t: i for i, t in enumerate(terms)},
+            arrays["term_offsets"], arrays["post_docs"], arrays["post_tfs"], arrays["doc_lens"],
+            k1=manifest["k1"], b=manifest["b"], epsilon=manifest["epsilon"],
+            blocks=(arrays["term_block_offsets"], arrays["block_last_doc"], arrays["block_max"]),
+            build_avgdl=manifest["avgdl"],
+        )
+
+
+class BM25IndexWriter:
+    """
+    流式构建索引，内存占用与语料规模无关:
+    posting 在内存中累积到 run_size 条后按 (term_id, doc_id) 排序落盘为一个 run，
+    close 时按各词的 df 预分配倒排表，把所有 run 依次散列写入 memmap。
+    """
+
+    def __init__(self, index_dir: str, run_size: int = 2_000_000, **params):
+        os.makedirs(index_dir, exist_ok=True)
+        self.index_dir = index_dir
+        self.run_dir = os.path.join(index_dir, "_runs")
+        os.makedirs(self.run_dir, exist_ok=True)
+        self.run_size = run_size
+        self.params = params
+
+        self.vocab: Dict[str, int] = {}
+        self.doc_freqs = array('q')
+        self.doc_lens = array('i')
+        self.run_paths: List[str] = []
+        self._run_terms, self._run_docs, self._run_tfs = array('i'), array('i'), array('i')
+
+    def add(self, tokens: Sequence[str]) -> int:
+        """追加一个文档，返回其 doc_id"""
+        doc_id = len(self.doc_lens)
+        self.doc_lens.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            tid = self.vocab.get(term)
+            if tid is None:
+                tid = self.vocab[term] = len(self.doc_freqs)
+                self.doc_freqs.append(0)
+            self.doc_freqs[tid] += 1
+            self._run_terms.append(tid)
+            self._run_docs.append(doc_id)
+            self._run_tfs.append(tf)
+
+        if len(self._run_terms) >= self.run_size:
+            self._flush_run()
+        return doc_id
+
+    def add_index(self, index: BM25Index, live: np.ndarray):
+        """
+        追加另一个索引中 live 为 True 的文档 (段合并用)，直接搬运 posting，无需重新分词。
+        文档按原顺序重新编号。
+        """
+        self._flush_run()
+        base = len(self.doc_lens)
+        new_ids = np.cumsum(live, dtype=np.int64) - 1 + base
+        self.doc_lens.extend(np.asarray(index.doc_lens)[live].astype(np.int32).tolist())
+
+        # 本段 term_id -> 合并后 term_id
+        term_map = np.empty(len(index.vocab), dtype=np.int32)
+        for term, local_tid in index.vocab.items():
+            tid = self.vocab.get(term)
+            if tid is None:
+                tid = self.vocab[term] = len(self.doc_freqs)
+                self.doc_freqs.append(0)
+            term_map[local_tid] = tid
+
+        # 按 run_size 分片搬运，内存占用与被合并索引的规模无关。
+        # 同一个词在一个索引内的 posting 是连续的，分片后仍按 doc_id 递增的顺序落入各 run
+        live_ids = new_ids.astype(np.int32)
+        n_postings = int(index.term_offsets[-1])
+        for start in range(0, n_postings, self.run_size):
+            end = min(start + self.run_size, n_postings)
+            docs = np.asarray(index.post_docs[start:end])
+            keep = live[docs]
+            local_tids = np.searchsorted(index.term_offsets, np.arange(start, end), side='right') - 1
+            terms = term_map[local_tids[keep]]
+            for tid, df in zip(*np.unique(terms, return_counts=True)):
+                self.doc_freqs[tid] += int(df)
+            order = np.argsort(terms, kind='stable')
+            self._save_run(terms[order], live_ids[docs[keep]][order],
+                           np.asarray(index.post_tfs[start:end])[keep][order])
+
+    def __len__(self):
+        return len(self.doc_lens)
+
+    def _save_run(self, terms: np.ndarray, docs: np.ndarray, tfs: np.ndarray):
+        path = os.path.join(self.run_dir, f"run_{len(self.run_paths):05d}.npz")
+        np.savez(path, terms=terms, docs=docs, tfs=tfs)
+        self.run_paths.append(path)
+
+    def _flush_run(self):
+        if not self._run_terms:
+            return
+        terms = np.frombuffer(self._run_terms, dtype=np.int32)
+        # doc_id 本身递增，按 term 稳定排序后每个词的 doc_id 仍有序
+        order = np.argsort(terms, kind='stable')
+        self._save_run(terms[order],
+                       np.frombuffer(self._run_docs, dtype=np.int32)[order],
+                       np.frombuffer(self._run_tfs, dtype=np.int32)[order])
+        self._run_terms, self._run_docs, self._run_tfs = array('i'), array('i'), array('i')
+
+    def close(self) -> BM25Index:
+        """归并所有 run，写出完整索引并返回 (memmap 打开的) BM25Index"""
+        self._flush_run()
+        n_terms = len(self.doc_freqs)
+        term_offsets = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(np.frombuffer(self.doc_freqs, dtype=np.int64), out=term_offsets[1:])
+        n_postings = int(term_offsets[-1])
+
+        post_docs = np.lib.format.open_memmap(os.path.join(self.index_dir, "post_docs.npy"),
+                                              mode='w+', dtype=np.int32, shape=(n_postings,))
+        post_tfs = np.lib.format.open_memmap(os.path.join(self.index_dir, "post_tfs.npy"),
+                                             mode='w+', dtype=np.int32, shape=(n_postings,))
+        cursor = np.zeros(n_terms, dtype=np.int64)
+        for path in self.run_paths:
+            with np.load(path, allow_pickle=False) as run:
+                terms, docs, tfs = run["terms"], run["docs"], run["tfs"]
+            counts = np.bincount(terms, minlength=n_terms)
+            seg_start = np.cumsum(counts) - counts
+            dest = term_offsets[terms] + cursor[terms] + (np.arange(len(terms)) - seg_start[terms])
+            post_docs[dest] = docs
+            post_tfs[dest] = tfs
+            cursor += counts
+            os.remove(path)
+        os.rmdir(self.run_dir)
+
+        index = BM25Index(self.vocab, term_offsets, post_docs, post_tfs,
+                          np.frombuffer(self.doc_lens, dtype=np.int32).copy(), **self.params)
+        index.save(self.index_dir)
+        return index
@@ -0,0 +1,91 @@
+"""
+模块: Document Store
+检索文档的只读存储，与 BM25 索引放在同一个 vector_store/ 目录下。
+正文按 doc_id 顺序拼接写入 docs.bin，偏移表 doc_offsets.npy 以 memmap 打开，
+查询时只解码命中的文档，常驻内存与命中数相关而非语料规模。
+"""
+import json
+import mmap
+import os
+from array import array
+from typing import Dict, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+
+class DocStoreWriter:
+    """顺序写入文档，close 时落盘偏移表与路径表"""
+
+    def __init__(self, index_dir: str):
+        os.makedirs(index_dir, exist_ok=True)
+        self.index_dir = index_dir
+        self._f = open(os.path.join(index_dir, DocStore.DATA_FILE), 'wb')
+        self._offsets = array('q', [0])
+        self._path_to_id: Dict[str, int] = {}
+        self._path_ids = array('i')
+
+    def add(self, page_content: str, metadata: Dict):
+        record = json.dumps({"page_content": page_content, "metadata": metadata}, ensure_ascii=False)
+        self.add_raw(record.encode('utf-8'), metadata.get('full_path', ''))
+
+    def add_raw(self, record: bytes, path: str):
+        """直接写入已编码的文档记录 (段合并时从 DocStore.get_raw 搬运)"""
+        self._offsets.append(self._offsets[-1] + self._f.write(record))
+        self._path_ids.append(self._path_to_id.setdefault(path, len(self._path_to_id)))
+
+    def __len__(self):
+        return len(self._path_ids)
+
+    def close(self):
+        self._f.close()
+        np.save(os.path.join(self.index_dir, DocStore.OFFSETS_FILE), np.frombuffer(self._offsets, dtype=np.int64))
+        np.save(os.path.join(self.index_dir, DocStore.PATH_IDS_FILE), np.frombuffer(self._path_ids, dtype=np.int32))
+        with open(os.path.join(self.index_dir, DocStore.PATHS_FILE), 'w', encoding='utf-8') as f:
+            json.dump(list(self._path_to_id), f, ensure_ascii=False)
+
+
+class DocStore:
+    DATA_FILE = "docs.bin"
+    OFFSETS_FILE = "doc_offsets.npy"
+    # 每个文档所属 full_path 的编号，用于黑名单的向量化屏蔽
+    PATH_IDS_FILE = "doc_path_ids.npy"
+    PATHS_FILE = "paths.json"
+
+    def __init__(self, index_dir: str):
+        self.offsets = np.load(os.path.join(index_dir, self.OFFSETS_FILE), mmap_mode='r', allow_pickle=False)
+        self.doc_path_ids = np.load(os.path.join(index_dir, self.PATH_IDS_FILE), mmap_mode='r', allow_pickle=False)
+        with open(os.path.join(index_dir, self.PATHS_FILE), 'r', encoding='utf-8') as f:
+            self.paths = json.load(f)
+        self.path_to_id = {p: i for i, p in enumerate(self.paths)}
+
+        self._file = open(os.path.join(index_dir, self.DATA_FILE), 'rb')
+        # 空文件无法 mmap
+        self._data: Optional[mmap.mmap] = None
+        if self.offsets[-1] > 0:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def exists(index_dir: str) -> bool:
+        return os.path.exists(os.path.join(index_dir, DocStore.OFFSETS_FILE))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_raw(self, doc_id: int) -> bytes:
+        start, end = int(self.offsets[doc_id]), int(self.offsets[doc_id + 1])
+        return self._data[start:end]
+
+    def get(self, doc_id: int) -> Document:
+        """按偏移读取并解码单个文档"""
+        item = json.loads(self.get_raw(doc_id).decode('utf-8'))
+        return Document(page_content=item["page_content"], metadata=item["metadata"])
+
+    def path_of(self, doc_id: int) -> str:
+        return self.paths[self.doc_path_ids[doc_id]]
+
+    def close(self):
+        if self._data is not None:
+            self._data.close()
+            self._data = None
+        self._file.close()
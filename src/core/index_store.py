@@ -0,0 +1,537 @@
+"""
+模块: Index Store
+分段 (LSM 风格) 的库索引，支持按 chunk 增量新增 / 替换 / 删除。
+
+磁盘格式 (vector_store/):
+  manifest.json       版本号、代号与段列表，原子替换，读到的永远是一致的快照
+  seg_<id>/           不可变段: BM25Index + DocStore + chunks.json (每个文档的 key 与内容哈希)
+    deleted_{gen}.npy 删除标记 (tombstone)，按代号写新文件，不修改已发布的文件
+    live_df_{gen}.npy 扣除已删除文档后的各词 df，用于计算全库 idf
+
+chunk key = sha1(source + title + 同名序号)，内容哈希用于判断 chunk 是否变化。
+各段单独打分，但 avgdl / idf 按全库的存活文档计算后下发给每个段，得分与单一索引一致。
+段数过多或删除比例过高时在后台线程合并，合并期间发生的删除会映射到新段上。
+被合并掉的段与被新一代取代的删除标记记入 manifest 的 retired / retired_deletes，
+到下一次提交时才删除: 刚读到上一版 manifest 的读取端仍能打开它们。
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from src.core.bm25_index import BM25Index, BM25IndexWriter, calc_idf
+from src.core.doc_store import DocStore, DocStoreWriter
+
+# 同一目录只允许一个提交者，不同 IndexStore 实例共享同一把锁
+_store_locks: Dict[str, threading.RLock] = {}
+_store_locks_guard = threading.Lock()
+
+
+def _store_lock(store_dir: str) -> threading.RLock:
+    with _store_locks_guard:
+        return _store_locks.setdefault(os.path.abspath(store_dir), threading.RLock())
+
+
+def content_hash(page_content: str) -> str:
+    return hashlib.sha1(page_content.encode('utf-8')).hexdigest()
+
+
+class ChunkKeyer:
+    """按出现顺序为 (source, title) 生成 chunk key，同一页面下的同名 chunk 以序号区分"""
+
+    def __init__(self):
+        self._seen = Counter()
+
+    def key(self, source: str, title: str) -> str:
+        occurrence = self._seen[(source, title)]
+        self._seen[(source, title)] += 1
+        return hashlib.sha1(f"{source}\x00{title}\x00{occurrence}".encode('utf-8')).hexdigest()
+
+
+def _write_json_atomic(path: str, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+class SegmentWriter:
+    """写一个新段: 倒排索引、文档与 chunk 表同步追加"""
+
+    def __init__(self, seg_dir: str, **params):
+        self.seg_dir = seg_dir
+        self.index_writer = BM25IndexWriter(seg_dir, **params)
+        self.doc_writer = DocStoreWriter(seg_dir)
+        self.keys: List[str] = []
+        self.hashes: List[str] = []
+
+    def add(self, key: str, tokens: Sequence[str], page_content: str, metadata: Dict) -> int:
+        self.index_writer.add(tokens)
+        self.doc_writer.add(page_content, metadata)
+        self.keys.append(key)
+        self.hashes.append(content_hash(page_content))
+        return len(self.keys) - 1
+
+    def add_segment(self, segment: "Segment", live: np.ndarray):
+        """搬运另一个段中 live 为 True 的文档，无需重新分词"""
+        self.index_writer.add_index(segment.index, live)
+        keys, hashes = segment.chunks()
+        for doc_id in np.flatnonzero(live):
+            doc_id = int(doc_id)
+            self.doc_writer.add_raw(segment.doc_store.get_raw(doc_id), segment.doc_store.path_of(doc_id))
+            self.keys.append(keys[doc_id])
+            self.hashes.append(hashes[doc_id])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        self.doc_writer.close()
+        self.index_writer.close()
+        write_chunk_table(self.seg_dir, self.keys, self.hashes)
+
+
+def write_chunk_table(seg_dir: str, keys: List[str], hashes: List[str]):
+    with open(os.path.join(seg_dir, Segment.CHUNKS_FILE), 'w', encoding='utf-8') as f:
+        json.dump({"keys": keys, "hashes": hashes}, f)
+
+
+def chunk_table_from_docs(docs: Iterable[Tuple[str, Dict]]) -> Tuple[List[str], List[str]]:
+    """由 (page_content, metadata) 序列计算 chunk 表 (迁移旧索引用)"""
+    keyer = ChunkKeyer()
+    keys, hashes = [], []
+    for page_content, metadata in docs:
+        keys.append(keyer.key(metadata.get("source", ""), metadata.get("full_path", "")))
+        hashes.append(content_hash(page_content))
+    return keys, hashes
+
+
+class Segment:
+    CHUNKS_FILE = "chunks.json"
+
+    def __init__(self, seg_dir: str, name: str, deletes: Optional[int] = None):
+        self.name = name
+        self.seg_dir = seg_dir
+        self.index = BM25Index.load(seg_dir)
+        self.doc_store = DocStore(seg_dir)
+        self._keys: Optional[List[str]] = None
+        self._hashes: Optional[List[str]] = None
+        self.load_deletes(deletes)
+
+    def load_deletes(self, deletes: Optional[int]):
+        """加载指定代号的删除标记，None 表示没有删除；文件不存在时抛出 FileNotFoundError，原状态不变"""
+        if deletes is None:
+            self.deleted: Optional[np.ndarray] = None
+            self.live_df = np.diff(self.index.term_offsets)
+            self.live_count = self.index.corpus_size
+            self.live_len = int(np.asarray(self.index.doc_lens).sum())
+        else:
+            deleted = np.load(self._deleted_path(deletes), allow_pickle=False)
+            live_df = np.load(self._live_df_path(deletes), allow_pickle=False)
+            self.deleted, self.live_df = deleted, live_df
+            live = ~deleted
+            self.live_count = int(live.sum())
+            self.live_len = int(np.asarray(self.index.doc_lens)[live].sum())
+        self.deletes = deletes
+
+    def _deleted_path(self, gen: int) -> str:
+        return os.path.join(self.seg_dir, f"deleted_{gen}.npy")
+
+    def _live_df_path(self, gen: int) -> str:
+        return os.path.join(self.seg_dir, f"live_df_{gen}.npy")
+
+    def write_deletes(self, gen: int, deleted: np.ndarray):
+        """写出新一代删除标记，并按倒排表重算存活 df"""
+        index = self.index
+        live_df = np.zeros(len(index.vocab), dtype=np.int64)
+        n_postings = int(index.term_offsets[-1])
+        step = 1 << 22
+        for start in range(0, n_postings, step):
+            end = min(start + step, n_postings)
+            alive = ~deleted[np.asarray(index.post_docs[start:end])]
+            tids = np.searchsorted(index.term_offsets, np.arange(start, end), side='right') - 1
+            live_df += np.bincount(tids[alive], minlength=len(live_df))
+        np.save(self._deleted_path(gen), deleted)
+        np.save(self._live_df_path(gen), live_df)
+
+    def chunks(self) -> Tuple[List[str], List[str]]:
+        """(keys, hashes)，按 doc_id 排列；只有写入端需要，首次访问时才加载"""
+        if self._keys is None:
+            with open(os.path.join(self.seg_dir, self.CHUNKS_FILE), 'r', encoding='utf-8') as f:
+                table = json.load(f)
+            self._keys, self._hashes = table["keys"], table["hashes"]
+        return self._keys, self._hashes
+
+    def exclude_mask(self, blacklist_paths: List[str]) -> Optional[np.ndarray]:
+        """已删除文档与黑名单路径 -> 文档级布尔屏蔽数组 (True 表示屏蔽)"""
+        mask = self.deleted
+        path_to_id = self.doc_store.path_to_id
+        ids = [path_to_id[p] for p in blacklist_paths if p in path_to_id]
+        if ids:
+            blocked = np.zeros(len(path_to_id), dtype=bool)
+            blocked[ids] = True
+            blocked = blocked[self.doc_store.doc_path_ids]
+            mask = blocked if mask is None else (blocked | mask)
+        return mask
+
+    def close(self):
+        self.doc_store.close()
+
+
+class IndexStore:
+    FORMAT_VERSION = 1
+    MANIFEST_FILE = "manifest.json"
+    # 段数达到 MERGE_FACTOR 或删除比例超过 MERGE_DELETED_RATIO 时触发合并
+    MERGE_FACTOR = 4
+    MERGE_DELETED_RATIO = 0.3
+    # refresh 时段文件已被清理 (manifest 又更新了) 的重试次数
+    REFRESH_RETRIES = 3
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self._lock = _store_lock(store_dir)
+        self._merge_thread: Optional[threading.Thread] = None
+        self.segments: List[Segment] = []
+        self.generation = 0
+        self.manifest_mtime = None
+
+        with self._lock:
+            if not os.path.exists(self._manifest_path()) and BM25Index.exists(store_dir):
+                self._migrate_flat_layout()
+        self.refresh()
+
+    @classmethod
+    def exists(cls, store_dir: str) -> bool:
+        return (os.path.exists(os.path.join(store_dir, cls.MANIFEST_FILE))
+                or BM25Index.exists(store_dir))
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.store_dir, self.MANIFEST_FILE)
+
+    def _read_manifest(self) -> Dict:
+        path = self._manifest_path()
+        if not os.path.exists(path):
+            return {"version": self.FORMAT_VERSION, "generation": 0, "segments": [], "retired": []}
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get("version") != self.FORMAT_VERSION:
+            raise ValueError(f"Unsupported index store version: {manifest.get('version')}")
+        return manifest
+
+    # === Read ===
+
+    def is_stale(self) -> bool:
+        """manifest 是否已在上次 refresh 之后变化 (只 stat，不读取)"""
+        path = self._manifest_path()
+        return (os.stat(path).st_mtime_ns if os.path.exists(path) else None) != self.manifest_mtime
+
+    def refresh(self, force: bool = False) -> bool:
+        """manifest 有变化时重新加载段列表，未变化的段直接复用。返回是否发生了重新加载"""
+        path = self._manifest_path()
+        mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+        if not force and mtime is not None and mtime == self.manifest_mtime:
+            return False
+
+        # 读到 manifest 之后、打开段之前，写入端可能已提交了不止一次，清理掉了这一版引用的文件:
+        # 重新读取 manifest 再试
+        for attempt in range(self.REFRESH_RETRIES):
+            manifest = self._read_manifest()
+            try:
+                segments = self._open_segments(manifest)
+                break
+            except FileNotFoundError:
+                if attempt == self.REFRESH_RETRIES - 1:
+                    raise
+                mtime = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+        kept = {id(seg) for seg in segments}
+        for seg in self.segments:
+            if id(seg) not in kept:
+                seg.close()
+
+        self.segments = segments
+        self.generation = manifest["generation"]
+        self.manifest_mtime = mtime
+        self._apply_corpus_stats()
+        return True
+
+    def _open_segments(self, manifest: Dict) -> List[Segment]:
+        """按 manifest 列出段，未变化的段直接复用；出错时关闭本次新打开的段"""
+        current = {seg.name: seg for seg in self.segments}
+        segments, opened = [], []
+        try:
+            for entry in manifest["segments"]:
+                seg = current.get(entry["name"])
+                if seg is None:
+                    seg = Segment(os.path.join(self.store_dir, entry["name"]), entry["name"], entry.get("deletes"))
+                    opened.append(seg)
+                elif seg.deletes != entry.get("deletes"):
+                    seg.load_deletes(entry.get("deletes"))
+                segments.append(seg)
+        except Exception:
+            for seg in opened:
+                seg.close()
+            raise
+        return segments
+
+    def _apply_corpus_stats(self):
+        """按全库存活文档计算 avgdl / idf 并下发给每个段"""
+        n_docs = sum(seg.live_count for seg in self.segments)
+        avgdl = sum(seg.live_len for seg in self.segments) / n_docs if n_docs else 0.0
+
+        if len(self.segments) == 1 and self.segments[0].deleted is None:
+            # 单段且无删除: 段自身的统计即全库统计
+            index = self.segments[0].index
+            index.set_corpus_stats(avgdl, calc_idf(np.diff(index.term_offsets), n_docs, index.epsilon))
+            return
+
+        doc_freqs: Dict[str, int] = {}
+        for seg in self.segments:
+            live_df = seg.live_df
+            for term, tid in seg.index.vocab.items():
+                df = int(live_df[tid])
+                if df:
+                    doc_freqs[term] = doc_freqs.get(term, 0) + df
+        epsilon = self.segments[0].index.epsilon if self.segments else 0.25
+        idf_values = calc_idf(np.fromiter(doc_freqs.values(), dtype=np.int64, count=len(doc_freqs)),
+                              n_docs, epsilon)
+        global_idf = dict(zip(doc_freqs, idf_values.tolist()))
+        for seg in self.segments:
+            idf = np.zeros(len(seg.index.vocab), dtype=np.float64)
+            for term, tid in seg.index.vocab.items():
+                idf[tid] = global_idf.get(term, 0.0)
+            seg.index.set_corpus_stats(avgdl, idf)
+
+    def __len__(self):
+        return sum(seg.live_count for seg in self.segments)
+
+    def top_k(self, query_tokens: Sequence[str], k: int,
+              blacklist_paths: List[str] = None) -> List[Tuple[Segment, int, float]]:
+        """各段分别取 Top K 再归并；同分时按段顺序与 doc_id 排序，与单一索引的顺序一致"""
+        blacklist_paths = blacklist_paths or []
+        hits = []
+        for order, seg in enumerate(self.segments):
+            ids, scores = seg.index.top_k(query_tokens, k, exclude=seg.exclude_mask(blacklist_paths))
+            hits.extend((float(s), order, int(i)) for i, s in zip(ids, scores))
+        hits.sort(key=lambda h: (-h[0], h[1], h[2]))
+        return [(self.segments[order], doc_id, score) for score, order, doc_id in hits[:k]]
+
+    def search(self, query_tokens: Sequence[str], k: int, blacklist_paths: List[str] = None) -> List[Document]:
+        return [seg.doc_store.get(doc_id) for seg, doc_id, _ in self.top_k(query_tokens, k, blacklist_paths)]
+
+    def live_chunks(self) -> Dict[str, Tuple[str, int, str]]:
+        """key -> (段名, doc_id, 内容哈希)，只包含未删除的 chunk"""
+        chunks = {}
+        for seg in self.segments:
+            keys, hashes = seg.chunks()
+            for doc_id, (key, digest) in enumerate(zip(keys, hashes)):
+                if seg.deleted is None or not seg.deleted[doc_id]:
+                    chunks[key] = (seg.name, doc_id, digest)
+        return chunks
+
+    def get_document(self, seg_name: str, doc_id: int) -> Document:
+        return next(seg for seg in self.segments if seg.name == seg_name).doc_store.get(doc_id)
+
+    # === Write ===
+
+    def new_segment(self) -> Tuple[str, str]:
+        """分配一个新段名，返回 (段名, 段目录)；段在 commit 之前对读取端不可见"""
+        name = f"seg_{uuid.uuid4().hex[:12]}"
+        return name, os.path.join(self.store_dir, name)
+
+    def commit(self, new_segments: List[str] = None, deletes: Dict[str, Iterable[int]] = None):
+        """
+        原子地发布一批变更: 追加新段 (已写完的段目录)，并为已有段打删除标记。
+        deletes: 段名 -> 要删除的 doc_id
+        """
+        with self._lock:
+            manifest = self._read_manifest()
+            unknown = set(deletes or {}) - {e["name"] for e in manifest["segments"]}
+            if unknown:
+                raise ValueError(f"Segments no longer exist: {sorted(unknown)}")
+            gen = manifest["generation"] + 1
+            self._apply_deletes(manifest, deletes or {}, gen)
+            manifest["segments"].extend({"name": name, "deletes": None} for name in new_segments or [])
+            manifest["generation"] = gen
+            self._write_manifest(manifest)
+            self.refresh(force=True)
+            self._cleanup(manifest)
+
+    def _apply_deletes(self, manifest: Dict, deletes: Dict[str, Iterable[int]], gen: int):
+        segments = {seg.name: seg for seg in self.segments}
+        for entry in manifest["segments"]:
+            doc_ids = np.fromiter(deletes.get(entry["name"], ()), dtype=np.int64)
+            if not len(doc_ids):
+                continue
+            seg = segments.get(entry["name"])
+            if seg is None or seg.deletes != entry.get("deletes"):
+                seg = Segment(os.path.join(self.store_dir, entry["name"]), entry["name"], entry.get("deletes"))
+            deleted = np.zeros(seg.index.corpus_size, dtype=bool) if seg.deleted is None else seg.deleted.copy()
+            deleted[doc_ids] = True
+            seg.write_deletes(gen, deleted)
+            if entry.get("deletes") is not None:
+                # 被取代的上一代删除标记留到下一次提交再删
+                manifest.setdefault("retired_deletes", []).append(
+                    {"name": entry["name"], "deletes": entry["deletes"], "gen": gen})
+            entry["deletes"] = gen
+            if seg is not segments.get(entry["name"]):
+                seg.close()
+
+    def _write_manifest(self, manifest: Dict):
+        os.makedirs(self.store_dir, exist_ok=True)
+        _write_json_atomic(self._manifest_path(), manifest)
+
+    def _cleanup(self, manifest: Dict):
+        """
+        删除更早的提交退役的段与删除标记。本次提交刚退役的留到下一次提交:
+        刚读到上一版 manifest 的读取端还会打开它们。Windows 下仍被 mmap 占用的文件同样留待下次清理
+        """
+        gen = manifest["generation"]
+        retired = []
+        for item in manifest.get("retired", []):
+            # 旧版 manifest 中只记录段名
+            name, since = (item, None) if isinstance(item, str) else (item["name"], item["gen"])
+            seg_dir = os.path.join(self.store_dir, name)
+            if since != gen:
+                shutil.rmtree(seg_dir, ignore_errors=True)
+            if os.path.exists(seg_dir):
+                retired.append(item)
+
+        retired_deletes = []
+        for item in manifest.get("retired_deletes", []):
+            seg_dir = os.path.join(self.store_dir, item["name"])
+            paths = [os.path.join(seg_dir, f"{prefix}_{item['deletes']}.npy") for prefix in ("deleted", "live_df")]
+            for path in paths if item["gen"] != gen else ():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            if any(os.path.exists(path) for path in paths):
+                retired_deletes.append(item)
+
+        if retired != manifest.get("retired", []) or retired_deletes != manifest.get("retired_deletes", []):
+            manifest["retired"] = retired
+            manifest["retired_deletes"] = retired_deletes
+            self._write_manifest(manifest)
+            self.manifest_mtime = os.stat(self._manifest_path()).st_mtime_ns
+
+        # 提交中途失败留下的、没有被 manifest 引用的删除标记
+        for entry in manifest["segments"]:
+            gens = {entry["deletes"]} | {i["deletes"] for i in retired_deletes if i["name"] == entry["name"]}
+            keep = {f"{prefix}_{g}.npy" for g in gens for prefix in ("deleted", "live_df")}
+            seg_dir = os.path.join(self.store_dir, entry["name"])
+            for fname in os.listdir(seg_dir):
+                if fname.startswith(("deleted_", "live_df_")) and fname not in keep:
+                    try:
+                        os.remove(os.path.join(seg_dir, fname))
+                    except OSError:
+                        pass
+
+    # === Merge ===
+
+    def needs_merge(self) -> bool:
+        if len(self.segments) >= self.MERGE_FACTOR:
+            return True
+        total = sum(seg.index.corpus_size for seg in self.segments)
+        return total > 0 and 1 - len(self) / total > self.MERGE_DELETED_RATIO
+
+    def maybe_merge_async(self) -> Optional[threading.Thread]:
+        """需要时在后台线程合并所有段；已有合并在进行时不重复启动"""
+        if not self.needs_merge() or (self._merge_thread and self._merge_thread.is_alive()):
+            return None
+        self._merge_thread = threading.Thread(target=self.merge, daemon=True)
+        self._merge_thread.start()
+        return self._merge_thread
+
+    def merge(self):
+        """把当前所有段合并成一个段，丢弃已删除的文档"""
+        with self._lock:
+            self.refresh(force=True)
+            sources = list(self.segments)
+            snapshot = {seg.name: (None if seg.deleted is None else seg.deleted.copy()) for seg in sources}
+        if len(sources) < 2 and all(d is None for d in snapshot.values()):
+            return
+
+        name, seg_dir = self.new_segment()
+        writer = SegmentWriter(seg_dir)
+        # 旧段 doc_id -> 新段 doc_id (未搬运的为 -1)
+        id_maps = {}
+        for seg in sources:
+            deleted = snapshot[seg.name]
+            live = np.ones(seg.index.corpus_size, dtype=bool) if deleted is None else ~deleted
+            id_map = np.full(seg.index.corpus_size, -1, dtype=np.int64)
+            id_map[live] = np.arange(len(writer), len(writer) + int(live.sum()))
+            id_maps[seg.name] = id_map
+            writer.add_segment(seg, live)
+        writer.close()
+
+        with self._lock:
+            self.refresh(force=True)
+            merged = {seg.name for seg in sources}
+            # 合并期间新增的删除标记映射到新段上
+            late_deletes = []
+            for seg in self.segments:
+                if seg.name not in merged or seg.deleted is None:
+                    continue
+                before = snapshot[seg.name]
+                newly = seg.deleted if before is None else (seg.deleted & ~before)
+                late_deletes.extend(id_maps[seg.name][newly].tolist())
+
+            manifest = self._read_manifest()
+            gen = manifest["generation"] + 1
+            entries = manifest["segments"]
+            first = next(i for i, e in enumerate(entries) if e["name"] in merged)
+            manifest["segments"] = (entries[:first] + [{"name": name, "deletes": None}]
+                                    + [e for e in entries[first:] if e["name"] not in merged])
+            manifest["retired"] = manifest.get("retired", []) + [{"name": n, "gen": gen} for n in sorted(merged)]
+            if late_deletes:
+                new_seg = Segment(seg_dir, name)
+                deleted = np.zeros(new_seg.index.corpus_size, dtype=bool)
+                deleted[late_deletes] = True
+                new_seg.write_deletes(gen, deleted)
+                new_seg.close()
+                manifest["segments"][first]["deletes"] = gen
+            manifest["generation"] = gen
+            self._write_manifest(manifest)
+            self.refresh(force=True)
+            self._cleanup(manifest)
+
+    def wait_for_merge(self):
+        if self._merge_thread is not None:
+            self._merge_thread.join()
+
+    # === Migration ===
+
+    def _migrate_flat_layout(self):
+        """把旧版单目录索引 (vector_store/index.json) 原地转换为第一个段"""
+        name, seg_dir = self.new_segment()
+        os.makedirs(seg_dir)
+        files = ([BM25Index.VOCAB_FILE] + [f"{a}.npy" for a in BM25Index.ARRAYS]
+                 + [DocStore.DATA_FILE, DocStore.OFFSETS_FILE, DocStore.PATH_IDS_FILE, DocStore.PATHS_FILE])
+        for fname in files:
+            os.replace(os.path.join(self.store_dir, fname), os.path.join(seg_dir, fname))
+        # 段内 index.json 最后移动，中途失败时仍能从旧位置识别出来
+        os.replace(os.path.join(self.store_dir, BM25Index.MANIFEST_FILE),
+                   os.path.join(seg_dir, BM25Index.MANIFEST_FILE))
+
+        store = DocStore(seg_dir)
+        try:
+            docs = (store.get(i) for i in range(len(store)))
+            keys, hashes = chunk_table_from_docs((d.page_content, d.metadata) for d in docs)
+        finally:
+            store.close()
+        write_chunk_table(seg_dir, keys, hashes)
+        self._write_manifest({"version": self.FORMAT_VERSION, "generation": 1,
+                              "segments": [{"name": name, "deletes": None}], "retired": []})
+
+    def close(self):
+        for seg in self.segments:
+            seg.close()
+        self.segments = []
+        self.manifest_mtime = None
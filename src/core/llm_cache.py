@@ -0,0 +1,178 @@
+"""
+模块: LLM Cache
+LLM 回复的持久化缓存 (SQLite)。同一模型、同一提示词模板、渲染结果完全相同的调用直接返回上次的回复，
+重复提问时省去 query / blacklist / evaluate / final 各阶段的延迟与调用费用。
+- key = sha256(模型标识, 模板 id, 渲染后的消息)，模板内容变化后 id 随之变化，旧条目自然失效
+- 超过 TTL 的条目视为未命中；条目数超过上限时按最近访问时间淘汰 (LRU)
+- 命中/未命中次数持久化，按模板分别统计
+"""
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Optional
+
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    template TEXT NOT NULL,
+    value TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at);
+CREATE TABLE IF NOT EXISTS stats (
+    template TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def model_id(llm: BaseLanguageModel) -> str:
+    """模型标识: 类型 + 模型名 + 温度，换模型或温度后不复用旧回复"""
+    name = getattr(llm, "model_name", None) or getattr(llm, "model", None) or ""
+    return f"{type(llm).__name__}:{name}:{getattr(llm, 'temperature', '')}"
+
+
+def template_id(name: str, prompt: ChatPromptTemplate) -> str:
+    """模板 id: 名称 + 模板内容的摘要"""
+    digest = hashlib.sha256(repr(prompt.messages).encode('utf-8')).hexdigest()[:12]
+    return f"{name}:{digest}"
+
+
+class LLMCache:
+    def __init__(self, db_path: str, max_entries: int = 5000, ttl: float = 7 * 86400):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # 查询在 agent_runner 线程中进行，设置页的统计在 UI 线程中读取
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    @staticmethod
+    def make_key(model: str, template: str, messages) -> str:
+        payload = json.dumps([model, template, [(m.type, m.content) for m in messages]], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str, template: str = "") -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                row = None
+            if row:
+                self._conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            column = "hits" if row else "misses"
+            self._conn.execute(f"INSERT INTO stats (template, {column}) VALUES (?, 1) "
+                               f"ON CONFLICT(template) DO UPDATE SET {column} = {column} + 1", (template,))
+        return row[0] if row else None
+
+    def put(self, key: str, value: str, template: str = ""):
+        if not value:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                                   (key, template, value, now, now))
+                self._evict(now)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _evict(self, now: float):
+        self._conn.execute("DELETE FROM entries WHERE created_at < ?", (now - self.ttl,))
+        excess = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._conn.execute("DELETE FROM entries WHERE key IN "
+                               "(SELECT key FROM entries ORDER BY accessed_at LIMIT ?)", (excess,))
+
+    def stats(self) -> Dict[str, Any]:
+        """总条目数、命中率以及按模板的命中/未命中次数"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            rows = self._conn.execute("SELECT template, hits, misses FROM stats").fetchall()
+        per_template = {}
+        for template, hits, misses in rows:
+            name = template.split(":")[0]
+            h, m = per_template.get(name, (0, 0))
+            per_template[name] = (h + hits, m + misses)
+        hits = sum(h for h, _ in per_template.values())
+        misses = sum(m for _, m in per_template.values())
+        return {
+            "entries": entries,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "templates": {k: {"hits": h, "misses": m} for k, (h, m) in per_template.items()},
+        }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM entries")
+            self._conn.execute("DELETE FROM stats")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedChain:
+    """
+    prompt | llm | StrOutputParser 的缓存版本，提供 agent 用到的 invoke / ainvoke / astream。
+    只缓存完整生成的回复: 出错或被取消的调用不写入。
+    """
+
+    def __init__(self, name: str, prompt: ChatPromptTemplate, llm: BaseLanguageModel, cache: LLMCache):
+        self.prompt = prompt
+        self.cache = cache
+        self.chain = prompt | llm | StrOutputParser()
+        self.model = model_id(llm)
+        self.template = template_id(name, prompt)
+
+    def _key(self, inputs: Dict[str, Any]) -> str:
+        return self.cache.make_key(self.model, self.template, self.prompt.format_messages(**inputs))
+
+    def invoke(self, inputs: Dict[str, Any]) -> str:
+        key = self._key(inputs)
+        cached = self.cache.get(key, self.template)
+        if cached is not None:
+            return cached
+        value = self.chain.invoke(inputs)
+        self.cache.put(key, value, self.template)
+        return value
+
+    async def ainvoke(self, inputs: Dict[str, Any]) -> str:
+        key = self._key(inputs)
+        cached = await asyncio.to_thread(self.cache.get, key, self.template)
+        if cached is not None:
+            return cached
+        value = await self.chain.ainvoke(inputs)
+        await asyncio.to_thread(self.cache.put, key, value, self.template)
+        return value
+
+    async def astream(self, inputs: Dict[str, Any]) -> AsyncIterator[str]:
+        """命中时整段作为一个片段返回"""
+        key = self._key(inputs)
+        cached = await asyncio.to_thread(self.cache.get, key, self.template)
+        if cached is not None:
+            yield cached
+            return
+        chunks = []
+        async for chunk in self.chain.astream(inputs):
+            chunks.append(chunk)
+            yield chunk
+        await asyncio.to_thread(self.cache.put, key, "".join(chunks), self.template)
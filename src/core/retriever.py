@@ -1,72 +1,222 @@
 import os
 import pickle
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 import jieba
-import numpy as np
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from langchain_core.documents import Document
-from rank_bm25 import BM25Okapi
+from src.core.bm25_index import BM25Index
+from src.core.doc_store import DocStoreWriter
+from src.core.index_store import IndexStore, chunk_table_from_docs, write_chunk_table
+
+# 旧版索引 (rank_bm25 pickle)，仅在首次加载时迁移
+LEGACY_MODEL_FILE = "bm25_model.pkl"
+LEGACY_DOCS_FILE = "documents.pkl"
+
+_loaded_userdicts = set()
+
+
+def load_user_dict():
+    """加载项目根目录下的自定义词典 (每个进程只需加载一次)"""
+    root_dict = os.path.join("data", "dnd_terms.txt")
+    if os.path.exists(root_dict) and root_dict not in _loaded_userdicts:
+        jieba.load_userdict(root_dict)
+        _loaded_userdicts.add(root_dict)
+
+
+def tokenize(text: str) -> List[str]:
+    """建索引与查询共用的分词"""
+    return jieba.lcut(text)
+
+
+class _ReadWriteLock:
+    """多个读者并发，写者独占；有写者等待时新读者排队，避免写者饿死"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writing or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
 
 class BM25Retriever:
+    """
+    可被多个线程同时检索 (各会话的 agent 共用一个实例)。
+    检索持读锁；切换库 (load_index) 与切换段列表 (refresh 会关闭旧段、改写 idf/norm) 持写锁，
+    等进行中的检索全部结束后才执行。
+    """
+    # 查询结果缓存: 条目数上限，以及每条缓存比 top_k 多取的候选数 (留给黑名单过滤)
+    CACHE_SIZE = 256
+    CACHE_EXTRA = 10
+
     def __init__(self, lib_path: str = None):
-        self.bm25_model: Optional[BM25Okapi] = None
-        self.documents: List[Document] = []
+        self.store: Optional[IndexStore] = None
         self.loaded = False
         self.current_lib_path = lib_path
 
+        # (库路径, 索引版本, 规范化词元) -> (取的深度, [(段, doc_id, 得分)])
+        self._cache: "OrderedDict[Tuple, Tuple[int, list]]" = OrderedDict()
+        self._tokens_cache: "OrderedDict[str, Tuple[str, ...]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._rw = _ReadWriteLock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
         if lib_path:
             self.load_index(lib_path)
 
     def load_index(self, lib_path: str):
-        """热加载指定库的索引"""
+        """热加载指定库的索引 (memmap 打开，不读入正文)"""
+        with self._rw.write():
+            self._load_index(lib_path)
+
+    def _load_index(self, lib_path: str):
         self.current_lib_path = lib_path
+        self._close()
+        self.clear_cache()
         index_dir = os.path.join(lib_path, "vector_store")
-        model_path = os.path.join(index_dir, "bm25_model.pkl")
-        docs_path = os.path.join(index_dir, "documents.pkl")
 
-        if not os.path.exists(model_path):
+        if not IndexStore.exists(index_dir) and os.path.exists(os.path.join(index_dir, LEGACY_MODEL_FILE)):
+            self._migrate_legacy_index(index_dir)
+
+        if not IndexStore.exists(index_dir):
             print(f"Index not found: {index_dir}")
             self.loaded = False
             return
 
-        # 尝试加载项目根目录下的自定义词典
-        root_dict = os.path.join("data", "dnd_terms.txt")
-        if os.path.exists(root_dict):
-            jieba.load_userdict(root_dict)
+        load_user_dict()
 
         try:
-            with open(docs_path, 'rb') as f:
-                self.documents = pickle.load(f)
-
-            with open(model_path, 'rb') as f:
-                self.bm25_model = pickle.load(f)
-
+            self.store = IndexStore(index_dir)
             self.loaded = True
         except Exception as e:
             print(f"Error loading index: {e}")
+            self._close()
             self.loaded = False
 
-    def search(self, query: str, top_k: int = 10, blacklist_paths: List[str] = None) -> List[Document]:
-        if not self.loaded: return []
-        if blacklist_paths is None: blacklist_paths = []
-
-        tokenized_query = jieba.lcut(query)
-        scores = self.bm25_model.get_scores(tokenized_query)
-
-        # 优化策略：取 Top 5N 候选再过滤
-        limit = min(max(top_k * 5, 50), len(self.documents))
-        # argsort 返回从小到大的索引，取最后 limit 个并反转
-        candidate_indices = np.argsort(scores)[-limit:][::-1]
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
 
-        results = []
-        for idx in candidate_indices:
-            if scores[idx] <= 0: break # 无相关性
+    def _close(self):
+        if self.store is not None:
+            self.store.close()
+        self.store = None
 
-            doc = self.documents[idx]
-            path = doc.metadata.get('full_path', '')
-
-            if path in blacklist_paths: continue
+    def _migrate_legacy_index(self, index_dir: str):
+        """将旧版 bm25_model.pkl / documents.pkl 转换为新的磁盘格式"""
+        try:
+            with open(os.path.join(index_dir, LEGACY_DOCS_FILE), 'rb') as f:
+                documents = pickle.load(f)
+            with open(os.path.join(index_dir, LEGACY_MODEL_FILE), 'rb') as f:
+                model = pickle.load(f)
+
+            store = IndexStore(index_dir)
+            name, seg_dir = store.new_segment()
+            writer = DocStoreWriter(seg_dir)
+            for doc in documents:
+                writer.add(doc.page_content, doc.metadata)
+            writer.close()
+            BM25Index.from_bm25okapi(model).save(seg_dir)
+            write_chunk_table(seg_dir, *chunk_table_from_docs((d.page_content, d.metadata) for d in documents))
+            store.commit([name])
+            store.close()
+            print(f"Migrated legacy index: {index_dir}")
+        except Exception as e:
+            print(f"Error migrating legacy index: {e}")
 
-            results.append(doc)
-            if len(results) >= top_k: break
+    def search(self, query: str, top_k: int = 10, blacklist_paths: List[str] = None) -> List[Document]:
+        if blacklist_paths is None: blacklist_paths = []
 
-        return results
\ No newline at end of file
+        # 索引被增量更新或后台合并后切换到新的段列表 (持写锁)，旧代号的缓存随之作废
+        with self._rw.read():
+            store = self.store
+            stale = store is not None and store.is_stale()
+        if stale:
+            with self._rw.write():
+                if self.store is store and store.refresh():
+                    self.clear_cache()
+
+        with self._rw.read():
+            if not self.loaded or self.store is None:
+                return []
+            hits = self._cached_top_k(self.store, query, top_k, blacklist_paths)
+            # 只解码命中的文档 (在读锁内，段不会被关闭)
+            return [seg.doc_store.get(doc_id) for seg, doc_id, _ in hits]
+
+    def _normalize(self, query: str) -> Tuple[str, ...]:
+        """查询词 -> 排序后的词元元组 (BM25 得分与词序无关)，分词结果按原始查询词缓存"""
+        with self._cache_lock:
+            tokens = self._tokens_cache.get(query)
+            if tokens is not None:
+                self._tokens_cache.move_to_end(query)
+                return tokens
+        tokens = tuple(sorted(tokenize(query)))
+        with self._cache_lock:
+            self._tokens_cache[query] = tokens
+            if len(self._tokens_cache) > self.CACHE_SIZE:
+                self._tokens_cache.popitem(last=False)
+        return tokens
+
+    def _cached_top_k(self, store: IndexStore, query: str, top_k: int, blacklist_paths: List[str]):
+        """
+        缓存不带黑名单的前 top_k + CACHE_EXTRA 条，取出后再过滤黑名单。
+        过滤后不足 top_k 条且缓存被截断时，退回带黑名单的检索 (先屏蔽再选 Top K)。
+        """
+        tokens = self._normalize(query)
+        # 重建索引后代号会从头计数，连同 manifest 的修改时间一起作为版本
+        key = (self.current_lib_path, (store.generation, store.manifest_mtime), tokens)
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] >= top_k:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+            else:
+                entry = None
+                self.cache_misses += 1
+
+        if entry is None:
+            depth = top_k + self.CACHE_EXTRA
+            entry = (depth, store.top_k(tokens, depth))
+            with self._cache_lock:
+                self._cache[key] = entry
+                if len(self._cache) > self.CACHE_SIZE:
+                    self._cache.popitem(last=False)
+
+        depth, hits = entry
+        if blacklist_paths:
+            blocked = set(blacklist_paths)
+            hits = [h for h in hits if h[0].doc_store.path_of(h[1]) not in blocked]
+            if len(hits) < top_k and len(entry[1]) >= depth:
+                return store.top_k(tokens, top_k, blacklist_paths)
+        return hits[:top_k]
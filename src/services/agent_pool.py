@@ -0,0 +1,57 @@
+"""
+模块: Agent Pool
+按会话分配 DndAgentExecutor，会话之间的对话历史与文档池互不影响。
+最近使用的若干个执行器常驻 (LRU)，被淘汰或重启后再次使用时从 SessionManager 的记录中恢复对话历史。
+"""
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+from src.core.agent import DndAgentExecutor
+from src.services.session_manager import SessionManager
+
+
+class AgentPool:
+    # 恢复历史时读取的最近消息数 (之后再按 token 预算裁剪)
+    HYDRATE_MESSAGES = 40
+
+    def __init__(self, session_manager: SessionManager, factory: Callable[[], DndAgentExecutor], max_size: int = 8):
+        self.sm = session_manager
+        self.factory = factory
+        self.max_size = max_size
+        self._agents: "OrderedDict[str, DndAgentExecutor]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> DndAgentExecutor:
+        """取会话对应的执行器，不存在时新建并恢复历史"""
+        with self._lock:
+            agent = self._agents.get(session_id)
+            if agent is not None:
+                self._agents.move_to_end(session_id)
+                return agent
+
+        agent = self.factory()
+        messages, _ = self.sm.load_messages(session_id, self.HYDRATE_MESSAGES)
+        agent.load_history(self.history_turns(messages))
+
+        with self._lock:
+            # 并发创建时以先放入的为准
+            agent = self._agents.setdefault(session_id, agent)
+            self._agents.move_to_end(session_id)
+            while len(self._agents) > self.max_size:
+                self._agents.popitem(last=False)
+        return agent
+
+    @staticmethod
+    def history_turns(messages: List[Dict]) -> List[Tuple[str, str]]:
+        """会话消息 -> (用户问题, 回答) 列表；没有回答的问题 (如被停止) 不计入"""
+        turns = []
+        for prev, msg in zip(messages, messages[1:]):
+            if prev["role"] == "user" and msg["role"] == "ai":
+                turns.append((prev["content"], msg["content"]))
+        return turns
+
+    def clear(self):
+        """丢弃全部执行器，下次使用时按当前配置重建 (设置页保存配置后调用)"""
+        with self._lock:
+            self._agents.clear()
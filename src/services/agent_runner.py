@@ -0,0 +1,101 @@
+"""
+模块: Agent Runner
+在独立线程的事件循环上执行 agent 问答，UI 事件循环只负责接收事件并刷新控件。
+- 同时进行的问答数有上限，超出的排队等待
+- 同一个 DndAgentExecutor 上的问答串行执行 (其对话历史与文档池不是并发安全的)，不同执行器之间并行
+- 每个问答按 key (会话 id) 登记，可随时取消
+"""
+import asyncio
+import logging
+import threading
+import weakref
+from concurrent.futures import Future
+from typing import AsyncIterator, Dict
+
+from src.core.agent import AgentEvent, DndAgentExecutor
+
+logger = logging.getLogger(__name__)
+
+# 事件流结束标记
+_DONE = object()
+
+
+class AgentRunner:
+    def __init__(self, max_concurrent: int = 4):
+        self.max_concurrent = max_concurrent
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="agent-runner", daemon=True)
+        self._thread.start()
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        # 执行器 -> 锁，只在 runner 线程中访问
+        self._agent_locks = weakref.WeakKeyDictionary()
+        self._running: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def is_running(self, key: str) -> bool:
+        with self._lock:
+            return key in self._running
+
+    def cancel(self, key: str) -> bool:
+        """取消 key 对应的问答 (排队中或执行中)，返回是否有可取消的任务"""
+        with self._lock:
+            future = self._running.get(key)
+        return future is not None and future.cancel()
+
+    async def stream(self, key: str, agent: DndAgentExecutor, user_input: str) -> AsyncIterator[AgentEvent]:
+        """
+        在调用方的事件循环中迭代 agent.astream_events 的事件，实际执行在 runner 线程。
+        被取消时抛出 asyncio.CancelledError。
+        """
+        caller_loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+
+        def emit(item):
+            caller_loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        with self._lock:
+            if key in self._running:
+                raise RuntimeError("该会话已有正在进行的问答")
+            future = asyncio.run_coroutine_threadsafe(self._run(agent, user_input, emit), self._loop)
+            self._running[key] = future
+        future.add_done_callback(lambda f: self._finish(key, f, emit))
+
+        try:
+            while True:
+                item = await queue.get()
+                if item is _DONE:
+                    break
+                yield item
+            # 传播异常或取消
+            await asyncio.wrap_future(future)
+        finally:
+            # 调用方提前结束迭代 (如界面销毁) 时一并取消
+            future.cancel()
+
+    def _finish(self, key: str, future: Future, emit):
+        with self._lock:
+            if self._running.get(key) is future:
+                del self._running[key]
+        emit(_DONE)
+
+    async def _run(self, agent: DndAgentExecutor, user_input: str, emit):
+        lock = self._agent_locks.setdefault(agent, asyncio.Lock())
+        async with self._semaphore, lock:
+            async for event in agent.astream_events(user_input):
+                emit(event)
+
+    def shutdown(self):
+        """取消 runner 线程上的全部任务并等待其收尾，再停止事件循环"""
+        async def cancel_all():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(cancel_all(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+
+
+# 全局单例
+agent_runner = AgentRunner()
@@ -1,28 +1,352 @@
+import codecs
 import os
-import json
 import shutil
 import subprocess
 import logging
+import multiprocessing
+import posixpath
 import re
+import tempfile
+import time
+from collections import OrderedDict, deque
+from collections.abc import ItemsView, MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+from html import unescape
+from html.parser import HTMLParser
+from urllib.parse import unquote
 from bs4 import BeautifulSoup
 import html2text
 
+try:
+    import chardet
+except ImportError:
+    chardet = None
+
+from src.services.chm_reader import CHMError, CHMFile, DirectorySource, open_source
+from src.services.chunker import MarkdownChunker
+from src.services.rules_data import RulesWriter
+
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-class CHMProcessor:
+# 打包热路径上用到的正则，模块加载时编译一次
+# (<tag\b[^>]*>.*?</tag>)，re.DOTALL 确保 . 匹配换行符，re.IGNORECASE 忽略大小写
+_SPLIT_PATTERNS = {f"h{i}": re.compile(f"(<h{i}\\b[^>]*>.*?</h{i}>)", re.DOTALL | re.IGNORECASE)
+                   for i in range(1, 7)}
+_TAGS = re.compile(r'<[^>]*>')
+# Markdown 标题行中的链接/图片、反斜杠转义与强调标记，空白
+_MD_LINK = re.compile(r'!?\[([^\]]*)\]\([^)]*\)')
+_MD_MARKUP = re.compile(r'\\(?=[!-/:-@\[-`{-~])|[*_`]')
+_SPACES = re.compile(r'\s+')
+# 整个 <head>；缺少 </head> 时只匹配其后连续的 title/style/script/meta 等头部元素
+_HEAD = re.compile(r'<head\b[^>]*>(?:.*?</head\s*>|(?:\s+|<(title|style|script)\b.*?</\1\s*>'
+                   r'|<(?:meta|link|base)\b[^>]*>|<!--.*?-->)*)', re.DOTALL | re.IGNORECASE)
+
+
+class HeadingCounter(HTMLParser):
+    """
+    单次流式解析统计 h1..h6 起始标签数量，无需构建 DOM。
+    只在 handle_starttag 中计数，注释、<script>/<style> 内容与 CDATA 中的标签不计入。
+    """
+
     def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.counts = [0] * 6
+
+    def handle_starttag(self, tag, attrs):
+        if len(tag) == 2 and tag[0] == "h" and tag[1] in "123456":
+            self.counts[int(tag[1]) - 1] += 1
+
+    @classmethod
+    def count(cls, html):
+        parser = cls()
+        parser.feed(html)
+        parser.close()
+        return parser.counts
+
+
+def strip_tags(html):
+    """轻量提取纯文本: 去掉标签、解码实体，各段文本以空格连接 (同 get_text(" ", strip=True))"""
+    return " ".join(t for t in (unescape(part).strip() for part in _TAGS.split(html)) if t)
+
+
+def heading_text(text):
+    """
+    标题比较用的规范化文本: 去掉 Markdown 链接/图片语法、转义与强调标记，合并空白并忽略大小写。
+    strip_tags 得到的子标题与 html2text 输出中的标题行都经此处理后再比较。
+    """
+    text = _MD_LINK.sub(r'\1', text)
+    text = _MD_MARKUP.sub('', text)
+    return _SPACES.sub(' ', text).strip().casefold()
+
+
+class MarkdownConverter:
+    """
+    进程内复用的 html2text 转换器 (配置同 package_json.py)。
+    只构建、配置一次；每次转换前把解析状态恢复到配置完成时的快照，
+    上一个文档未闭合的标签不会影响下一个。
+    """
+
+    OPTIONS = {
+        "ignore_links": False,
+        "ignore_images": False,
+        "ignore_tables": False,  # 必须保留表格
+        "body_width": 0,  # 不强制折行
+        "protect_links": True,
+        "unicode_snob": True,
+    }
+
+    def __init__(self):
+        self._h = html2text.HTML2Text()
+        for name, value in self.OPTIONS.items():
+            setattr(self._h, name, value)
+        self._state = dict(vars(self._h))
+
+    def convert(self, html_content):
+        h = self._h
+        h.__dict__.clear()
+        h.__dict__.update({k: v.copy() if isinstance(v, (list, dict)) else v for k, v in self._state.items()})
+        # 缺少 </head> 的页面会让 html2text 把整页都当作 head 忽略，先去掉 head
+        return h.handle(_HEAD.sub("", html_content, count=1))
+
+
+_converter = None
+
+
+def _markdown_converter():
+    global _converter
+    if _converter is None:
+        _converter = MarkdownConverter()
+    return _converter
+
+
+class HHCWalker(HTMLParser):
+    """
+    流式解析 HHC 目录: 跟踪 <ul> 嵌套层级与 sitemap <object> 的参数，
+    每个节点解析完即产出 (面包屑路径列表, Local)，不构建 DOM。
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.nodes = deque()
+        # 各层级当前节点的名称，即面包屑
+        self._trail = []
+        self._depth = 0
+        self._params = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "ul":
+            self._depth += 1
+        elif tag == "object":
+            attrs = dict(attrs)
+            self._params = {} if (attrs.get("type") or "").lower() == "text/sitemap" else None
+        elif tag == "param" and self._params is not None:
+            attrs = dict(attrs)
+            name = (attrs.get("name") or "").lower()
+            # 合并条目可能带多组 Name/Local，以第一组为准
+            if name in ("name", "local") and attrs.get("value"):
+                self._params.setdefault(name, attrs["value"].strip())
+
+    def handle_endtag(self, tag):
+        if tag == "ul":
+            self._depth = max(0, self._depth - 1)
+        elif tag == "object" and self._params is not None:
+            params, self._params = self._params, None
+            name = params.get("name")
+            if not name:
+                return
+            level = max(self._depth, 1)
+            del self._trail[level - 1:]
+            self._trail.extend([""] * (level - 1 - len(self._trail)))
+            self._trail.append(name)
+            if params.get("local"):
+                self.nodes.append(([n for n in self._trail if n], params["local"]))
+
+    @classmethod
+    def walk(cls, content, read_size=64 * 1024):
+        """分段喂给解析器，边解析边产出节点"""
+        parser = cls()
+        for i in range(0, len(content), read_size):
+            parser.feed(content[i:i + read_size])
+            while parser.nodes:
+                yield parser.nodes.popleft()
+        parser.close()
+        while parser.nodes:
+            yield parser.nodes.popleft()
+
+
+class _RuleItems(ItemsView):
+    """items() 沿 HHC 流式产出，不逐个按键回查"""
+
+    def __iter__(self):
+        yield from self._mapping.iter_rules()
+
+
+class TreeProcessingRules(MutableMapping):
+    """
+    config["tree_processing_rules"]: 目录节点名 -> {"path", "anchor", "action", "split_by"}。
+    节点在遍历时才由 HHCWalker 流式产出，不常驻内存；split_by 在读取规则时按节点所在页面分析。
+    键为面包屑标题，重名节点依次加 " (2)"、" (3)" 后缀。
+    修改规则需写回 (rules[name] = rule)，只保存与默认值不同的 action / split_by；
+    删除的节点不再打包。
+    """
+
+    def __init__(self, processor, hhc_path):
+        self._processor = processor
+        self._hhc_path = hhc_path
+        # 节点名 -> 覆盖的字段，None 表示已删除
+        self._overrides = {}
+
+    def nodes(self):
+        """产出 (节点名, 面包屑标题, 页面路径, 锚点, 覆盖的字段)，不分析 split_by"""
+        counts = {}
+        for title, path, anchor in self._processor.iter_nodes(self._hhc_path):
+            counts[title] = counts.get(title, 0) + 1
+            name = title if counts[title] == 1 else f"{title} ({counts[title]})"
+            override = self._overrides.get(name, {})
+            if override is not None:
+                yield name, title, path, anchor, override
+
+    def iter_rules(self):
+        for name, _, path, anchor, override in self.nodes():
+            yield name, self._rule(path, anchor, override)
+
+    def _rule(self, path, anchor, override):
+        rule = {"path": path, "anchor": anchor, "action": "process"}
+        rule.update(override)
+        if "split_by" not in rule:
+            rule["split_by"] = self._processor._analyze_split_strategy_strict(self._processor._read_file_safe(path))
+        return rule
+
+    def __getitem__(self, name):
+        for node_name, _, path, anchor, override in self.nodes():
+            if node_name == name:
+                return self._rule(path, anchor, override)
+        raise KeyError(name)
+
+    def __setitem__(self, name, rule):
+        if name not in self:
+            raise KeyError(name)
+        override = {}
+        if rule.get("action", "process") != "process":
+            override["action"] = rule["action"]
+        if "split_by" in rule:
+            override["split_by"] = rule["split_by"]
+        self._overrides[name] = override
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._overrides[name] = None
+
+    def __contains__(self, name):
+        return any(node[0] == name for node in self.nodes())
+
+    def __iter__(self):
+        return (node[0] for node in self.nodes())
+
+    def __len__(self):
+        return sum(1 for _ in self.nodes())
+
+    def items(self):
+        return _RuleItems(self)
+
+
+# 打包子进程内打开的页面读取源，整个进程生命周期内复用，解压过的帧缓存不随批次丢弃
+_worker_source = None
+
+
+def _init_package_worker(source_spec):
+    global _worker_source
+    _worker_source = open_source(source_spec)
+
+
+def _package_batch(source_spec, batch, encoding=None, source=None):
+    """
+    进程池任务: 打包一批页面，返回 (条目列表, 统计)。
+    子进程内新建处理器，复用进程初始化时打开的 CHM；串行处理时 source 直接传入当前的读取源。
+    encoding 为本次导入检测出的编码；batch 中每项为 iter_pages 产出的 (页面路径, 节点列表)。
+    """
+    start = time.time()
+    processor = CHMProcessor()
+    processor._source_spec = source_spec
+    processor._source = source or _worker_source
+    processor.detected_encoding = encoding
+    entries = []
+    nodes = nbytes = 0
+    for relative_path, page_nodes in batch:
+        entries.extend(processor._process_page(relative_path, page_nodes))
+        nodes += len(page_nodes)
+        if processor.source.exists(relative_path):
+            nbytes += processor.source.size(relative_path)
+    return entries, {"pid": os.getpid(), "pages": len(batch), "rules": nodes, "bytes": nbytes,
+                     "elapsed": time.time() - start}
+
+
+def _decodes(data: bytes, encoding: str) -> bool:
+    """严格解码是否成功；抽样在末尾截断，允许最后一个多字节字符不完整"""
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(data, final=False)
+        return True
+    except (UnicodeDecodeError, LookupError):
+        return False
+
+
+def _is_single_byte(encoding: str) -> bool:
+    """单字节编码把每个高位字节各解码为一个字符 (或替换符)，多字节编码会把字节成对组合"""
+    try:
+        return len(bytes(range(0x81, 0xff)).decode(encoding, errors='replace')) == 0xff - 0x81
+    except LookupError:
+        return False
+
+
+class CHMProcessor:
+    # 编码检测的抽样规模
+    ENCODING_SAMPLE_FILES = 8
+    ENCODING_SAMPLE_BYTES = 32 * 1024
+    ENCODING_ALIASES = {"gb2312": "gb18030", "gbk": "gb18030", "ascii": "utf-8-sig", "utf-8": "utf-8-sig"}
+    # chardet 结果的最低置信度: UTF-8 与 GB18030 都解码失败时兜底用 / 在能严格解码的多字节编码之间裁决用
+    ENCODING_MIN_CONFIDENCE = 0.5
+    ENCODING_TIEBREAK_CONFIDENCE = 0.2
+    # 面包屑标题 (条目的 full_path) 各层级之间的分隔符
+    BREADCRUMB_SEPARATOR = " > "
+    # 检索 chunk 的长度上下限 (字符) 与相邻 chunk 的重叠长度
+    CHUNK_MAX_CHARS = 1500
+    CHUNK_MIN_CHARS = 200
+    CHUNK_OVERLAP = 0
+    # 已解码页面的缓存上限 (页数)，只需覆盖同一页面的连续几次读取
+    DECODED_CACHE = 8
+
+    def __init__(self, work_dir=None):
         self.base_dir = os.getcwd()
-        self.temp_dir = os.path.join(self.base_dir, "temp_chm")
+        # 本处理器独占的工作目录 (7za 兜底解包用)，多个导入互不干扰；
+        # 为空时在 temp_chm/ 下按需创建，cleanup 时删除
+        self.work_dir = work_dir
+        self._owns_work_dir = False
         self.output_dir = os.path.join(self.base_dir, "data")
         self.seven_zip_path = self._get_7zip_path()
         self.config = None
-        self.chm_source_dir = None
+        # 页面读取源: 原生 CHMFile，解析失败时退回 7za 解包后的目录
+        self._source = None
+        self._source_spec = None
+        # 最近一次 generate_library 的耗时统计
+        self.last_stats = None
+        # 最近解码的页面 (路径 -> 内容)，同一页面的多个目录节点与分割分析共用，LRU 淘汰
+        self._decoded: "OrderedDict[str, str]" = OrderedDict()
+        # 本次导入的主编码: 优先用它解码，失败才逐个尝试其他编码
+        self.detected_encoding = None
         # 严格对应 analyze_chm.py 的阈值
         self.SPLIT_HEURISTIC_THRESHOLD = 9
+        self.chunker = MarkdownChunker(self.CHUNK_MAX_CHARS, self.CHUNK_MIN_CHARS, self.CHUNK_OVERLAP)
+
+    @property
+    def source(self):
+        if self._source is None and self._source_spec is not None:
+            self._source = open_source(self._source_spec)
+        return self._source
 
     def _get_7zip_path(self):
         """获取 7zip 路径，优先使用 bin 目录"""
@@ -32,27 +356,58 @@ class CHMProcessor:
         # Fallback 到系统命令
         return "7za"
 
-    def process_chm(self, file_path):
+    def process_chm(self, file_path, encoding=None):
         """
-        阶段 1: 解包与分析 (对应 analyze_chm.py)
+        阶段 1: 读取目录与分析 (对应 analyze_chm.py)
+        encoding: 已知的编码 (重新导入时取自库元数据)，为空时抽样检测
         """
-        # === 新增：强制转为绝对路径，防止 7zip 找不到文件报 Code 2 ===
         file_path = os.path.abspath(file_path)
-        # 1. 清理环境
-        if os.path.exists(self.temp_dir):
-            shutil.rmtree(self.temp_dir)
-        os.makedirs(self.temp_dir)
+        self._decoded.clear()
+        self.detected_encoding = None
+        if self._source is not None:
+            self._source.close()
+        self._source = None
+
+        # 1. 直接读取 CHM 目录，页面在用到时才解压到内存
+        logger.info(f"正在读取 {file_path}...")
+        try:
+            self._source = CHMFile(file_path)
+            self._source_spec = ("chm", file_path)
+        except CHMError as e:
+            logger.warning(f"CHM 解析失败 ({e})，改用 7zip 解包")
+            self._source = DirectorySource(self._extract_with_7zip(file_path))
+            self._source_spec = ("dir", self._source.path)
+
+        # 2. 查找 HHC 索引文件
+        hhc_file = next((name for name in self.source.list() if name.lower().endswith('.hhc')), None)
+        if not hhc_file:
+            raise Exception("未找到 .hhc 索引文件，无法分析结构。")
+
+        self.detected_encoding = self._detect_encoding(encoding)
+        logger.info(f"页面编码: {self.detected_encoding or '未知'}{' (沿用)' if self.detected_encoding == encoding else ' (检测)'}")
+
+        # 3. 生成配置树
+        self.config = self._generate_config_logic(hhc_file)
+        return self.config
 
-        self.chm_source_dir = os.path.join(self.temp_dir, "source")
+    def _extract_with_7zip(self, file_path):
+        """兜底: 用 7zip 解包到工作目录下的 source/，返回解包目录"""
+        # 1. 准备工作目录，只清理本处理器上一次的解包结果
+        if self.work_dir is None:
+            temp_root = os.path.join(self.base_dir, "temp_chm")
+            os.makedirs(temp_root, exist_ok=True)
+            self.work_dir = tempfile.mkdtemp(prefix="chm_", dir=temp_root)
+            self._owns_work_dir = True
+        source_dir = os.path.join(self.work_dir, "source")
+        if os.path.exists(source_dir):
+            shutil.rmtree(source_dir)
+        os.makedirs(source_dir)
 
-        # 2. 解包
-        logger.info(f"正在解包 {file_path}...")
         try:
-            # === 修改开始 ===
             # 1. 移除 check=True，改为捕获返回值 result
             # 2. 增加 "-y" 参数，强制覆盖不询问，防止后台挂起
             result = subprocess.run(
-                [self.seven_zip_path, "x", file_path, f"-o{self.chm_source_dir}", "-y"],
+                [self.seven_zip_path, "x", file_path, f"-o{source_dir}", "-y"],
                 check=False,  # 关键修改：允许返回非0代码
                 stdout=subprocess.DEVNULL,
                 stderr=subprocess.PIPE
@@ -63,127 +418,144 @@ class CHMProcessor:
             if result.returncode > 1:
                 err_msg = result.stderr.decode('gbk', errors='ignore') if result.stderr else "Unknown error"
                 raise Exception(f"7zip解包错误 (Code {result.returncode}): {err_msg}")
-            # === 修改结束 ===
 
         except Exception as e:
-            # 这里如果之前有 subprocess.CalledProcessError 的捕获逻辑，现在可以去掉了，
-            # 因为上面手动处理了错误，直接捕获 Exception 即可
             raise Exception(f"7zip解包失败: {str(e)}")
+        return source_dir
+
+    def cleanup(self):
+        """关闭页面读取源并删除 7za 解包结果"""
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+        if self.work_dir is None:
+            return
+        if self._owns_work_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            self.work_dir, self._owns_work_dir = None, False
+        else:
+            shutil.rmtree(os.path.join(self.work_dir, "source"), ignore_errors=True)
 
-        # 3. 查找 HHC 索引文件
-        hhc_file = None
-        for root, _, files in os.walk(self.chm_source_dir):
-            for f in files:
-                if f.lower().endswith('.hhc'):
-                    hhc_file = os.path.join(root, f)
-                    break
-            if hhc_file: break
-
-        if not hhc_file:
-            raise Exception("未找到 .hhc 索引文件，无法分析结构。")
-
-        # 4. 生成配置树
-        self.config = self._generate_config_logic(hhc_file)
-        return self.config
+    def _detect_encoding(self, known=None):
+        """
+        抽样最大的几个页面，确定整个 CHM 的编码。known 为上次导入记录的编码。
+        先严格试解 UTF-8、GB18030，chardet 只用于在其中裁决 (如 Big5 也能被 GB18030 解码)
+        或两者都失败时兜底。单字节编码永远不会解码失败，只在 UTF-8 与 GB18030 都失败时才采用。
+        """
+        pages = [(self.source.size(name), name) for name in self.source.list()
+                 if name.lower().endswith(('.htm', '.html', '.hhc'))]
+        # 大文件的非 ASCII 文本更多，检测更可靠
+        sample = [self.source.read(name)[:self.ENCODING_SAMPLE_BYTES]
+                  for _, name in sorted(pages, reverse=True)[:self.ENCODING_SAMPLE_FILES]]
+        if not sample:
+            return known
+
+        strict = {enc: all(_decodes(data, enc) for data in sample) for enc in ("utf-8", "gb18030")}
+        if strict["utf-8"]:
+            return "utf-8-sig"
+        if known and all(_decodes(data, known) for data in sample) \
+                and (not _is_single_byte(known) or not strict["gb18030"]):
+            return known
+
+        guess, confidence = None, 0.0
+        if chardet is not None:
+            result = chardet.detect(b"\n".join(sample))
+            name = (result.get("encoding") or "").lower()
+            try:
+                name = codecs.lookup(self.ENCODING_ALIASES.get(name, name)).name if name else None
+            except LookupError:
+                name = None
+            if name and all(_decodes(data, name) for data in sample):
+                guess, confidence = name, result.get("confidence") or 0.0
+
+        if strict["gb18030"]:
+            # 同样能严格解码的多字节编码 (如 Big5) 由 chardet 裁决，其余一律 GB18030
+            if guess and not _is_single_byte(guess) and confidence >= self.ENCODING_TIEBREAK_CONFIDENCE:
+                return guess
+            return "gb18030"
+        return guess if confidence >= self.ENCODING_MIN_CONFIDENCE else None
 
     def _generate_config_logic(self, hhc_path):
         """
         核心分析逻辑：解析 HHC -> 应用启发式算法 -> 生成 Config
+        tree_processing_rules 覆盖整棵 HHC 树，节点与 split_by 在遍历时才产出 (见 TreeProcessingRules)。
         """
         content = self._read_file_safe(hhc_path)
         if not content:
             raise Exception("无法读取 HHC 文件内容")
 
-        soup = BeautifulSoup(content, 'html.parser')
-
-        # 解析 HHC 获取待处理的文件列表
-        items = self._parse_hhc_items(soup)
-
-        tree_rules = {}
-        for item in items:
-            name = item['name']
-            rel_path = item['path']
-
-            # === 核心算法：启发式判断 Split 策略 (analyze_chm.py) ===
-            split_by = self._analyze_split_strategy_strict(rel_path)
-
-            tree_rules[name] = {
-                "path": rel_path,
-                "action": "process",  # 默认选中
-                "split_by": split_by
-            }
-
         return {
             "common_config": {
                 "base_url": "chm://",
-                "selector": "body"
+                "selector": "body",
+                "hhc_file": hhc_path,
             },
-            "tree_processing_rules": tree_rules
+            "tree_processing_rules": TreeProcessingRules(self, hhc_path),
         }
 
-    def _parse_hhc_items(self, soup):
+    def _normalize_local(self, local, hhc_path):
         """
-        解析 HHC 结构。
-        为了 UI 展示简洁，目前只提取第一层级的有效 HTML 节点。
+        HHC 中的 Local -> (CHM 内相对路径, 锚点)，外部链接返回 None。
+        兼容 mk:@MSITStore:X.chm::/a.htm、%20 转义、相对 .hhc 所在目录的路径与 #anchor。
         """
-        items = []
-
-        # 尝试找到根 UL
-        root_ul = soup.find('ul')
-        target_container = root_ul if root_ul else soup
-
-        # 仅遍历直接子节点以获取“根目录”概念
-        for li in target_container.find_all('li', recursive=False):
-            obj = li.find('object', type="text/sitemap")
-            if not obj: continue
-
-            name_param = obj.find('param', {'name': 'Name'})
-            local_param = obj.find('param', {'name': 'Local'})
-
-            if name_param and local_param:
-                path = local_param['value'].replace('\\', '/').lstrip('/')
-                # 忽略非 HTML 资源
-                if not path.lower().endswith(('.htm', '.html')):
-                    continue
+        local = local.replace('\\', '/')
+        if '::' in local:
+            local = '/' + local.split('::', 1)[1].lstrip('/')
+        path, _, anchor = local.partition('#')
+        path = unquote(path)
+        if re.match(r'^[a-z][a-z0-9+.-]*:', path, re.IGNORECASE):
+            return None
+        if not path.startswith('/'):
+            path = posixpath.join(posixpath.dirname(hhc_path), path)
+        path = posixpath.normpath(path.lstrip('/'))
+        # 越过根目录的 ../ 按根目录处理
+        while path.startswith('../'):
+            path = path[3:]
+        if not path.lower().endswith(('.htm', '.html')):
+            return None
+        return path, unquote(anchor)
 
-                items.append({
-                    'name': name_param['value'],
-                    'path': path
-                })
+    def iter_nodes(self, hhc_path=None):
+        """
+        流式遍历整棵 HHC 树，产出 (面包屑标题, 页面路径, 锚点)。
+        嵌套 <ul> 的各级名称拼成面包屑，同一 (路径, 锚点) 只保留第一次出现。
+        """
+        hhc_path = hhc_path or self.config["common_config"]["hhc_file"]
+        content = self._read_file_safe(hhc_path)
+        seen = set()
+        for trail, local in HHCWalker.walk(content or ""):
+            target = self._normalize_local(local, hhc_path)
+            if target is None or target in seen:
+                continue
+            seen.add(target)
+            yield self.BREADCRUMB_SEPARATOR.join(trail), target[0], target[1]
 
-        # 如果 HHC 结构太乱找不到 recursive=False 的，回退到搜索所有 (Fallback)
-        if not items:
-            seen_paths = set()
-            for obj in soup.find_all('object', type="text/sitemap"):
-                name_param = obj.find('param', {'name': 'Name'})
-                local_param = obj.find('param', {'name': 'Local'})
-                if name_param and local_param:
-                    path = local_param['value'].replace('\\', '/').lstrip('/')
-                    if path in seen_paths or not path.lower().endswith(('.htm', '.html')):
-                        continue
-                    seen_paths.add(path)
-                    items.append({'name': name_param['value'], 'path': path})
-            # 限制数量防止 UI 卡死
-            items = items[:100]
-
-        return items
-
-    def _analyze_split_strategy_strict(self, relative_path):
+    def iter_pages(self):
+        """
+        按 config 的 tree_processing_rules，把连续指向同一页面的目录节点合并为一个打包任务:
+        (页面路径, [(面包屑标题, 锚点, 覆盖的 action/split_by), ...])。
+        不打包的节点也保留，用于确定同页其他节点的切片边界。
+        只缓存当前页面的节点，内存占用与目录规模无关。
+        """
+        path, nodes = None, []
+        for _, title, node_path, anchor, override in self.config["tree_processing_rules"].nodes():
+            if node_path != path and nodes:
+                yield path, nodes
+                nodes = []
+            path = node_path
+            nodes.append((title, anchor, override))
+        if nodes:
+            yield path, nodes
+
+    def _analyze_split_strategy_strict(self, content):
         """
         [严格复刻] analyze_chm.py 的启发式算法
         优先级: H1 -> H2 -> H3 -> H4
         """
-        full_path = os.path.join(self.chm_source_dir, relative_path)
-        if not os.path.exists(full_path):
-            return None
-
-        content = self._read_file_safe(full_path)
         if not content: return None
 
-        soup = BeautifulSoup(content, 'html.parser')
-
-        # 统计标签数量
-        h_counts = [len(soup.find_all(f'h{i}')) for i in range(1, 7)]
+        # 统计标签数量 (单次扫描)
+        h_counts = HeadingCounter.count(content)
 
         # 严格的优先级判断 (analyze_chm.py 逻辑)
         if h_counts[0] > self.SPLIT_HEURISTIC_THRESHOLD:  # H1
@@ -197,44 +569,153 @@ class CHMProcessor:
         else:
             return None
 
-    def generate_library(self):
+    def generate_library(self, output_dir=None, workers=None, batch_size=8, compression=None,
+                         progress_callback=None):
         """
         阶段 2: 打包 (对应 package_json.py)
+        output_dir: 输出目录，默认 data/ (导入规则库时传入库目录)
+        workers: 并行进程数，默认 CPU 核数 - 1；为 1 时在当前进程内串行处理
+        batch_size: 每个任务包含的页面数，减少进程间调度开销
+        compression: None / "gzip" / "zstd"，条目边生成边写入 rules_data.jsonl
+        progress_callback(已处理页面数, 页面总数, 已生成条目数, 已处理字节数)，每批结果写出后调用
         """
         if not self.config:
             raise Exception("配置未就绪，请先运行分析")
 
-        output_json_path = os.path.join(self.output_dir, "rules_data.json")
-        os.makedirs(self.output_dir, exist_ok=True)
+        output_dir = output_dir or self.output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        # 只为进度统计预先数一遍目录，不保留节点
+        pages_total = sum(1 for _ in self.iter_pages())
+
+        start = time.time()
+        per_worker = {}
+        pages_done = nodes_done = bytes_done = 0
+        with RulesWriter(output_dir, compression) as writer:
+            if workers == 1 or pages_total <= batch_size:
+                results = (_package_batch(self._source_spec, batch, self.detected_encoding, self.source)
+                           for batch in self._batches(self.iter_pages(), batch_size))
+                pool = None
+            else:
+                # 从导入线程中创建进程池: fork 会把其他线程持有的锁原样复制进子进程而死锁，改用 spawn
+                pool = ProcessPoolExecutor(max_workers=min(workers, -(-pages_total // batch_size)),
+                                           mp_context=multiprocessing.get_context("spawn"),
+                                           initializer=_init_package_worker, initargs=(self._source_spec,))
+                results = self._submit_batches(pool, workers, batch_size)
+
+            try:
+                # 结果按提交顺序到达，每批写出后即释放，不在内存中累积全部条目
+                for entries, stat in results:
+                    writer.write_all(entries)
+                    worker = per_worker.setdefault(stat["pid"], {"batches": 0, "rules": 0, "entries": 0, "busy": 0.0})
+                    worker["batches"] += 1
+                    worker["rules"] += stat["rules"]
+                    worker["entries"] += len(entries)
+                    worker["busy"] += stat["elapsed"]
+                    pages_done += stat["pages"]
+                    nodes_done += stat["rules"]
+                    bytes_done += stat["bytes"]
+                    if progress_callback:
+                        progress_callback(pages_done, pages_total, writer.count, bytes_done)
+            finally:
+                if pool is not None:
+                    pool.shutdown(cancel_futures=True)
+
+        elapsed = time.time() - start
+        busy = sum(w["busy"] for w in per_worker.values())
+        self.last_stats = {
+            "workers": len(per_worker),
+            "pages": pages_done,
+            "rules": nodes_done,
+            "entries": writer.count,
+            "bytes": bytes_done,
+            "elapsed": elapsed,
+            "chunks_per_sec": writer.count / elapsed if elapsed > 0 else 0.0,
+            # 各进程忙碌时间之和 / 墙钟时间，即平均同时工作的进程数。
+            # 并行时单批耗时会因争用而变长，它不等于相对串行的加速比
+            "parallelism": busy / elapsed if elapsed > 0 else 1.0,
+            "per_worker": per_worker,
+        }
+        for pid, w in per_worker.items():
+            logger.info(f"[worker {pid}] {w['batches']} 批, {w['rules']} 个节点, "
+                        f"{w['entries']} 条, 耗时 {w['busy']:.1f}s")
+        logger.info(f"打包完成: {pages_done} 页, {nodes_done} 个节点, {writer.count} 条, {elapsed:.1f}s "
+                    f"({self.last_stats['chunks_per_sec']:.0f} chunks/sec), {len(per_worker)} 进程, 并行度 {self.last_stats['parallelism']:.1f}")
+
+        return os.path.join(output_dir, writer.file_name)
+
+    @staticmethod
+    def _batches(pages, batch_size):
+        batch = []
+        for page in pages:
+            batch.append(page)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _submit_batches(self, pool, workers, batch_size):
+        """边遍历目录边提交任务，同时在途的批次数有上限，按提交顺序产出结果"""
+        pending = deque()
+        for batch in self._batches(self.iter_pages(), batch_size):
+            pending.append(pool.submit(_package_batch, self._source_spec, batch, self.detected_encoding))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def _anchor_position(self, html_content, anchor):
+        """锚点 (name= 或 id=) 所在标签的起始位置，找不到返回 None"""
+        match = re.search(r'<[a-z][^>]*\b(?:name|id)\s*=\s*["\']?' + re.escape(anchor) + r'(?:["\'\s/>])',
+                          html_content, re.IGNORECASE)
+        return match.start() if match else None
+
+    def _process_page(self, relative_path, nodes):
+        """
+        处理一个页面及指向它的目录节点：读取 -> 按锚点切片 -> 正则分割 -> Md转换。
+        多个节点指向同一页面的不同锚点时，每个节点只取自己锚点到下一个锚点之间的内容；
+        页面开头到第一个锚点的部分归第一个节点。页面内找不到的锚点并入前一个节点。
+        split_by 按节点决定: 规则中指定的优先，否则对节点所在的整个页面做启发式分析。
+        """
+        if not any(override.get("action", "process") == "process" for _, _, override in nodes):
+            return []
+        if not self.source.exists(relative_path):
+            return []
 
-        rules = self.config.get("tree_processing_rules", {})
-        all_data = []
+        html_content = self._read_file_safe(relative_path)
+        if not html_content: return []
 
-        for name, rule in rules.items():
-            if rule.get("action") != "process":
+        sections = []
+        for title, anchor, override in nodes:
+            pos = self._anchor_position(html_content, anchor) if anchor else 0
+            if pos is None and sections:
                 continue
+            sections.append((pos or 0, title, override))
+        sections.sort(key=lambda s: s[0])
+        # 第一个切片从页面开头开始
+        bounds = [0] + [section[0] for section in sections[1:]] + [len(html_content)]
 
-            entries = self._process_node_package(
-                title=name,
-                relative_path=rule['path'],
-                split_by=rule.get('split_by')
-            )
-            all_data.extend(entries)
-
-        with open(output_json_path, 'w', encoding='utf-8') as f:
-            json.dump(all_data, f, ensure_ascii=False, indent=2)
-
-        return output_json_path
+        page_split = None
+        if any("split_by" not in override for _, _, override in sections):
+            page_split = self._analyze_split_strategy_strict(html_content)
 
-    def _process_node_package(self, title, relative_path, split_by):
-        """处理单个文件节点：读取 -> 正则分割 -> Md转换"""
-        full_path = os.path.join(self.chm_source_dir, relative_path)
-        if not os.path.exists(full_path):
-            return []
-
-        html_content = self._read_file_safe(full_path)
-        if not html_content: return []
+        entries = []
+        # 同一页面 (即同一 source) 下各节点共用，保证 (source, title) 不重复
+        seen_titles = {}
+        for (_, title, override), begin, end in zip(sections, bounds, bounds[1:]):
+            if override.get("action", "process") != "process":
+                continue
+            split_by = override.get("split_by", page_split)
+            entries.extend(self._process_node_package(title, relative_path, html_content[begin:end], split_by,
+                                                      seen_titles))
+        return entries
 
+    def _process_node_package(self, title, relative_path, html_content, split_by, seen_titles=None):
+        """
+        处理单个目录节点对应的 HTML：正则分割 -> Md转换 -> 按长度上下限切成检索 chunk
+        seen_titles: 本页面已用过的标题 -> 次数，重名的标题加 " (n)" 后缀
+        """
         # 1. Regex 分割 (复刻 V3/V5)
         if split_by:
             chunks = self._split_content_regex(html_content, split_by)
@@ -242,6 +723,10 @@ class CHMProcessor:
             chunks = [{"sub_title": "", "content": html_content}]
 
         entries = []
+        leaf = heading_text(title.rsplit(self.BREADCRUMB_SEPARATOR, 1)[-1])
+        # 标题即检索端的 full_path (文档池与黑名单都按它区分)，也是 chunk key 的一部分，同一页面内不能重复
+        if seen_titles is None:
+            seen_titles = {}
         for chunk in chunks:
             # 2. Html2Text 转换
             md_text = self._convert_html_to_md(chunk["content"])
@@ -253,11 +738,21 @@ class CHMProcessor:
             if chunk["sub_title"] and chunk["sub_title"] != "Intro":
                 final_title = f"{title} - {chunk['sub_title']}"
 
-            entries.append({
-                "title": final_title,
-                "content": md_text,
-                "source": relative_path
-            })
+            # 3. 超长的按子标题/表格/段落切分，过短的合并
+            for headings, content in self.chunker.split(md_text):
+                # 分割标题与页面同名的标题已在 final_title 中 (两边都取规范化文本比较)
+                extra = [h for h in headings if heading_text(h) not in (heading_text(chunk["sub_title"]), leaf)]
+                chunk_title = self.BREADCRUMB_SEPARATOR.join([final_title] + extra)
+                seen_titles[chunk_title] = seen_titles.get(chunk_title, 0) + 1
+                if seen_titles[chunk_title] > 1:
+                    chunk_title = f"{chunk_title} ({seen_titles[chunk_title]})"
+
+                entries.append({
+                    "title": chunk_title,
+                    "content": content,
+                    "source": relative_path,
+                    "headings": headings,
+                })
 
         return entries
 
@@ -266,12 +761,7 @@ class CHMProcessor:
         [关键逻辑] 基于正则的字符串分割 (复刻 package_json.py)
         保留 <tag>...</tag> 及其内容。
         """
-        # Pattern: (<tag\b[^>]*>.*?</tag>)
-        # re.DOTALL 确保 . 匹配换行符
-        # re.IGNORECASE 忽略大小写
-        pattern = f"(<{tag_name}\\b[^>]*>.*?</{tag_name}>)"
-
-        parts = re.split(pattern, html_content, flags=re.DOTALL | re.IGNORECASE)
+        parts = _SPLIT_PATTERNS[tag_name].split(html_content)
 
         results = []
 
@@ -288,8 +778,7 @@ class CHMProcessor:
             body_html = parts[i + 1]
 
             # 提取纯文本标题
-            soup_header = BeautifulSoup(header_html, 'html.parser')
-            clean_title = soup_header.get_text(" ", strip=True)
+            clean_title = strip_tags(header_html)
 
             # 组合内容：将 header 放回 body 开头，以便 Markdown 保留层级
             combined = header_html + "\n" + body_html
@@ -302,33 +791,38 @@ class CHMProcessor:
         return results
 
     def _convert_html_to_md(self, html_content):
-        """配置 html2text (复刻 package_json.py)"""
-        h = html2text.HTML2Text()
-        h.ignore_links = False
-        h.ignore_images = False
-        h.ignore_tables = False  # 必须保留表格
-        h.body_width = 0  # 不强制折行
-        h.protect_links = True
-        h.unicode_snob = True
-
+        """html2text 转换 (复刻 package_json.py)，转换器在进程内复用"""
         try:
-            return h.handle(html_content)
+            return _markdown_converter().convert(html_content)
         except Exception as e:
             logger.error(f"Markdown conversion error: {e}")
             return BeautifulSoup(html_content, 'html.parser').get_text()
 
     def _read_file_safe(self, path):
-        """多编码读取尝试 (复刻 analyze_chm.py 的健壮性)"""
+        """多编码读取尝试 (复刻 analyze_chm.py 的健壮性)，path 为 CHM 内的相对路径，最近的结果按路径缓存"""
+        content = self._decoded.get(path)
+        if content is not None:
+            self._decoded.move_to_end(path)
+            return content
         try:
-            with open(path, 'rb') as f:
-                raw = f.read()
-            # 常见中文编码尝试顺序
-            encodings = ['utf-8-sig', 'utf-8', 'gb18030', 'gbk', 'big5', 'utf-16']
-            for enc in encodings:
-                try:
-                    return raw.decode(enc)
-                except:
-                    continue
-            return raw.decode('utf-8', errors='ignore')
+            raw = self.source.read(path)
         except Exception:
-            return None
\ No newline at end of file
+            return None
+
+        # 常见中文编码尝试顺序，检测出的编码排在最前
+        encodings = ['utf-8-sig', 'utf-8', 'gb18030', 'gbk', 'big5', 'utf-16']
+        if self.detected_encoding:
+            encodings = [self.detected_encoding] + [e for e in encodings if e != self.detected_encoding]
+        content = None
+        for enc in encodings:
+            try:
+                content = raw.decode(enc)
+                break
+            except:
+                continue
+        if content is None:
+            content = raw.decode('utf-8', errors='ignore')
+        self._decoded[path] = content
+        if len(self._decoded) > self.DECODED_CACHE:
+            self._decoded.popitem(last=False)
+        return content
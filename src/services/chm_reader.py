@@ -0,0 +1,598 @@
+"""
+模块: CHM Reader
+纯 Python 的 CHM (ITSF) 读取器，替代 7za 解包。
+
+只解析目录 (ITSP/PMGL)，成员内容按需读取: 未压缩段直接按偏移读取，
+MSCompressed 段按 LZX 帧 (0x8000 字节) 解压，只解压目标成员所在的帧及其所属重置区间内之前的帧，
+解压结果直接留在内存中，不落盘。LZX 解码流程与 chmlib / libmspack 的 lzxd 一致。
+"""
+import os
+import struct
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+class CHMError(Exception):
+    pass
+
+
+# === LZX ===
+
+LZX_MIN_MATCH = 2
+LZX_NUM_CHARS = 256
+LZX_NUM_PRIMARY_LENGTHS = 7
+LZX_NUM_SECONDARY_LENGTHS = 249
+LZX_PRETREE_NUM_ELEMENTS = 20
+LZX_ALIGNED_NUM_ELEMENTS = 8
+
+BLOCKTYPE_VERBATIM = 1
+BLOCKTYPE_ALIGNED = 2
+BLOCKTYPE_UNCOMPRESSED = 3
+
+EXTRA_BITS = []
+POSITION_BASE = []
+_j = 0
+for _i in range(0, 52, 2):
+    EXTRA_BITS += [_j, _j]
+    if _i != 0 and _j < 17:
+        _j += 1
+_j = 0
+for _i in range(51):
+    POSITION_BASE.append(_j)
+    _j += 1 << EXTRA_BITS[_i]
+del _i, _j
+
+
+def _build_table(lengths: List[int]) -> Tuple[List, int]:
+    """
+    由码长构造范式 Huffman 查找表: 以最长码长 max_bits 位为下标，直接得到 (符号, 码长)。
+    码长全为 0 时返回空表
+    """
+    max_bits = max(lengths) if lengths else 0
+    if max_bits == 0:
+        return [], 0
+    table = [None] * (1 << max_bits)
+    code = 0
+    for bits in range(1, max_bits + 1):
+        for sym, length in enumerate(lengths):
+            if length != bits:
+                continue
+            span = 1 << (max_bits - bits)
+            start = code << (max_bits - bits)
+            if start + span > len(table):
+                raise CHMError("LZX: over-subscribed Huffman table")
+            table[start:start + span] = [(sym, bits)] * span
+            code += 1
+        code <<= 1
+    return table, max_bits
+
+
+class _BitReader:
+    """LZX 位流: 16 位小端字为单位，字内高位在前"""
+    __slots__ = ("data", "pos", "buf", "left")
+
+    def __init__(self, data: bytes, pos: int = 0):
+        self.data = data
+        self.pos = pos
+        self.buf = 0
+        self.left = 0
+
+    def ensure(self, n: int):
+        data = self.data
+        while self.left < n:
+            p = self.pos
+            # 越过末尾时补 0 (与 C 实现读取缓冲区之后的填充字节等价)
+            word = (data[p + 1] << 8 | data[p]) if p + 1 < len(data) else 0
+            self.buf = (self.buf << 16) | word
+            self.left += 16
+            self.pos = p + 2
+
+    def read(self, n: int) -> int:
+        if n == 0:
+            return 0
+        self.ensure(n)
+        self.left -= n
+        value = self.buf >> self.left
+        self.buf &= (1 << self.left) - 1
+        return value
+
+    def symbol(self, table, bits) -> int:
+        if not bits:
+            raise CHMError("LZX: empty Huffman table")
+        self.ensure(bits)
+        entry = table[self.buf >> (self.left - bits)]
+        if entry is None:
+            raise CHMError("LZX: invalid Huffman code")
+        sym, length = entry
+        self.left -= length
+        self.buf &= (1 << self.left) - 1
+        return sym
+
+
+class LZXDecoder:
+    """按帧解压 LZX 数据；跨帧保留窗口、重复偏移与码表，reset() 对应重置区间的起点"""
+
+    def __init__(self, window_bits: int):
+        if not 15 <= window_bits <= 21:
+            raise CHMError(f"LZX: unsupported window size 2^{window_bits}")
+        self.window_size = 1 << window_bits
+        if window_bits == 20:
+            posn_slots = 42
+        elif window_bits == 21:
+            posn_slots = 50
+        else:
+            posn_slots = window_bits << 1
+        self.main_elements = LZX_NUM_CHARS + (posn_slots << 3)
+        self.window = bytearray(self.window_size)
+        self.reset()
+
+    def reset(self):
+        self.R0 = self.R1 = self.R2 = 1
+        self.main_lens = [0] * self.main_elements
+        self.length_lens = [0] * LZX_NUM_SECONDARY_LENGTHS
+        self.main_table, self.main_bits = [], 0
+        self.length_table, self.length_bits = [], 0
+        self.aligned_table, self.aligned_bits = [], 0
+        self.header_read = False
+        self.block_type = 0
+        self.block_length = 0
+        self.block_remaining = 0
+        self.frames_read = 0
+        self.intel_filesize = 0
+        self.intel_curpos = 0
+        self.intel_started = False
+        self.window_posn = 0
+
+    def _read_lengths(self, br: _BitReader, lens: List[int], first: int, last: int):
+        """读取用 pretree 差分编码的码长"""
+        pre_lens = [br.read(4) for _ in range(LZX_PRETREE_NUM_ELEMENTS)]
+        table, bits = _build_table(pre_lens)
+        size = len(lens)
+        x = first
+        while x < last:
+            z = br.symbol(table, bits)
+            if z == 17:
+                run, value = br.read(4) + 4, 0
+            elif z == 18:
+                run, value = br.read(5) + 20, 0
+            elif z == 19:
+                run = br.read(1) + 4
+                z = br.symbol(table, bits)
+                value = (lens[x] - z) % 17
+            else:
+                run, value = 1, (lens[x] - z) % 17
+            # 与 C 实现一致: 游程可以越过 last，写入同一码长表的后续位置
+            n = min(run, size - x)
+            lens[x:x + n] = [value] * n
+            x += run
+
+    def decompress(self, data: bytes, outlen: int) -> bytes:
+        """解压一帧: data 为该帧的压缩数据，返回 outlen 字节"""
+        br = _BitReader(data)
+        window = self.window
+        window_size = self.window_size
+        window_posn = self.window_posn
+        R0, R1, R2 = self.R0, self.R1, self.R2
+
+        if not self.header_read:
+            if br.read(1):
+                high = br.read(16)
+                low = br.read(16)
+                self.intel_filesize = (high << 16) | low
+            self.header_read = True
+
+        togo = outlen
+        while togo > 0:
+            if self.block_remaining == 0:
+                if self.block_type == BLOCKTYPE_UNCOMPRESSED:
+                    # 未压缩块之后重新对齐到字边界
+                    pos = br.pos + (self.block_length & 1)
+                    br = _BitReader(data, pos)
+
+                self.block_type = br.read(3)
+                self.block_remaining = self.block_length = (br.read(16) << 8) | br.read(8)
+
+                if self.block_type == BLOCKTYPE_ALIGNED:
+                    aligned_lens = [br.read(3) for _ in range(LZX_ALIGNED_NUM_ELEMENTS)]
+                    self.aligned_table, self.aligned_bits = _build_table(aligned_lens)
+                if self.block_type in (BLOCKTYPE_VERBATIM, BLOCKTYPE_ALIGNED):
+                    self._read_lengths(br, self.main_lens, 0, 256)
+                    self._read_lengths(br, self.main_lens, 256, self.main_elements)
+                    self.main_table, self.main_bits = _build_table(self.main_lens)
+                    if self.main_lens[0xE8] != 0:
+                        self.intel_started = True
+                    self._read_lengths(br, self.length_lens, 0, LZX_NUM_SECONDARY_LENGTHS)
+                    self.length_table, self.length_bits = _build_table(self.length_lens)
+                elif self.block_type == BLOCKTYPE_UNCOMPRESSED:
+                    self.intel_started = True
+                    br.ensure(16)
+                    pos = br.pos - 2 if br.left > 16 else br.pos
+                    R0, R1, R2 = struct.unpack_from("<III", data, pos)
+                    br = _BitReader(data, pos + 12)
+                else:
+                    raise CHMError(f"LZX: illegal block type {self.block_type}")
+
+            if br.pos > len(data) + 2:
+                raise CHMError("LZX: input overrun")
+
+            while self.block_remaining > 0 and togo > 0:
+                this_run = min(self.block_remaining, togo)
+                togo -= this_run
+                self.block_remaining -= this_run
+                window_posn &= window_size - 1
+                if window_posn + this_run > window_size:
+                    raise CHMError("LZX: run straddles window wrap")
+
+                if self.block_type == BLOCKTYPE_UNCOMPRESSED:
+                    pos = br.pos
+                    if pos + this_run > len(data):
+                        raise CHMError("LZX: truncated uncompressed block")
+                    window[window_posn:window_posn + this_run] = data[pos:pos + this_run]
+                    br.pos = pos + this_run
+                    window_posn += this_run
+                    continue
+
+                window_posn, R0, R1, R2 = self._decode_run(br, this_run, window_posn, R0, R1, R2)
+
+        end = window_posn or window_size
+        out = bytearray(window[end - outlen:end])
+        self.window_posn = window_posn
+        self.R0, self.R1, self.R2 = R0, R1, R2
+
+        if self.frames_read < 32768 and self.intel_filesize:
+            self._intel_e8(out)
+        self.frames_read += 1
+        return bytes(out)
+
+    def _decode_run(self, br: _BitReader, this_run: int, window_posn: int, R0: int, R1: int, R2: int):
+        """解码 verbatim / aligned 块中的 this_run 字节 (热循环，位流操作内联)"""
+        window = self.window
+        window_size = self.window_size
+        aligned = self.block_type == BLOCKTYPE_ALIGNED
+        main_table, main_bits = self.main_table, self.main_bits
+        length_table, length_bits = self.length_table, self.length_bits
+        aligned_table, aligned_bits = self.aligned_table, self.aligned_bits
+        if not main_bits:
+            raise CHMError("LZX: empty main tree")
+        data = br.data
+        n = len(data)
+        buf, left, pos = br.buf, br.left, br.pos
+
+        while this_run > 0:
+            # 读主树符号
+            while left < main_bits:
+                buf = (buf << 16) | ((data[pos + 1] << 8 | data[pos]) if pos + 1 < n else 0)
+                left += 16
+                pos += 2
+            entry = main_table[buf >> (left - main_bits)]
+            if entry is None:
+                raise CHMError("LZX: invalid Huffman code")
+            sym, length = entry
+            left -= length
+            buf &= (1 << left) - 1
+
+            if sym < LZX_NUM_CHARS:
+                window[window_posn] = sym
+                window_posn += 1
+                this_run -= 1
+                continue
+
+            sym -= LZX_NUM_CHARS
+            match_length = sym & LZX_NUM_PRIMARY_LENGTHS
+            if match_length == LZX_NUM_PRIMARY_LENGTHS:
+                br.buf, br.left, br.pos = buf, left, pos
+                match_length += br.symbol(length_table, length_bits)
+                buf, left, pos = br.buf, br.left, br.pos
+            match_length += LZX_MIN_MATCH
+
+            match_offset = sym >> 3
+            if match_offset > 2:
+                extra = EXTRA_BITS[match_offset]
+                br.buf, br.left, br.pos = buf, left, pos
+                if not aligned:
+                    if match_offset != 3:
+                        match_offset = POSITION_BASE[match_offset] - 2 + br.read(extra)
+                    else:
+                        match_offset = 1
+                else:
+                    match_offset = POSITION_BASE[match_offset] - 2
+                    if extra > 3:
+                        match_offset += br.read(extra - 3) << 3
+                        match_offset += br.symbol(aligned_table, aligned_bits)
+                    elif extra == 3:
+                        match_offset += br.symbol(aligned_table, aligned_bits)
+                    elif extra > 0:
+                        match_offset += br.read(extra)
+                    else:
+                        match_offset = 1
+                buf, left, pos = br.buf, br.left, br.pos
+                R2, R1, R0 = R1, R0, match_offset
+            elif match_offset == 0:
+                match_offset = R0
+            elif match_offset == 1:
+                match_offset = R1
+                R1, R0 = R0, match_offset
+            else:
+                match_offset = R2
+                R2, R0 = R0, match_offset
+
+            this_run -= match_length
+            if window_posn + match_length > window_size:
+                raise CHMError("LZX: match runs past window end")
+            src = window_posn - match_offset
+            if src < 0:
+                # 源数据绕回窗口末尾
+                src += window_size
+                first = min(match_length, window_size - src)
+                window[window_posn:window_posn + first] = window[src:src + first]
+                window_posn += first
+                match_length -= first
+                src = 0
+            if match_length <= 0:
+                continue
+            if src + match_length <= window_posn:
+                window[window_posn:window_posn + match_length] = window[src:src + match_length]
+            else:
+                # 源与目标重叠: 按周期重复
+                pattern = window[src:window_posn]
+                reps = match_length // len(pattern) + 1
+                window[window_posn:window_posn + match_length] = (pattern * reps)[:match_length]
+            window_posn += match_length
+
+        if this_run < 0:
+            raise CHMError("LZX: match overruns frame")
+        br.buf, br.left, br.pos = buf, left, pos
+        return window_posn, R0, R1, R2
+
+    def _intel_e8(self, out: bytearray):
+        outlen = len(out)
+        curpos = self.intel_curpos
+        self.intel_curpos = curpos + outlen
+        if outlen <= 6 or not self.intel_started:
+            return
+        filesize = self.intel_filesize
+        i, end = 0, outlen - 10
+        while i < end:
+            if out[i] != 0xE8:
+                i += 1
+                curpos += 1
+                continue
+            abs_off = struct.unpack_from("<i", out, i + 1)[0]
+            if -curpos <= abs_off < filesize:
+                rel_off = abs_off - curpos if abs_off >= 0 else abs_off + filesize
+                struct.pack_into("<I", out, i + 1, rel_off & 0xFFFFFFFF)
+            i += 5
+            curpos += 5
+
+
+# === ITSF container ===
+
+def _encint(data: bytes, pos: int) -> Tuple[int, int]:
+    """CHM 目录中的变长整数: 大端 7 位分组，最高位为延续标志"""
+    value = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value = (value << 7) | (b & 0x7F)
+        if not b & 0x80:
+            return value, pos
+
+
+class CHMFile:
+    """CHM 归档的只读视图: 成员名 (以 / 开头) -> 内容"""
+
+    CONTENT = "::DataSpace/Storage/MSCompressed/Content"
+    CONTROL_DATA = "::DataSpace/Storage/MSCompressed/ControlData"
+    RESET_TABLE = ("::DataSpace/Storage/MSCompressed/Transform/"
+                   "{7FC28940-9D31-11D0-9B27-00A0C91E9C7C}/InstanceData/ResetTable")
+    # 解压后的帧缓存上限 (帧数)
+    FRAME_CACHE = 64
+
+    def __init__(self, path: str):
+        self.path = path
+        self._f = open(path, 'rb')
+        try:
+            self._read_header()
+            self._read_directory()
+        except (struct.error, IndexError) as e:
+            self._f.close()
+            raise CHMError(f"Malformed CHM file: {e}")
+        except Exception:
+            self._f.close()
+            raise
+        self._lzx: Optional[LZXDecoder] = None
+        self._lzx_next_frame = -1
+        self._frames: "OrderedDict[int, bytes]" = OrderedDict()
+        self._compressed = None
+        # 不区分大小写的查找 (HHC 中的链接大小写常与实际成员名不一致)
+        self._lower = {name.lower(): name for name in self.entries}
+
+    def _read(self, offset: int, length: int) -> bytes:
+        self._f.seek(offset)
+        data = self._f.read(length)
+        if len(data) != length:
+            raise CHMError("Unexpected end of CHM file")
+        return data
+
+    def _read_header(self):
+        header = self._read(0, 0x58)
+        if header[:4] != b"ITSF":
+            raise CHMError("Not a CHM file (missing ITSF signature)")
+        version = struct.unpack_from("<I", header, 4)[0]
+        self.dir_offset, self.dir_length = struct.unpack_from("<QQ", header, 0x48)
+        if version >= 3:
+            self.content_offset = struct.unpack_from("<Q", self._read(0x58, 8))[0]
+        else:
+            self.content_offset = self.dir_offset + self.dir_length
+
+    def _read_directory(self):
+        itsp = self._read(self.dir_offset, 0x54)
+        if itsp[:4] != b"ITSP":
+            raise CHMError("Missing ITSP directory header")
+        header_len, _, chunk_size = struct.unpack_from("<III", itsp, 8)
+        first_pmgl, last_pmgl = struct.unpack_from("<ii", itsp, 0x20)
+        n_chunks = struct.unpack_from("<I", itsp, 0x2C)[0]
+        chunks_start = self.dir_offset + header_len
+
+        self.entries: Dict[str, Tuple[int, int, int]] = {}
+        chunk_no, visited = first_pmgl, set()
+        while chunk_no != -1 and chunk_no not in visited and 0 <= chunk_no < n_chunks:
+            visited.add(chunk_no)
+            chunk = self._read(chunks_start + chunk_no * chunk_size, chunk_size)
+            if chunk[:4] != b"PMGL":
+                break
+            free_space = struct.unpack_from("<I", chunk, 4)[0]
+            next_chunk = struct.unpack_from("<i", chunk, 0x10)[0]
+            pos, end = 0x14, chunk_size - free_space
+            while pos < end:
+                name_len, pos = _encint(chunk, pos)
+                name = chunk[pos:pos + name_len].decode('utf-8', errors='replace')
+                pos += name_len
+                section, pos = _encint(chunk, pos)
+                offset, pos = _encint(chunk, pos)
+                length, pos = _encint(chunk, pos)
+                self.entries[name] = (section, offset, length)
+            if chunk_no == last_pmgl:
+                break
+            chunk_no = next_chunk
+
+    # === Members ===
+
+    def resolve(self, name: str) -> Optional[str]:
+        """相对路径 / 成员名 -> 归档中的成员名，不存在时返回 None"""
+        name = "/" + name.replace("\\", "/").lstrip("/")
+        if name in self.entries:
+            return name
+        return self._lower.get(name.lower())
+
+    def exists(self, name: str) -> bool:
+        return self.resolve(name) is not None
+
+    def size(self, name: str) -> int:
+        return self.entries[self.resolve(name)][2]
+
+    def list(self) -> Iterator[str]:
+        """所有普通文件成员 (不含目录与 ::DataSpace 等内部对象)，返回不带前导 / 的相对路径"""
+        for name, (_, _, length) in self.entries.items():
+            if name.startswith("/") and not name.endswith("/") and not name.startswith("/#") \
+                    and not name.startswith("/$"):
+                yield name[1:]
+
+    def read(self, name: str) -> bytes:
+        member = self.resolve(name)
+        if member is None:
+            raise KeyError(name)
+        return self._read_entry(*self.entries[member])
+
+    def _read_entry(self, section: int, offset: int, length: int) -> bytes:
+        if length == 0:
+            return b""
+        if section == 0:
+            return self._read(self.content_offset + offset, length)
+        return self._read_compressed(offset, length)
+
+    # === MSCompressed ===
+
+    def _init_compressed(self):
+        control = self._read_entry(*self.entries[self.CONTROL_DATA])
+        if control[4:8] != b"LZXC":
+            raise CHMError("Unsupported compression (expected LZXC)")
+        version, reset_interval, window_size, windows_per_reset = struct.unpack_from("<IIII", control, 8)
+        if version == 2:
+            reset_interval *= 0x8000
+            window_size *= 0x8000
+        if window_size == 0 or window_size & (window_size - 1):
+            raise CHMError(f"Invalid LZX window size: {window_size}")
+
+        reset_table = self._read_entry(*self.entries[self.RESET_TABLE])
+        n_entries, _, table_offset = struct.unpack_from("<III", reset_table, 4)
+        self.uncompressed_len, self.compressed_len, self.frame_size = struct.unpack_from("<QQQ", reset_table, 0x10)
+        self.frame_offsets = list(struct.unpack_from(f"<{n_entries}Q", reset_table, table_offset))
+
+        self.window_bits = window_size.bit_length() - 1
+        # 与 chmlib 相同: 每隔 reset_frames 帧解码器重置一次
+        self.reset_frames = max(1, reset_interval // (window_size // 2) * max(1, windows_per_reset))
+        _, content_offset, _ = self.entries[self.CONTENT]
+        self._compressed = self.content_offset + content_offset
+
+    def _frame(self, index: int) -> bytes:
+        frame = self._frames.get(index)
+        if frame is not None:
+            self._frames.move_to_end(index)
+            return frame
+
+        start = index - index % self.reset_frames
+        # 顺序读取时沿用上次的解码器状态，否则从重置点开始
+        if self._lzx is None or not (start <= self._lzx_next_frame <= index):
+            if self._lzx is None:
+                self._lzx = LZXDecoder(self.window_bits)
+            self._lzx.reset()
+            self._lzx_next_frame = start
+
+        while self._lzx_next_frame <= index:
+            i = self._lzx_next_frame
+            if i % self.reset_frames == 0:
+                self._lzx.reset()
+            begin = self.frame_offsets[i]
+            end = self.frame_offsets[i + 1] if i + 1 < len(self.frame_offsets) else self.compressed_len
+            out_len = min(self.frame_size, self.uncompressed_len - i * self.frame_size)
+            frame = self._lzx.decompress(self._read(self._compressed + begin, end - begin), out_len)
+            self._frames[i] = frame
+            if len(self._frames) > self.FRAME_CACHE:
+                self._frames.popitem(last=False)
+            self._lzx_next_frame = i + 1
+        return frame
+
+    def _read_compressed(self, offset: int, length: int) -> bytes:
+        if self._compressed is None:
+            self._init_compressed()
+        first = offset // self.frame_size
+        last = (offset + length - 1) // self.frame_size
+        data = b"".join(self._frame(i) for i in range(first, last + 1))
+        start = offset - first * self.frame_size
+        return data[start:start + length]
+
+    def close(self):
+        self._f.close()
+        self._frames.clear()
+        self._lzx = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class DirectorySource:
+    """已解包到磁盘的目录，与 CHMFile 提供相同的读取接口 (7za 兜底路径)"""
+
+    def __init__(self, root: str):
+        self.path = root
+
+    def _full(self, name: str) -> str:
+        return os.path.join(self.path, name.replace("\\", "/").lstrip("/"))
+
+    def exists(self, name: str) -> bool:
+        return os.path.isfile(self._full(name))
+
+    def size(self, name: str) -> int:
+        return os.path.getsize(self._full(name))
+
+    def list(self) -> Iterator[str]:
+        for root, _, files in os.walk(self.path):
+            for f in files:
+                yield os.path.relpath(os.path.join(root, f), self.path).replace(os.sep, "/")
+
+    def read(self, name: str) -> bytes:
+        with open(self._full(name), 'rb') as f:
+            return f.read()
+
+    def close(self):
+        pass
+
+
+def open_source(spec: Tuple[str, str]):
+    """("chm", 文件路径) 或 ("dir", 目录) -> 读取源，供子进程按描述重新打开"""
+    kind, path = spec
+    return CHMFile(path) if kind == "chm" else DirectorySource(path)
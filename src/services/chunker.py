@@ -0,0 +1,145 @@
+"""
+模块: Chunker
+html2text 输出的 Markdown -> 大小受限的检索 chunk。
+超长的文本依次按更深一级的标题、表格/段落、行递归切分，最后才按长度硬切；
+过短的相邻 chunk 合并，每个 chunk 带上所在的标题路径 (面包屑)。
+"""
+import re
+from typing import Callable, List, Optional, Tuple
+
+_HEADING = re.compile(r'^(#{1,6})[ \t]+(.+?)[ \t#]*$', re.MULTILINE)
+_TABLE_SEPARATOR = re.compile(r'^[ \t]*\|?[ \t]*:?-{3,}:?[ \t]*(\|[ \t]*:?-{3,}:?[ \t]*)*\|?[ \t]*$')
+_BLANK_LINES = re.compile(r'\n[ \t]*\n')
+
+# (标题路径, 内容)
+Chunk = Tuple[List[str], str]
+
+
+class MarkdownChunker:
+    """
+    max_size / min_size: chunk 长度上下限，单位由 length_function 决定 (默认字符数，可传入分词计数)
+    overlap: 按段落/行切分时，新 chunk 开头重复上一个 chunk 末尾的长度，0 为不重叠
+    """
+
+    def __init__(self, max_size: int = 1500, min_size: int = 200, overlap: int = 0,
+                 length_function: Callable[[str], int] = len):
+        if not 0 <= min_size <= max_size:
+            raise ValueError("需要 0 <= min_size <= max_size")
+        if not 0 <= overlap < max_size:
+            raise ValueError("需要 0 <= overlap < max_size")
+        self.max_size = max_size
+        self.min_size = min_size
+        self.overlap = overlap
+        self.length = length_function
+
+    def split(self, text: str, headings: Optional[List[str]] = None) -> List[Chunk]:
+        chunks = self._split(text.strip(), list(headings or []), 0)
+        return self._merge_small([(h, c) for h, c in chunks if c.strip()])
+
+    def _split(self, text: str, headings: List[str], level: int) -> List[Chunk]:
+        if self.length(text) <= self.max_size:
+            return [(headings, text)]
+
+        # 1. 按下一级标题切分，标题行留在各自小节开头
+        matches = [m for m in _HEADING.finditer(text) if len(m.group(1)) > level]
+        if matches:
+            top = min(len(m.group(1)) for m in matches)
+            marks = [m for m in matches if len(m.group(1)) == top]
+            chunks = []
+            if text[:marks[0].start()].strip():
+                chunks.extend(self._split(text[:marks[0].start()].strip(), headings, top))
+            for m, nxt in zip(marks, marks[1:] + [None]):
+                section = text[m.start():nxt.start() if nxt else len(text)].strip()
+                chunks.extend(self._split(section, headings + [m.group(2)], top))
+            return chunks
+
+        # 2. 没有更深的标题: 按表格/段落/行打包
+        return [(headings, c) for c in self._pack(self._blocks(text))]
+
+    def _blocks(self, text: str) -> List[str]:
+        """切成不超过上限的块: 段落与表格为单位，超长的表格按行切 (每段重复表头)，其余按行、按长度切"""
+        blocks = []
+        for para in _BLANK_LINES.split(text):
+            para = para.strip('\n')
+            if not para.strip():
+                continue
+            if self.length(para) <= self.max_size:
+                blocks.append(para)
+                continue
+            lines = para.split('\n')
+            header = []
+            if len(lines) > 2 and _TABLE_SEPARATOR.match(lines[1]):
+                header, lines = lines[:2], lines[2:]
+            for piece in self._pack_lines(lines, header):
+                blocks.extend(self._hard_split(piece))
+        return blocks
+
+    def _pack_lines(self, lines: List[str], header: List[str]) -> List[str]:
+        pieces, current = [], list(header)
+        for line in lines:
+            if len(current) > len(header) and self.length('\n'.join(current + [line])) > self.max_size:
+                pieces.append('\n'.join(current))
+                current = list(header)
+            current.append(line)
+        if len(current) > len(header) or not pieces:
+            pieces.append('\n'.join(current))
+        return pieces
+
+    def _hard_split(self, text: str) -> List[str]:
+        """单行仍超长时按比例估算切点，尽量落在空白处"""
+        pieces = []
+        while self.length(text) > self.max_size:
+            cut = max(1, len(text) * self.max_size // self.length(text))
+            space = text.rfind(' ', cut // 2, cut)
+            cut = space if space > 0 else cut
+            pieces.append(text[:cut])
+            text = text[cut:].lstrip()
+        if text:
+            pieces.append(text)
+        return pieces
+
+    def _pack(self, blocks: List[str]) -> List[str]:
+        """贪心地把相邻块拼成不超过上限的 chunk，按需在开头带上前一个 chunk 的末尾"""
+        chunks, current = [], ""
+        for block in blocks:
+            candidate = f"{current}\n\n{block}" if current else block
+            if current and self.length(candidate) > self.max_size:
+                chunks.append(current)
+                tail = self._tail(current)
+                candidate = f"{tail}\n\n{block}" if tail else block
+                if self.length(candidate) > self.max_size:
+                    candidate = block
+            current = candidate
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _tail(self, text: str) -> str:
+        if not self.overlap:
+            return ""
+        cut = len(text) - len(text) * self.overlap // max(self.length(text), 1)
+        space = text.find(' ', cut)
+        return text[space + 1 if 0 <= space < len(text) - 1 else cut:].strip()
+
+    def _merge_small(self, chunks: List[Chunk]) -> List[Chunk]:
+        """相邻两个 chunk 有一个过短时合并 (合并后不超过上限)，标题路径取两者的公共前缀"""
+        merged: List[Chunk] = []
+        for headings, content in chunks:
+            if merged and min(self.length(merged[-1][1]), self.length(content)) < self.min_size:
+                if self._try_merge(merged, headings, content):
+                    continue
+            merged.append((headings, content))
+        return merged
+
+    def _try_merge(self, merged: List[Chunk], headings: List[str], content: str) -> bool:
+        prev_headings, prev = merged[-1]
+        combined = f"{prev}\n\n{content}"
+        if self.length(combined) > self.max_size:
+            return False
+        common = []
+        for a, b in zip(prev_headings, headings):
+            if a != b:
+                break
+            common.append(a)
+        merged[-1] = (common, combined)
+        return True
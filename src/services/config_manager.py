@@ -18,7 +18,13 @@ class ConfigManager:
         "temperature": 0.1,
         "top_k": 10,
         "data_dir": "data",
-        "chm_source_dir": "chm_source"
+        "chm_source_dir": "chm_source",
+        # LLM 回复缓存: 相同问题 (同模型、同提示词输入) 直接复用上次的回复
+        "llm_cache_enabled": True,
+        "llm_cache_ttl_hours": 168,
+        "llm_cache_max_entries": 5000,
+        # 拼入提示词的对话历史的 token 上限
+        "history_token_budget": 1500
     }
 
     def __init__(self):
@@ -51,6 +57,10 @@ class ConfigManager:
         with open(self.settings_file, 'w', encoding='utf-8') as f:
             json.dump(self.settings, f, ensure_ascii=False, indent=2)
 
+    @property
+    def llm_cache_path(self) -> Path:
+        return self.data_dir / "llm_cache.sqlite3"
+
     def get(self, key: str):
         return self.settings.get(key, self.DEFAULT_SETTINGS.get(key))
 
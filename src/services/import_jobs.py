@@ -0,0 +1,216 @@
+"""
+模块: Import Jobs
+CHM 导入任务队列。每个导入是一个带 job id 的任务，拥有独立的工作目录 (data/imports/{job_id})，
+由有界线程池执行: 分析 -> 打包到库 -> 建索引/增量更新，并实时汇报进度。
+只有来源相同 (同一路径或内容哈希相同) 或显式指定目标库的导入才视为重新导入，文件名相同不算；
+同一个库的导入按提交顺序串行，不同库之间互不干扰。
+"""
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from src.services.chm_processor import CHMProcessor
+from src.services.index_builder import IndexBuilder
+from src.services.library_manager import library_manager
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ImportJob:
+    id: str
+    file_path: str
+    title: str
+    # queued -> analyzing -> packaging -> indexing -> done / failed
+    status: str = "queued"
+    pages_total: int = 0
+    pages_done: int = 0
+    chunks: int = 0
+    bytes_done: int = 0
+    indexed: int = 0
+    # 显式指定的重新导入目标库，为空时按来源匹配
+    lib_id: Optional[str] = None
+    is_update: bool = False
+    stats: Dict = field(default_factory=dict)
+    error: str = ""
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    @property
+    def progress(self) -> float:
+        """0~1 的整体进度: 打包阶段按节点数，建索引阶段按已索引 chunk 数"""
+        if self.status == "done":
+            return 1.0
+        if self.status == "indexing":
+            return 0.5 + 0.5 * self.indexed / max(self.chunks, 1)
+        if self.status == "packaging":
+            return 0.5 * self.pages_done / max(self.pages_total, 1)
+        return 0.0
+
+
+class ImportJobManager:
+    def __init__(self, data_root: str = "data", max_workers: int = 2, max_pending: int = 16,
+                 max_finished: int = 32):
+        self.jobs_dir = Path(data_root) / "imports"
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        # 已结束的任务只保留最近的若干个，长时间运行时任务表不随导入次数增长
+        self.max_finished = max_finished
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="import")
+        self._jobs: Dict[str, ImportJob] = {}
+        self._lock = threading.Lock()
+        # 匹配/创建目标库时持有，保证同一来源并发导入只建一个库
+        self._resolve_lock = threading.Lock()
+        self._lib_locks: Dict[str, threading.Lock] = {}
+        self._listeners: List[Callable[[ImportJob], None]] = []
+        # 并发导入平分 CPU，避免每个任务都各开满核的进程池
+        self._workers_per_job = max(1, ((os.cpu_count() or 2) - 1) // max_workers)
+        self.index_builder = IndexBuilder(workers=self._workers_per_job)
+
+    def subscribe(self, listener: Callable[[ImportJob], None]):
+        """注册进度监听，在工作线程中以任务对象调用"""
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable[[ImportJob], None]):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def submit(self, file_path: str, lib_id: Optional[str] = None) -> ImportJob:
+        """排队一个 CHM 导入 (lib_id 为重新导入的目标库)，队列已满时抛出 RuntimeError"""
+        with self._lock:
+            pending = sum(1 for j in self._jobs.values() if not j.finished)
+            if pending >= self.max_pending:
+                raise RuntimeError(f"导入队列已满 ({pending} 个任务进行中)")
+            title = os.path.splitext(os.path.basename(file_path))[0]
+            job = ImportJob(id=uuid.uuid4().hex[:12], file_path=os.path.abspath(file_path), title=title,
+                            lib_id=lib_id)
+            self._jobs[job.id] = job
+        self._notify(job)
+        self._pool.submit(self._run, job)
+        return job
+
+    def get_job(self, job_id: str) -> Optional[ImportJob]:
+        return self._jobs.get(job_id)
+
+    def get_jobs(self) -> List[ImportJob]:
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: j.created_at)
+
+    def clear_finished(self, keep: int = 0):
+        """移除已结束的任务，保留最近结束的 keep 个"""
+        with self._lock:
+            finished = sorted((j for j in self._jobs.values() if j.finished), key=lambda j: j.finished_at)
+            for job in finished[:len(finished) - keep]:
+                del self._jobs[job.id]
+
+    def _notify(self, job: ImportJob):
+        for listener in list(self._listeners):
+            try:
+                listener(job)
+            except Exception as e:
+                logger.warning(f"导入进度回调出错: {e}")
+
+    def _update(self, job: ImportJob, **kwargs):
+        for k, v in kwargs.items():
+            setattr(job, k, v)
+        self._notify(job)
+
+    def _run(self, job: ImportJob):
+        work_dir = self.jobs_dir / job.id
+        work_dir.mkdir(parents=True, exist_ok=True)
+        processor = CHMProcessor(work_dir=str(work_dir))
+        created = False
+        try:
+            created = self._resolve_library(job)
+            # 同一个库的重新导入需要基于上一次的结果做增量，必须串行
+            with self._lib_locks.setdefault(job.lib_id, threading.Lock()):
+                self._import(job, processor)
+            self._update(job, status="done", finished_at=time.time())
+        except Exception as e:
+            logger.exception(f"[import {job.id}] 导入失败: {job.file_path}")
+            if created and not library_manager.get_library_stats(job.lib_id).get("doc_count"):
+                # 本次新建、尚未写入任何内容的库不保留
+                library_manager.delete_library(job.lib_id)
+            self._update(job, status="failed", error=str(e), finished_at=time.time())
+        finally:
+            processor.cleanup()
+            shutil.rmtree(work_dir, ignore_errors=True)
+            self.clear_finished(keep=self.max_finished)
+
+    @staticmethod
+    def _file_hash(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _resolve_library(self, job: ImportJob) -> bool:
+        """
+        确定导入的目标库: 显式指定的库，或来源路径/内容哈希与本文件一致的库；都没有时新建。
+        返回是否新建了库。
+        """
+        source_hash = self._file_hash(job.file_path)
+        with self._resolve_lock:
+            libs = library_manager.get_libraries()
+            if job.lib_id:
+                if not any(l["id"] == job.lib_id for l in libs):
+                    raise Exception(f"规则库不存在: {job.lib_id}")
+                existing = job.lib_id
+            else:
+                existing = next((l["id"] for l in libs if l.get("source_sha256") == source_hash), None) \
+                    or next((l["id"] for l in libs if l.get("source_path") == job.file_path), None)
+            created = existing is None
+            lib_id = library_manager.create_library(job.title) if created else existing
+            library_manager.update_metadata(lib_id, source_path=job.file_path, source_sha256=source_hash)
+        self._update(job, lib_id=lib_id, is_update=not created)
+        return created
+
+    def _import(self, job: ImportJob, processor: CHMProcessor):
+        # 重新导入: 沿用已记录的编码 (仍会校验)
+        meta = next((l for l in library_manager.get_libraries() if l["id"] == job.lib_id), {})
+        self._update(job, status="analyzing")
+        config = processor.process_chm(job.file_path, encoding=meta.get("encoding") if job.is_update else None)
+        if not config:
+            raise Exception("CHM 分析失败")
+
+        # 分析 -> 打包到库 -> 建索引；重新导入只增量更新变化的 chunk
+        lib_id = job.lib_id
+        library_manager.update_metadata(lib_id, encoding=processor.detected_encoding)
+        self._update(job, status="packaging")
+
+        def on_package(pages_done, pages_total, chunks, bytes_done):
+            self._update(job, pages_done=pages_done, pages_total=pages_total, chunks=chunks, bytes_done=bytes_done)
+
+        processor.generate_library(str(library_manager.get_library_path(lib_id)),
+                                   workers=self._workers_per_job, progress_callback=on_package)
+
+        def on_index(done, rate):
+            self._update(job, indexed=done)
+
+        self._update(job, status="indexing")
+        if job.is_update:
+            stats = self.index_builder.update_library(lib_id, on_index)
+        else:
+            stats = self.index_builder.build_library(lib_id, on_index)
+        job.stats = stats
+        logger.info(f"[import {job.id}] 完成: {job.title} {stats}")
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+
+
+# 全局单例
+import_jobs = ImportJobManager()
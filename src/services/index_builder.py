@@ -0,0 +1,228 @@
+"""
+模块: Index Builder
+rules_data.jsonl -> vector_store/ 的建索引流程:
+流式读取条目 -> 进程池 jieba 分词 -> SegmentWriter 分批落盘 -> 原子替换旧索引。
+重新导入时按 chunk key 增量更新: 只为变化的 chunk 建新段，其余打删除标记，后台合并。
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from src.core.index_store import ChunkKeyer, IndexStore, SegmentWriter, content_hash
+from src.core.retriever import load_user_dict, tokenize
+from src.services import rules_data
+from src.services.library_manager import library_manager
+from src.services.rules_data import RulesReader
+
+logger = logging.getLogger(__name__)
+
+
+def _init_worker():
+    load_user_dict()
+
+
+def _tokenize_batch(texts: List[str]) -> List[List[str]]:
+    return [tokenize(t) for t in texts]
+
+
+def entry_to_document(entry: Dict, lib_title: str = "") -> Dict:
+    """rules_data 条目 -> 检索文档 (page_content + metadata)"""
+    return {
+        "page_content": entry.get("content", ""),
+        "metadata": {
+            "full_path": entry.get("title", ""),
+            "source": entry.get("source", ""),
+            "source_title": lib_title,
+            # chunk 在页面内所处的标题路径
+            "headings": entry.get("headings", []),
+        }
+    }
+
+
+class IndexBuilder:
+    def __init__(self, workers: Optional[int] = None, batch_size: int = 256):
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.batch_size = batch_size
+        # 后台合并线程挂在 store 上，保留引用直到合并结束
+        self._stores: Dict[str, IndexStore] = {}
+
+    def _library(self, lib_id: str) -> Tuple[Path, RulesReader, str]:
+        lib_path = library_manager.get_library_path(lib_id)
+        if not lib_path:
+            raise Exception(f"规则库不存在: {lib_id}")
+        if not rules_data.exists(str(lib_path)):
+            raise Exception(f"未找到规则数据: {lib_path}")
+        lib_title = next((l.get("title", "") for l in library_manager.get_libraries() if l.get("id") == lib_id), "")
+        return lib_path, RulesReader(str(lib_path)), lib_title
+
+    def build_library(self, lib_id: str, progress_callback: Callable[[int, float], None] = None) -> Dict:
+        """
+        为指定库重建索引，返回统计信息。
+        progress_callback(已处理条目数, 当前吞吐 chunks/sec)
+        """
+        lib_path, rules, lib_title = self._library(lib_id)
+
+        # 先写到临时目录，完成后再替换，避免检索端读到半成品
+        index_dir = lib_path / "vector_store"
+        staging_dir = lib_path / "vector_store.building"
+        if staging_dir.exists():
+            shutil.rmtree(staging_dir)
+
+        old_store = self._stores.pop(str(index_dir), None)
+        if old_store is not None:
+            old_store.wait_for_merge()
+            old_store.close()
+
+        store = IndexStore(str(staging_dir))
+        name, seg_dir = store.new_segment()
+        stats = self.build(self._keyed(iter(rules), lib_title), seg_dir, progress_callback)
+        store.commit([name])
+        store.close()
+        self._swap_dirs(str(staging_dir), str(index_dir))
+
+        library_manager.update_metadata(lib_id, doc_count=stats["doc_count"], build_seconds=stats["elapsed"],
+                                        indexed_at=time.time())
+        return stats
+
+    def update_library(self, lib_id: str, progress_callback: Callable[[int, float], None] = None) -> Dict:
+        """
+        按 chunk key 对比 rules_data 与现有索引，只为新增或内容变化的 chunk 分词建段，
+        消失或被替换的 chunk 打删除标记，提交后按需在后台合并段。
+        """
+        lib_path, rules, lib_title = self._library(lib_id)
+        index_dir = lib_path / "vector_store"
+        if not IndexStore.exists(str(index_dir)):
+            return self.build_library(lib_id, progress_callback)
+
+        store = self._stores.get(str(index_dir))
+        if store is None:
+            store = self._stores[str(index_dir)] = IndexStore(str(index_dir))
+        # 合并会改写段名与 doc_id，必须在其完成后再计算差异
+        store.wait_for_merge()
+        store.refresh()
+
+        existing = store.live_chunks()
+        deletes: Dict[str, List[int]] = {}
+        unchanged = replaced = 0
+
+        def changed_entries():
+            nonlocal unchanged, replaced
+            for key, doc in self._keyed(iter(rules), lib_title):
+                old = existing.pop(key, None)
+                if old is not None:
+                    seg_name, doc_id, digest = old
+                    if digest == content_hash(doc["page_content"]):
+                        unchanged += 1
+                        continue
+                    deletes.setdefault(seg_name, []).append(doc_id)
+                    replaced += 1
+                yield key, doc
+
+        name, seg_dir = store.new_segment()
+        stats = self.build(changed_entries(), seg_dir, progress_callback)
+        # 剩下的 key 在新数据中已不存在
+        for seg_name, doc_id, _ in existing.values():
+            deletes.setdefault(seg_name, []).append(doc_id)
+
+        if stats["doc_count"]:
+            store.commit([name], deletes)
+        else:
+            shutil.rmtree(seg_dir, ignore_errors=True)
+            if deletes:
+                store.commit([], deletes)
+        store.maybe_merge_async()
+
+        stats.update({
+            "added": stats["doc_count"] - replaced,
+            "replaced": replaced,
+            "deleted": sum(len(ids) for ids in deletes.values()) - replaced,
+            "unchanged": unchanged,
+            "doc_count": len(store),
+        })
+        logger.info(f"索引增量更新: +{stats['added']} ~{stats['replaced']} -{stats['deleted']} "
+                    f"={stats['unchanged']}")
+        library_manager.update_metadata(lib_id, doc_count=stats["doc_count"], build_seconds=stats["elapsed"],
+                                        indexed_at=time.time())
+        return stats
+
+    def build(self, entries: Iterator[Tuple[str, Dict]], seg_dir: str,
+              progress_callback: Callable[[int, float], None] = None) -> Dict:
+        """把 (chunk key, 文档) 序列写成一个段"""
+        start = time.time()
+        writer = SegmentWriter(seg_dir)
+
+        # 建索引在导入线程中进行，fork 出的子进程可能继承其他线程持有的锁，改用 spawn
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker) as pool:
+            # 同时在途的批次数有上限，内存占用不随语料规模增长
+            pending = deque()
+            for batch in self._batches(entries):
+                pending.append((batch, pool.submit(_tokenize_batch, [self._index_text(d) for _, d in batch])))
+                if len(pending) >= self.workers * 2:
+                    self._consume(pending.popleft(), writer, start, progress_callback)
+            while pending:
+                self._consume(pending.popleft(), writer, start, progress_callback)
+
+        writer.close()
+
+        elapsed = time.time() - start
+        doc_count = len(writer)
+        stats = {
+            "doc_count": doc_count,
+            "elapsed": elapsed,
+            "chunks_per_sec": doc_count / elapsed if elapsed > 0 else 0.0,
+        }
+        logger.info(f"索引构建完成: {doc_count} chunks, {elapsed:.1f}s, {stats['chunks_per_sec']:.0f} chunks/sec")
+        return stats
+
+    @staticmethod
+    def _keyed(entries: Iterator[Dict], lib_title: str) -> Iterator[Tuple[str, Dict]]:
+        keyer = ChunkKeyer()
+        for entry in entries:
+            doc = entry_to_document(entry, lib_title)
+            yield keyer.key(doc["metadata"]["source"], doc["metadata"]["full_path"]), doc
+
+    def _batches(self, entries: Iterator[Tuple[str, Dict]]) -> Iterator[List[Tuple[str, Dict]]]:
+        batch = []
+        for item in entries:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _index_text(doc: Dict) -> str:
+        # 标题同样参与检索
+        return f"{doc['metadata']['full_path']}\n{doc['page_content']}"
+
+    @staticmethod
+    def _consume(item, writer: SegmentWriter, start: float, progress_callback):
+        batch, future = item
+        for (key, doc), tokens in zip(batch, future.result()):
+            writer.add(key, tokens, doc["page_content"], doc["metadata"])
+
+        done = len(writer)
+        elapsed = time.time() - start
+        rate = done / elapsed if elapsed > 0 else 0.0
+        if progress_callback:
+            progress_callback(done, rate)
+        logger.debug(f"已索引 {done} chunks ({rate:.0f} chunks/sec)")
+
+    @staticmethod
+    def _swap_dirs(staging_dir: str, index_dir: str):
+        old_dir = index_dir + ".old"
+        if os.path.exists(old_dir):
+            shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.exists(index_dir):
+            os.rename(index_dir, old_dir)
+        os.rename(staging_dir, index_dir)
+        # Windows 下旧索引可能仍被检索端 mmap 占用，删除失败留待下次清理
+        shutil.rmtree(old_dir, ignore_errors=True)
@@ -1,11 +1,23 @@
 import json
 import shutil
+import threading
 import time
 import uuid
 import os
 from pathlib import Path
 from typing import List, Dict, Optional
 
+from src.services import rules_data
+from src.services.rules_data import RulesReader
+
+
+def _write_json_atomic(path: Path, data, indent: Optional[int] = None):
+    """先写临时文件再替换，读者不会看到写了一半的内容"""
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+    os.replace(tmp_path, path)
+
 
 class LibraryManager:
     """
@@ -14,29 +26,127 @@ class LibraryManager:
     data/libraries/
       ├── {lib_id}/
       │    ├── metadata.json
-      │    ├── rules_data.json  <-- 原始内容 (用于查看)
+      │    ├── rules_data.jsonl <-- 原始内容 (用于查看，附 offsets/index 随机访问)
       │    └── vector_store/    <-- 索引 (用于检索)
+      └── catalog.json          <-- 目录缓存: 各库元数据与统计 (文档数、索引大小、索引代号、构建耗时)
+
+    目录缓存按 metadata.json 与索引 manifest 的修改时间失效，列出规则库时只需读一个小文件、
+    对每个库 stat 两次，只有变化过的库才重新解析元数据与统计索引。
     """
+    CATALOG_FILE = "catalog.json"
+    CATALOG_VERSION = 1
 
     def __init__(self, data_root: str = "data"):
         self.root = Path(data_root)
         self.libs_dir = self.root / "libraries"
         self.libs_dir.mkdir(parents=True, exist_ok=True)
+        # 导入任务在多个线程中更新元数据
+        self._lock = threading.RLock()
+        self._catalog: Optional[Dict] = None
+        self._catalog_mtime = None
 
     def get_libraries(self) -> List[Dict]:
-        """获取所有可用规则库的元数据"""
-        libs = []
-        for d in self.libs_dir.iterdir():
-            if d.is_dir():
-                meta_path = d / "metadata.json"
-                if meta_path.exists():
-                    try:
-                        with open(meta_path, 'r', encoding='utf-8') as f:
-                            libs.append(json.load(f))
-                    except Exception:
-                        continue
+        """获取所有可用规则库的元数据 (附 stats)"""
+        with self._lock:
+            entries = self._refresh_catalog()
+            libs = [dict(e["meta"], stats=dict(e["stats"])) for e in entries.values()]
         return sorted(libs, key=lambda x: x.get("created_at", 0), reverse=True)
 
+    def get_library_stats(self, lib_id: str) -> Dict:
+        with self._lock:
+            entry = self._refresh_catalog().get(lib_id)
+        return dict(entry["stats"]) if entry else {}
+
+    # === 目录缓存 ===
+
+    @staticmethod
+    def _mtime(path: Path) -> Optional[int]:
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load_catalog(self) -> Dict:
+        """读取目录缓存文件；文件未变化时沿用内存中的副本"""
+        path = self.libs_dir / self.CATALOG_FILE
+        mtime = self._mtime(path)
+        if self._catalog is not None and mtime == self._catalog_mtime:
+            return self._catalog
+        catalog = {"version": self.CATALOG_VERSION, "libraries": {}}
+        if mtime is not None:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get("version") == self.CATALOG_VERSION:
+                    catalog = data
+            except Exception:
+                pass
+        self._catalog, self._catalog_mtime = catalog, mtime
+        return catalog
+
+    def _refresh_catalog(self) -> Dict[str, Dict]:
+        """按修改时间校验每个库的缓存条目，有变化才重建，返回 lib_id -> 条目"""
+        catalog = self._load_catalog()
+        entries = catalog["libraries"]
+        changed = False
+        seen = set()
+        with os.scandir(self.libs_dir) as it:
+            for d in it:
+                if not d.is_dir():
+                    continue
+                lib_path = Path(d.path)
+                meta_mtime = self._mtime(lib_path / "metadata.json")
+                if meta_mtime is None:
+                    continue
+                manifest_mtime = self._mtime(lib_path / "vector_store" / "manifest.json")
+                entry = entries.get(d.name)
+                if entry is None or entry["meta_mtime"] != meta_mtime or entry["manifest_mtime"] != manifest_mtime:
+                    entry = self._catalog_entry(lib_path, meta_mtime, manifest_mtime)
+                    if entry is None:
+                        continue
+                    entries[d.name] = entry
+                    changed = True
+                seen.add(d.name)
+        for lib_id in set(entries) - seen:
+            del entries[lib_id]
+            changed = True
+        if changed:
+            path = self.libs_dir / self.CATALOG_FILE
+            _write_json_atomic(path, catalog)
+            self._catalog_mtime = self._mtime(path)
+        return entries
+
+    @staticmethod
+    def _catalog_entry(lib_path: Path, meta_mtime: int, manifest_mtime: Optional[int]) -> Optional[Dict]:
+        try:
+            with open(lib_path / "metadata.json", 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except Exception:
+            return None
+        index_dir = lib_path / "vector_store"
+        index_size = 0
+        for root, _, files in os.walk(index_dir):
+            for name in files:
+                try:
+                    index_size += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        index_version = None
+        if manifest_mtime is not None:
+            try:
+                with open(index_dir / "manifest.json", 'r', encoding='utf-8') as f:
+                    index_version = json.load(f).get("generation")
+            except Exception:
+                pass
+        stats = {
+            "doc_count": meta.get("doc_count", 0),
+            "index_size": index_size,
+            "index_version": index_version,
+            "build_seconds": meta.get("build_seconds"),
+            "indexed_at": meta.get("indexed_at"),
+        }
+        return {"meta": meta, "stats": stats, "meta_mtime": meta_mtime, "manifest_mtime": manifest_mtime}
+
     def create_library(self, title: str, description: str = "") -> str:
         """创建新库"""
         lib_id = str(uuid.uuid4())[:8]
@@ -68,29 +178,28 @@ class LibraryManager:
     def update_metadata(self, lib_id: str, **kwargs):
         lib_path = self.libs_dir / lib_id
         meta_path = lib_path / "metadata.json"
-        if meta_path.exists():
-            with open(meta_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            data.update(kwargs)
-            self._save_meta(lib_id, data)
+        # 读-改-写在锁内完成，避免并发的导入任务互相覆盖字段
+        with self._lock:
+            if meta_path.exists():
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                data.update(kwargs)
+                self._save_meta(lib_id, data)
 
     def _save_meta(self, lib_id: str, data: Dict):
         lib_path = self.libs_dir / lib_id
-        with open(lib_path / "metadata.json", "w", encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        _write_json_atomic(lib_path / "metadata.json", data, indent=2)
 
     def load_rules_data(self, lib_id: str, limit: int = 100) -> List[Dict]:
         """
-        读取 rules_data.json 的前 N 条数据用于预览
+        读取规则数据的前 N 条用于预览 (只读取需要的行，旧版 rules_data.json 会先自动迁移)
         """
-        json_path = self.libs_dir / lib_id / "rules_data.json"
-        if not json_path.exists():
+        lib_path = self.libs_dir / lib_id
+        if not rules_data.exists(str(lib_path)):
             return []
 
         try:
-            with open(json_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return data[:limit]  # 只返回前N条防止卡顿
+            return RulesReader(str(lib_path)).head(limit)  # 只返回前N条防止卡顿
         except Exception:
             return []
 
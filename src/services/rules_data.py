@@ -0,0 +1,236 @@
+"""
+模块: Rules Data
+规则库原始条目 (rules_data) 的流式读写。
+
+磁盘格式 (库目录下):
+  rules_data.jsonl[.gz|.zst]  每行一个条目；压缩时每 block_size 行为一个独立的压缩帧
+  rules_data.offsets.npy      每个块在文件中的起始偏移 (末尾附文件长度)
+  rules_data.index.json       版本号、文件名、压缩方式、块大小与条目数，最后写入，存在即代表数据完整
+
+写入时数据与偏移表先写到同目录的 *.tmp，close 时才替换到位；写入失败或被取消时删除临时文件，
+已有的数据与索引保持不变。
+
+未压缩时块大小为 1，随机访问只读一行；压缩时只解压目标所在的块。
+旧版 rules_data.json (整个 JSON 数组) 在首次读取时自动迁移。
+"""
+import gzip
+import json
+import os
+import re
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DATA_NAME = "rules_data.jsonl"
+OFFSETS_FILE = "rules_data.offsets.npy"
+INDEX_FILE = "rules_data.index.json"
+LEGACY_FILE = "rules_data.json"
+FORMAT_VERSION = 1
+
+COMPRESSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+COMPRESSED_BLOCK_SIZE = 256
+
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_json_array(path: str, read_size: int = 1 << 20) -> Iterator[Dict]:
+    """逐个解析 JSON 数组中的元素，不把整个文件读入内存"""
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        buf = f.read(read_size)
+        pos = _SEPARATORS.match(buf).end()
+        if not buf.startswith('[', pos):
+            raise ValueError(f"{path} is not a JSON array")
+        pos += 1
+        eof = False
+        while True:
+            pos = _SEPARATORS.match(buf, pos).end()
+            if buf.startswith(']', pos):
+                return
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(read_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            yield item
+
+
+def _compress(data: bytes, compression: Optional[str]) -> bytes:
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def _decompress(data: bytes, compression: Optional[str]) -> bytes:
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def exists(lib_dir: str) -> bool:
+    return (os.path.exists(os.path.join(lib_dir, INDEX_FILE))
+            or os.path.exists(os.path.join(lib_dir, LEGACY_FILE)))
+
+
+class RulesWriter:
+    """逐条写入条目，不在内存中累积；close 时写出偏移表与索引文件"""
+
+    def __init__(self, lib_dir: str, compression: Optional[str] = None):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unsupported compression: {compression}")
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("zstd 压缩需要安装 zstandard")
+        os.makedirs(lib_dir, exist_ok=True)
+        self.lib_dir = lib_dir
+        self.compression = compression
+        self.block_size = COMPRESSED_BLOCK_SIZE if compression else 1
+        self.file_name = DATA_NAME + COMPRESSIONS[compression]
+        self.count = 0
+
+        # 写入期间旧数据保持可读，close 时才替换
+        self._f = open(self._tmp_path(self.file_name), 'wb')
+        self._offsets: List[int] = [0]
+        self._block: List[bytes] = []
+
+    def _tmp_path(self, name: str) -> str:
+        return os.path.join(self.lib_dir, name + ".tmp")
+
+    def _remove(self, name: str):
+        path = os.path.join(self.lib_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def write(self, entry: Dict):
+        self._block.append(json.dumps(entry, ensure_ascii=False).encode('utf-8') + b"\n")
+        self.count += 1
+        if len(self._block) >= self.block_size:
+            self._flush_block()
+
+    def write_all(self, entries):
+        for entry in entries:
+            self.write(entry)
+
+    def _flush_block(self):
+        if not self._block:
+            return
+        written = self._f.write(_compress(b"".join(self._block), self.compression))
+        self._offsets.append(self._offsets[-1] + written)
+        self._block = []
+
+    def close(self):
+        self._flush_block()
+        self._f.close()
+        with open(self._tmp_path(OFFSETS_FILE), 'wb') as f:
+            np.save(f, np.array(self._offsets, dtype=np.int64))
+        index = {
+            "version": FORMAT_VERSION,
+            "file": self.file_name,
+            "compression": self.compression,
+            "block_size": self.block_size,
+            "count": self.count,
+        }
+        with open(self._tmp_path(INDEX_FILE), 'w', encoding='utf-8') as f:
+            json.dump(index, f, indent=2)
+
+        # 替换期间旧索引不可用，避免读到新数据配旧偏移表；索引最后替换到位
+        self._remove(INDEX_FILE)
+        os.replace(self._tmp_path(self.file_name), os.path.join(self.lib_dir, self.file_name))
+        os.replace(self._tmp_path(OFFSETS_FILE), os.path.join(self.lib_dir, OFFSETS_FILE))
+        # 清理其他格式的旧数据
+        for suffix in COMPRESSIONS.values():
+            if DATA_NAME + suffix != self.file_name:
+                self._remove(DATA_NAME + suffix)
+        self._remove(LEGACY_FILE)
+        os.replace(self._tmp_path(INDEX_FILE), os.path.join(self.lib_dir, INDEX_FILE))
+
+    def abort(self):
+        """放弃本次写入: 删除临时文件，已有的数据与索引不受影响"""
+        self._f.close()
+        for name in (self.file_name, OFFSETS_FILE, INDEX_FILE):
+            self._remove(name + ".tmp")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class RulesReader:
+    """按偏移表读取条目: 预览与随机访问只读取需要的块"""
+
+    def __init__(self, lib_dir: str):
+        self.lib_dir = lib_dir
+        index_path = os.path.join(lib_dir, INDEX_FILE)
+        # 迁移完成后旧文件即被删除，仍存在说明是新放入的旧格式数据
+        if os.path.exists(os.path.join(lib_dir, LEGACY_FILE)):
+            migrate_legacy(lib_dir)
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(f"未找到规则数据: {lib_dir}")
+
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported rules data version: {index.get('version')}")
+        self.path = os.path.join(lib_dir, index["file"])
+        self.compression = index["compression"]
+        self.block_size = index["block_size"]
+        self.count = index["count"]
+        self.offsets = np.load(os.path.join(lib_dir, OFFSETS_FILE), mmap_mode='r', allow_pickle=False)
+
+    def __len__(self):
+        return self.count
+
+    def _read_blocks(self, f, first: int, last: int) -> Iterator[bytes]:
+        """依次读取 [first, last) 号块并逐行返回"""
+        f.seek(int(self.offsets[first]))
+        for b in range(first, last):
+            data = f.read(int(self.offsets[b + 1] - self.offsets[b]))
+            yield from _decompress(data, self.compression).splitlines()
+
+    def iter_range(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Dict]:
+        stop = self.count if stop is None else min(stop, self.count)
+        if start >= stop:
+            return
+        first, last = start // self.block_size, (stop - 1) // self.block_size + 1
+        skip = start - first * self.block_size
+        with open(self.path, 'rb') as f:
+            for i, line in enumerate(self._read_blocks(f, first, last)):
+                if i < skip:
+                    continue
+                if i - skip >= stop - start:
+                    break
+                yield json.loads(line)
+
+    def __iter__(self) -> Iterator[Dict]:
+        return self.iter_range()
+
+    def head(self, limit: int) -> List[Dict]:
+        return list(self.iter_range(0, limit))
+
+    def get(self, i: int) -> Dict:
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return next(self.iter_range(i, i + 1))
+
+
+def migrate_legacy(lib_dir: str):
+    """把旧版 rules_data.json 流式转换为 JSONL，完成后删除旧文件"""
+    with RulesWriter(lib_dir) as writer:
+        writer.write_all(iter_json_array(os.path.join(lib_dir, LEGACY_FILE)))
@@ -3,68 +3,174 @@
 对应规格书: src/services/session_manager.py
 职责: 负责管理多轮对话。维护 session_id -> AgentInstance 映射(可选)，
       以及持久化对话记录到本地磁盘。
+
+磁盘格式: 每个会话一个只追加的日志 sessions/{id}.jsonl，每行一条记录:
+  {"op": "create", "id", "title", "created_at"}   会话头，总是第一行
+  {"op": "title", "title"}                        标题变更
+  {"op": "message", "message": {...}}             一条消息
+追加一条消息只写一行，与历史长度无关；写到一半崩溃只会留下不完整的最后一行，读取时跳过，
+下次追加前截掉。残缺行或多余的标题记录过多时在加载时压缩 (写临时文件后替换)。
+旧版 {id}.json 在首次加载时迁移。
+
+会话列表由索引 sessions/index.sqlite3 维护 (id、标题、时间、消息数)，
+new_session / add_message / delete_session 时同步更新，列出会话只按页查询索引，不读取日志。
 """
 import json
 import os
+import sqlite3
 import time
 import uuid
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+
+
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated_at DESC);
+"""
 
 
 class SessionManager:
+    # 非消息记录 (会话头以外) 或残缺行超过该数目时压缩日志
+    COMPACT_THRESHOLD = 16
+    INDEX_FILE = "index.sqlite3"
+
     def __init__(self, data_dir: str):
         self.sessions_dir = Path(data_dir) / "sessions"
         self.sessions_dir.mkdir(parents=True, exist_ok=True)
         self.current_session_id: Optional[str] = None
+        # 本进程内已检查过末尾完整性的日志
+        self._tail_checked = set()
+
+        index_path = self.sessions_dir / self.INDEX_FILE
+        is_new = not index_path.exists()
+        self._index = sqlite3.connect(str(index_path), check_same_thread=False, isolation_level=None)
+        self._index.execute("PRAGMA journal_mode=WAL")
+        self._index.execute("PRAGMA synchronous=NORMAL")
+        self._index.executescript(_INDEX_SCHEMA)
+        if is_new:
+            self.rebuild_index()
+
+    def get_all_sessions(self, offset: int = 0, limit: Optional[int] = None) -> List[Dict]:
+        """获取会话的元数据（按时间倒序），可分页"""
+        rows = self._index.execute(
+            "SELECT id, title, updated_at FROM sessions ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+            (-1 if limit is None else limit, offset)).fetchall()
+        return [{"id": sid, "title": title, "updated_at": updated_at} for sid, title, updated_at in rows]
 
-    def get_all_sessions(self) -> List[Dict]:
-        """获取所有会话的元数据（按时间倒序）"""
-        sessions = []
-        for f in self.sessions_dir.glob("*.json"):
+    def count_sessions(self) -> int:
+        return self._index.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def rebuild_index(self):
+        """按会话日志 (及旧版文件) 重建索引"""
+        self._index.execute("DELETE FROM sessions")
+        ids = {f.name.split(".")[0] for f in self.sessions_dir.glob("*.json*")}
+        for session_id in ids:
             try:
-                with open(f, 'r', encoding='utf-8') as file:
-                    data = json.load(file)
-                    sessions.append({
-                        "id": data["id"],
-                        "title": data.get("title", "未命名会话"),
-                        "updated_at": data.get("updated_at", 0)
-                    })
+                self.load_session(session_id, set_current=False)
             except Exception:
                 continue
 
-        return sorted(sessions, key=lambda x: x["updated_at"], reverse=True)
-
     def new_session(self) -> str:
         """创建一个新会话"""
         session_id = str(uuid.uuid4())
         timestamp = time.time()
-        session_data = {
+        header = {
+            "op": "create",
             "id": session_id,
             "title": f"新会话 {time.strftime('%H:%M', time.localtime(timestamp))}",
             "created_at": timestamp,
-            "updated_at": timestamp,
-            "history": []  # List of {role: str, content: str, trace: list}
         }
-        self._save_file(session_id, session_data)
+        self._write_log(session_id, [header])
+        self._index.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, 0)",
+                            (session_id, header["title"], timestamp, timestamp))
         self.current_session_id = session_id
         return session_id
 
-    def load_session(self, session_id: str) -> Dict:
+    def load_session(self, session_id: str, set_current: bool = True) -> Dict:
         """加载指定会话详情"""
-        file_path = self.sessions_dir / f"{session_id}.json"
+        if self._legacy_path(session_id).exists():
+            self._migrate_legacy(session_id)
+        file_path = self._log_path(session_id)
         if not file_path.exists():
             return {}
 
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        data, extra = self._read_log(file_path)
+        if not data:
+            return {}
+        if extra > self.COMPACT_THRESHOLD:
+            self.compact(session_id, data)
+        # 顺带校正索引 (上次追加后可能未来得及更新)
+        self._index.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)",
+                            (session_id, data["title"], data["created_at"], data["updated_at"],
+                             len(data["history"])))
+        if set_current:
             self.current_session_id = session_id
-            return data
+        return data
+
+    def load_messages(self, session_id: str, limit: int = 30,
+                      before: Optional[int] = None) -> Tuple[List[Dict], Optional[int]]:
+        """
+        从日志末尾向前读取最近的 limit 条消息 (早于游标 before)，按时间顺序返回 (消息, 游标)。
+        游标为本页第一条消息在日志中的字节偏移，作为下一页的 before；没有更早的消息时为 None。
+        """
+        if self._legacy_path(session_id).exists():
+            self._migrate_legacy(session_id)
+        file_path = self._log_path(session_id)
+        if not file_path.exists():
+            return [], None
+
+        messages, cursor = [], None
+        with open(file_path, 'rb') as f:
+            end = f.seek(0, os.SEEK_END) if before is None else before
+            for offset, line in self._iter_lines_reverse(f, end):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("op") != "message":
+                    continue
+                if len(messages) == limit:
+                    # 还有更早的消息
+                    return messages[::-1], cursor
+                messages.append(record["message"])
+                cursor = offset
+        return messages[::-1], None
+
+    @staticmethod
+    def _iter_lines_reverse(f, end: int, block: int = 65536):
+        """从 end 向前逐行读取，返回 (行首偏移, 行内容)"""
+        pos, rest = end, b""
+        while pos > 0:
+            start = max(0, pos - block)
+            f.seek(start)
+            lines = (f.read(pos - start) + rest).split(b"\n")
+            offsets, offset = [], start
+            for line in lines:
+                offsets.append(offset)
+                offset += len(line) + 1
+            # 块的第一段可能是被截断的行，留到下一块拼接
+            first = 1 if start > 0 else 0
+            for i in range(len(lines) - 1, first - 1, -1):
+                if lines[i].strip():
+                    yield offsets[i], lines[i]
+            rest = lines[0] if start > 0 else b""
+            pos = start
 
     def add_message(self, session_id: str, role: str, content: str, trace: list = None):
-        """追加消息并保存"""
-        data = self.load_session(session_id)
-        if not data: return
+        """追加消息 (只追加一行日志)"""
+        row = self._index.execute("SELECT message_count FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None:
+            if not self.load_session(session_id, set_current=False):
+                return
+            row = self._index.execute("SELECT message_count FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        count = row[0]
 
         message = {
             "role": role,
@@ -78,23 +184,118 @@ class SessionManager:
                 for t in trace
             ]
 
-        data["history"].append(message)
-        data["updated_at"] = time.time()
-
+        records = [{"op": "message", "message": message}]
         # 自动更新标题 (如果是第一条用户消息)
-        if role == "user" and len(data["history"]) <= 2:
-            data["title"] = content[:20].strip()
+        if role == "user" and count < 2:
+            records.append({"op": "title", "title": content[:20].strip()})
 
-        self._save_file(session_id, data)
+        self._append(session_id, records)
+        title = records[1]["title"] if len(records) > 1 else None
+        self._index.execute("UPDATE sessions SET title = COALESCE(?, title), updated_at = ?, message_count = ? "
+                            "WHERE id = ?", (title, message["timestamp"], count + 1, session_id))
 
     def delete_session(self, session_id: str):
-        file_path = self.sessions_dir / f"{session_id}.json"
-        if file_path.exists():
-            os.remove(file_path)
-            if self.current_session_id == session_id:
-                self.current_session_id = None
-
-    def _save_file(self, session_id: str, data: Dict):
-        file_path = self.sessions_dir / f"{session_id}.json"
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
\ No newline at end of file
+        for file_path in (self._log_path(session_id), self._legacy_path(session_id)):
+            if file_path.exists():
+                os.remove(file_path)
+        self._index.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        self._tail_checked.discard(session_id)
+        if self.current_session_id == session_id:
+            self.current_session_id = None
+
+    def compact(self, session_id: str, data: Optional[Dict] = None):
+        """把日志重写为会话头 + 消息，去掉多余的标题记录与残缺行"""
+        data = data or self.load_session(session_id, set_current=False)
+        if not data:
+            return
+        header = {"op": "create", "id": data["id"], "title": data["title"], "created_at": data["created_at"]}
+        self._write_log(session_id, [header] + [{"op": "message", "message": m} for m in data["history"]])
+
+    # === 日志读写 ===
+
+    def _log_path(self, session_id: str) -> Path:
+        return self.sessions_dir / f"{session_id}.jsonl"
+
+    def _legacy_path(self, session_id: str) -> Path:
+        return self.sessions_dir / f"{session_id}.json"
+
+    @staticmethod
+    def _read_log(file_path: Path) -> Tuple[Dict, int]:
+        """回放日志，返回 (会话数据, 非消息记录与残缺行的数目)"""
+        data: Dict = {}
+        extra = 0
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    extra += 1
+                    continue
+                op = record.get("op")
+                if op == "message" and data:
+                    data["history"].append(record["message"])
+                    data["updated_at"] = record["message"].get("timestamp", data["updated_at"])
+                elif op == "title" and data:
+                    data["title"] = record["title"]
+                    extra += 1
+                elif op == "create":
+                    data = {
+                        "id": record["id"],
+                        "title": record["title"],
+                        "created_at": record["created_at"],
+                        "updated_at": record["created_at"],
+                        "history": []  # List of {role: str, content: str, trace: list}
+                    }
+        return data, extra
+
+    @staticmethod
+    def _encode(records: List[Dict]) -> bytes:
+        return "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode('utf-8')
+
+    def _append(self, session_id: str, records: List[Dict]):
+        file_path = self._log_path(session_id)
+        if self._legacy_path(session_id).exists():
+            self._migrate_legacy(session_id)
+        with open(file_path, 'ab') as f:
+            if session_id not in self._tail_checked:
+                self._repair_tail(f)
+                self._tail_checked.add(session_id)
+            # 追加模式下单次 write 写入完整的记录
+            f.write(self._encode(records))
+
+    @staticmethod
+    def _repair_tail(f, block: int = 65536):
+        """上次写到一半的残缺行截掉，避免与新记录拼成一行"""
+        end = f.seek(0, os.SEEK_END)
+        with open(f.name, 'rb') as r:
+            pos = end
+            while pos > 0:
+                start = max(0, pos - block)
+                r.seek(start)
+                data = r.read(pos - start)
+                if pos == end and data.endswith(b"\n"):
+                    return
+                cut = data.rfind(b"\n")
+                if cut >= 0:
+                    f.truncate(start + cut + 1)
+                    return
+                pos = start
+        f.truncate(0)
+
+    def _write_log(self, session_id: str, records: List[Dict]):
+        """整体重写日志: 先写临时文件再替换，中途崩溃不影响原文件"""
+        file_path = self._log_path(session_id)
+        tmp_path = file_path.with_suffix(".jsonl.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(self._encode(records))
+        os.replace(tmp_path, file_path)
+        self._tail_checked.add(session_id)
+
+    def _migrate_legacy(self, session_id: str):
+        legacy = self._legacy_path(session_id)
+        with open(legacy, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        data.setdefault("created_at", data.get("updated_at", 0))
+        data.setdefault("title", "未命名会话")
+        self.compact(session_id, {**data, "history": data.get("history", [])})
+        os.remove(legacy)
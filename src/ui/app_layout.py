@@ -16,7 +16,7 @@ class AppLayout(ft.Row):
         # 初始化 Views
         self.view_chat = ChatView(page, self.session_manager)
         self.view_data = DataView()
-        self.view_setup = SetupView()
+        self.view_setup = SetupView(on_save=self.view_chat.apply_settings)
 
         # 侧边导航栏
         self.rail = ft.NavigationRail(
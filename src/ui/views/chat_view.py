@@ -1,25 +1,48 @@
+import asyncio
+import time
+
 import flet as ft
 from src.services.session_manager import SessionManager
 from src.services.config_manager import config_manager
 from src.services.library_manager import library_manager
 from src.core.llm import create_llm
 from src.core.agent import DndAgentExecutor
+from src.core.llm_cache import LLMCache
 from src.core.retriever import BM25Retriever
+from src.services.agent_runner import agent_runner
+from src.services.agent_pool import AgentPool
 
 
 class ChatView(ft.Container):
+    # 流式输出时两次重绘的最小间隔 (秒)
+    STREAM_UPDATE_INTERVAL = 0.05
+    # 侧边栏每页显示的会话数
+    SESSION_PAGE_SIZE = 50
+    # 打开会话时先显示最近的消息数，更早的在滚动到顶部时按页加载
+    HISTORY_PAGE_SIZE = 30
+
     def __init__(self, page: ft.Page, session_manager: SessionManager):
         super().__init__(expand=True, padding=0)
         self.main_page = page
         self.sm = session_manager
-        self.agent = None
         self.retriever = BM25Retriever()
+        # 每个会话一个执行器，按需创建并从会话记录恢复历史
+        self.agents = AgentPool(session_manager, self.create_agent)
+        self.llm_cache = None
+        self.session_limit = self.SESSION_PAGE_SIZE
+        # 更早消息的游标，None 表示已全部显示
+        self.history_cursor = None
 
         # UI
         self.history_list = ft.ListView(width=250, spacing=2, padding=10)
-        self.chat_area = ft.ListView(expand=True, spacing=15, padding=20, auto_scroll=True)
+        self.chat_area = ft.ListView(expand=True, spacing=15, padding=20, auto_scroll=True,
+                                     on_scroll=self.on_chat_scroll)
+        self.older_button = ft.TextButton("加载更早的消息", icon=ft.icons.HISTORY, on_click=self.load_older_messages)
         self.input_field = ft.TextField(hint_text="选择规则库以开始...", expand=True, border_radius=20,
                                         on_submit=self.send_message, disabled=True)
+        # 当前会话有问答进行中时显示，点击取消
+        self.stop_button = ft.IconButton(ft.icons.STOP_CIRCLE, icon_color=ft.colors.RED, tooltip="停止",
+                                         on_click=self.cancel_message, visible=False)
 
         # 稳健写法：Dropdown 初始化
         self.dd_library = ft.Dropdown(
@@ -51,8 +74,9 @@ class ChatView(ft.Container):
 
         main_chat = ft.Column([
             self.chat_area,
-            ft.Container(content=ft.Row([self.input_field, ft.IconButton(ft.icons.SEND, icon_color=ft.colors.BLUE,
-                                                                         on_click=self.send_message)]), padding=10,
+            ft.Container(content=ft.Row([self.input_field, self.stop_button,
+                                         ft.IconButton(ft.icons.SEND, icon_color=ft.colors.BLUE,
+                                                       on_click=self.send_message)]), padding=10,
                          bgcolor=ft.colors.WHITE)
         ], expand=True)
 
@@ -73,8 +97,8 @@ class ChatView(ft.Container):
         lid = self.dd_library.value
         path = library_manager.get_library_path(lid)
         if path:
+            # 所有执行器共用同一个 retriever，切换库后立即生效
             self.retriever.load_index(str(path))
-            if self.agent: self.agent.retriever = self.retriever
             self.input_field.disabled = False
             self.input_field.hint_text = "输入你的问题..."
             self.main_page.snack_bar = ft.SnackBar(ft.Text(f"已加载: {self.dd_library.text}"))
@@ -83,45 +107,111 @@ class ChatView(ft.Container):
 
     def refresh_history(self):
         self.history_list.controls.clear()
-        for s in self.sm.get_all_sessions():
+        for s in self.sm.get_all_sessions(limit=self.session_limit):
             bg = ft.colors.BLUE_100 if s["id"] == self.sm.current_session_id else None
             self.history_list.controls.append(ft.Container(
                 content=ft.Row([ft.Icon(ft.icons.CHAT_BUBBLE, size=16), ft.Text(s["title"], size=14, expand=True)]),
                 padding=10, bgcolor=bg, border_radius=5, on_click=lambda e, sid=s["id"]: self.load_session(sid)
             ))
+        if self.sm.count_sessions() > self.session_limit:
+            self.history_list.controls.append(ft.TextButton("加载更多...", on_click=self.load_more_sessions))
         self.update()
 
+    def load_more_sessions(self, e):
+        self.session_limit += self.SESSION_PAGE_SIZE
+        self.refresh_history()
+
     def create_new_session(self, e):
         sid = self.sm.new_session()
         self.load_session(sid)
 
     def load_session(self, sid):
         self.sm.current_session_id = sid
-        data = self.sm.load_session(sid)
+        messages, self.history_cursor = self.sm.load_messages(sid, self.HISTORY_PAGE_SIZE)
         self.chat_area.controls.clear()
-        for msg in data.get("history", []):
+        if self.history_cursor is not None:
+            self.chat_area.controls.append(self.older_button)
+        for msg in messages:
             self.render_bubble(msg["role"], msg["content"], msg.get("trace"))
+        self.stop_button.visible = agent_runner.is_running(sid)
         self.refresh_history()
         self.update()
 
+    def on_chat_scroll(self, e: ft.OnScrollEvent):
+        if self.history_cursor is not None and e.pixels <= e.min_scroll_extent:
+            self.load_older_messages(e)
+
+    def load_older_messages(self, e):
+        """在顶部插入更早的一页消息"""
+        sid = self.sm.current_session_id
+        if not sid or self.history_cursor is None:
+            return
+        messages, self.history_cursor = self.sm.load_messages(sid, self.HISTORY_PAGE_SIZE, self.history_cursor)
+        rows = [self.build_bubble(msg["role"], msg["content"], msg.get("trace"))[0] for msg in messages]
+        start = 1 if self.chat_area.controls and self.chat_area.controls[0] is self.older_button else 0
+        self.chat_area.controls[start:start] = rows
+        if self.history_cursor is None and start:
+            self.chat_area.controls.pop(0)
+        # 插入旧消息时不要跳到底部
+        self.chat_area.auto_scroll = False
+        self.update()
+        self.chat_area.auto_scroll = True
+
+    @staticmethod
+    def trace_text(trace):
+        return "\n\n".join([f"`{t['type']}` {t['content']}" for t in trace])
+
     def render_bubble(self, role, content, trace=None):
+        """添加一个气泡，返回 (正文 Markdown, 思维链 Markdown 或 None) 以便流式更新"""
+        row, body, trace_md = self.build_bubble(role, content, trace)
+        self.chat_area.controls.append(row)
+        return body, trace_md
+
+    def build_bubble(self, role, content, trace=None):
+        """
+        构建气泡控件，返回 (行, 正文 Markdown, 思维链 Markdown 或 None)。
+        历史消息的思维链在展开时才构建，此时返回的思维链 Markdown 为 None。
+        """
         is_user = role == "user"
         align = ft.MainAxisAlignment.END if is_user else ft.MainAxisAlignment.START
         bg = ft.colors.BLUE_50 if is_user else ft.colors.WHITE
 
-        ctrls = [ft.Markdown(content)]
-        if trace and not is_user:
-            t_txt = "\n\n".join([f"`{t['type']}` {t['content']}" for t in trace])
-            ctrls.insert(0, ft.ExpansionTile(title=ft.Text("思维链", size=12), controls=[
-                ft.Container(ft.Markdown(t_txt), bgcolor=ft.colors.GREY_50, padding=10)]))
+        body = ft.Markdown(content)
+        ctrls = [body]
+        trace_md = None
+        # trace 为空列表表示思维链尚在生成中，同样显示折叠面板
+        if trace is not None and not is_user:
+            tile = ft.ExpansionTile(title=ft.Text("思维链", size=12), controls=[])
+            if trace:
+                tile.on_change = lambda e: self.expand_trace(e, tile, trace)
+            else:
+                trace_md = ft.Markdown("")
+                tile.controls.append(self.trace_container(trace_md))
+            ctrls.insert(0, tile)
+
+        row = ft.Row([ft.Container(ft.Column(ctrls), bgcolor=bg, padding=15, border_radius=10,
+                                   width=600 if not is_user else None)], alignment=align)
+        return row, body, trace_md
+
+    @staticmethod
+    def trace_container(trace_md):
+        return ft.Container(trace_md, bgcolor=ft.colors.GREY_50, padding=10)
 
-        self.chat_area.controls.append(ft.Row([ft.Container(ft.Column(ctrls), bgcolor=bg, padding=15, border_radius=10,
-                                                            width=600 if not is_user else None)], alignment=align))
+    def expand_trace(self, e, tile, trace):
+        """首次展开时才构建思维链 Markdown"""
+        if e.data == "true" and not tile.controls:
+            tile.controls.append(self.trace_container(ft.Markdown(self.trace_text(trace))))
+            tile.update()
 
     def send_message(self, e):
         txt = self.input_field.value
         if not txt: return
         if not self.sm.current_session_id: self.create_new_session(None)
+        if agent_runner.is_running(self.sm.current_session_id):
+            self.main_page.snack_bar = ft.SnackBar(ft.Text("上一个问题还在回答中，可点击停止"))
+            self.main_page.snack_bar.open = True
+            self.main_page.update()
+            return
 
         self.input_field.value = ""
         self.render_bubble("user", txt)
@@ -129,23 +219,59 @@ class ChatView(ft.Container):
         self.update()
         self.main_page.run_task(self.process_ai, txt)
 
-    async def process_ai(self, txt):
-        if not self.agent:
-            cfg = config_manager.load_settings()
-            llm = create_llm(cfg['api_provider'], cfg['api_key'], cfg['model_name'], base_url=cfg['api_base_url'])
-            self.agent = DndAgentExecutor(llm, self.retriever, cfg)
-            self.agent.retriever = self.retriever  # Force update
+    def create_agent(self) -> DndAgentExecutor:
+        """按当前配置新建执行器 (回复缓存在执行器之间共用)"""
+        cfg = config_manager.load_settings()
+        llm = create_llm(cfg['api_provider'], cfg['api_key'], cfg['model_name'], base_url=cfg['api_base_url'])
+        if cfg.get("llm_cache_enabled") and self.llm_cache is None:
+            self.llm_cache = LLMCache(str(config_manager.llm_cache_path),
+                                      max_entries=int(cfg["llm_cache_max_entries"]),
+                                      ttl=float(cfg["llm_cache_ttl_hours"]) * 3600)
+        cache = self.llm_cache if cfg.get("llm_cache_enabled") else None
+        return DndAgentExecutor(llm, self.retriever, cfg, cache=cache)
 
-        try:
-            loader = ft.Text("Thinking...")
-            self.chat_area.controls.append(loader)
-            self.update()
+    def apply_settings(self):
+        """配置保存后调用: 丢弃已有的执行器，下次提问时按新的模型与参数重建；回复缓存就地更新上限与有效期"""
+        self.agents.clear()
+        if self.llm_cache is not None:
+            cfg = config_manager.load_settings()
+            self.llm_cache.max_entries = int(cfg["llm_cache_max_entries"])
+            self.llm_cache.ttl = float(cfg["llm_cache_ttl_hours"]) * 3600
 
-            res = self.agent.invoke(txt)
-            self.chat_area.controls.remove(loader)
+    async def process_ai(self, txt):
+        session_id = self.sm.current_session_id
+        body, trace_md = self.render_bubble("ai", "Thinking...", [])
+        self.stop_button.visible = True
+        self.update()
 
-            self.render_bubble("ai", res.answer, res.trace_log)
-            self.sm.add_message(self.sm.current_session_id, "ai", res.answer, res.trace_log)
+        # 思维链步骤随产生随显示，最终回答逐段追加；刷新频率有上限，避免每个片段都重绘
+        trace, answer, last_update = [], "", 0.0
+        try:
+            agent = self.agents.get(session_id)
+            # 问答在 agent_runner 的线程中执行，这里只接收事件刷新界面
+            async for event in agent_runner.stream(session_id, agent, txt):
+                if event.kind == "step":
+                    trace.append({"type": event.step.step_type, "content": event.step.content})
+                    trace_md.value = self.trace_text(trace)
+                elif event.kind == "token":
+                    answer += event.token
+                    body.value = answer
+                    if time.monotonic() - last_update < self.STREAM_UPDATE_INTERVAL:
+                        continue
+                else:
+                    res = event.result
+                    body.value = res.answer
+                    self.sm.add_message(session_id, "ai", res.answer, res.trace_log)
+                last_update = time.monotonic()
+                self.update()
+        except asyncio.CancelledError:
+            body.value = (answer + "\n\n" if answer else "") + "*(已停止)*"
         except Exception as ex:
-            self.render_bubble("ai", f"Error: {ex}")
-        self.update()
\ No newline at end of file
+            body.value = f"Error: {ex}"
+        if self.sm.current_session_id == session_id:
+            self.stop_button.visible = False
+        self.update()
+
+    def cancel_message(self, e):
+        if self.sm.current_session_id:
+            agent_runner.cancel(self.sm.current_session_id)
\ No newline at end of file
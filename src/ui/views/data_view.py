@@ -1,17 +1,27 @@
+import threading
+
 import flet as ft
-from src.services.chm_processor import CHMProcessor
+from src.services import rules_data
+from src.services.import_jobs import ImportJob, import_jobs
+from src.services.library_manager import library_manager
+from src.services.rules_data import RulesReader
 import os
 
 
 class DataView(ft.UserControl):
+    JOB_STAGES = {"queued": "排队中", "analyzing": "正在分析", "packaging": "正在打包", "indexing": "正在建立索引"}
+
     # 修复：移除 page 参数，避免 "missing 1 required positional argument" 错误
     def __init__(self):
         super().__init__()
         # 注意：此时 self.page 还是 None，不能在这里使用它
-        self.processor = CHMProcessor()
         self.file_picker = ft.FilePicker(on_result=self.on_file_picked)
         self.status_text = ft.Text("", size=12, color=ft.colors.GREY)
         self.rules_list = ft.Column(scroll=ft.ScrollMode.AUTO)
+        # 进行中的导入任务 id -> (状态文本, 进度条, 所在行)；任务结束即移除，结果汇总到 status_text
+        self._job_rows = {}
+        self._jobs_lock = threading.Lock()
+        self.jobs_list = ft.Column(spacing=8)
 
     def did_mount(self):
         """
@@ -23,9 +33,13 @@ class DataView(ft.UserControl):
             self.page.overlay.append(self.file_picker)
             self.page.update()
 
+        import_jobs.subscribe(self.on_job_progress)
         # 加载已有规则
         self.refresh_rules_list()
 
+    def will_unmount(self):
+        import_jobs.unsubscribe(self.on_job_progress)
+
     def build(self):
         return ft.Container(
             padding=20,
@@ -41,7 +55,7 @@ class DataView(ft.UserControl):
                                 icon=ft.icons.ADD,
                                 # 点击触发文件选择
                                 on_click=lambda _: self.file_picker.pick_files(
-                                    allow_multiple=False,
+                                    allow_multiple=True,
                                     allowed_extensions=["chm"]
                                 )
                             )
@@ -49,6 +63,7 @@ class DataView(ft.UserControl):
                     ),
                     ft.Divider(),
                     self.status_text,
+                    self.jobs_list,
                     ft.Container(
                         expand=True,
                         content=self.rules_list
@@ -58,54 +73,86 @@ class DataView(ft.UserControl):
         )
 
     def on_file_picked(self, e: ft.FilePickerResultEvent):
-        """处理文件选择回调"""
+        """处理文件选择回调: 每个 CHM 排队为一个导入任务，进度在后台线程中回调"""
         if not e.files:
             return
 
-        file_path = e.files[0].path
-        self.status_text.value = f"正在处理文件: {os.path.basename(file_path)}... (请查看控制台日志)"
-        self.status_text.color = ft.colors.BLUE
-        self.status_text.update()
+        for f in e.files:
+            try:
+                import_jobs.submit(f.path)
+            except Exception as ex:
+                self.status_text.value = f"发生错误: {str(ex)}"
+                self.status_text.color = ft.colors.RED
+                self.status_text.update()
+                break
 
-        # 异步调用处理器
-        try:
-            success = self.processor.process_chm(file_path)
-            if success:
-                self.status_text.value = f"成功导入: {os.path.basename(file_path)}"
-                self.status_text.color = ft.colors.GREEN
-                self.refresh_rules_list()
-            else:
-                self.status_text.value = "导入失败，请检查 bin 目录下的 7za.exe 是否可用，或查看控制台报错。"
+    def on_job_progress(self, job: ImportJob):
+        """导入任务进度回调 (在导入线程中调用)；任务结束时移除其进度行，结果显示在状态栏"""
+        name = os.path.basename(job.file_path)
+        if job.finished:
+            with self._jobs_lock:
+                row = self._job_rows.pop(job.id, None)
+                if row is not None:
+                    self.jobs_list.controls.remove(row[2])
+            if job.status == "failed":
+                self.status_text.value = f"{name}: 发生错误: {job.error}"
                 self.status_text.color = ft.colors.RED
-        except Exception as ex:
-            self.status_text.value = f"发生错误: {str(ex)}"
-            self.status_text.color = ft.colors.RED
+            else:
+                stats = job.stats
+                summary = f"{stats['doc_count']} 条, {stats['chunks_per_sec']:.0f} chunks/sec"
+                if job.is_update and "unchanged" in stats:
+                    summary += (f"; 新增 {stats['added']}, 更新 {stats['replaced']}, "
+                                f"删除 {stats['deleted']}, 未变 {stats['unchanged']}")
+                self.status_text.value = f"成功导入: {name} ({summary})"
+                self.status_text.color = ft.colors.GREEN
+            if self.page:
+                self.jobs_list.update()
+                self.status_text.update()
+                if job.status == "done":
+                    self.refresh_rules_list()
+            return
+
+        with self._jobs_lock:
+            row = self._job_rows.get(job.id)
+            if row is None:
+                text, bar = ft.Text(size=12), ft.ProgressBar(width=400, value=0)
+                row = self._job_rows[job.id] = (text, bar, ft.Column(spacing=2, controls=[text, bar]))
+                self.jobs_list.controls.append(row[2])
+        text, bar, _ = row
+        bar.value = job.progress
+        text.value = f"{name}: {self.JOB_STAGES.get(job.status, job.status)}"
+        if job.status == "packaging":
+            text.value += (f" {job.pages_done}/{job.pages_total} 页, {job.chunks} 条, "
+                           f"{job.bytes_done / (1024 * 1024):.1f} MB")
+        elif job.status == "indexing":
+            text.value += f" {job.indexed}/{job.chunks} chunks"
+        text.color = ft.colors.BLUE
 
-        self.status_text.update()
+        if self.page:
+            self.jobs_list.update()
 
     def refresh_rules_list(self):
-        """刷新列表显示"""
+        """刷新列表显示: 每个规则库一行，条数与大小取自 rules_data 的索引，不逐行读取数据"""
         self.rules_list.controls.clear()
 
-        data_file = os.path.join(self.processor.output_dir, "knowledge_base.jsonl")
-
-        if os.path.exists(data_file):
+        for lib in library_manager.get_libraries():
+            lib_path = library_manager.get_library_path(lib["id"])
+            if lib_path is None or not rules_data.exists(str(lib_path)):
+                continue
             try:
-                size_mb = os.path.getsize(data_file) / (1024 * 1024)
-                count = 0
-                with open(data_file, 'r', encoding='utf-8') as f:
-                    for _ in f: count += 1
-
+                reader = RulesReader(str(lib_path))
+                size_mb = os.path.getsize(reader.path) / (1024 * 1024)
                 self.rules_list.controls.append(
                     ft.ListTile(
                         leading=ft.Icon(ft.icons.LIBRARY_BOOKS, color=ft.colors.AMBER),
-                        title=ft.Text("Knowledge Base Main"),
-                        subtitle=ft.Text(f"包含 {count} 条规则片段 | 文件大小: {size_mb:.2f} MB"),
+                        title=ft.Text(lib.get("title", lib["id"])),
+                        subtitle=ft.Text(f"包含 {len(reader)} 条规则片段 | 文件大小: {size_mb:.2f} MB"),
                     )
                 )
             except Exception:
-                self.rules_list.controls.append(ft.Text("无法读取规则数据库"))
-        else:
+                self.rules_list.controls.append(ft.Text(f"无法读取规则数据库: {lib.get('title', lib['id'])}"))
+
+        if not self.rules_list.controls:
             self.rules_list.controls.append(
                 ft.Container(
                     content=ft.Text("暂无数据，请点击右上角导入 CHM 规则书", color=ft.colors.GREY_500),
@@ -114,4 +161,4 @@ class DataView(ft.UserControl):
                 )
             )
 
-        self.rules_list.update()
\ No newline at end of file
+        self.rules_list.update()
@@ -1,10 +1,14 @@
 import flet as ft
+from typing import Callable, Optional
 from src.services.config_manager import config_manager
+from src.core.llm_cache import LLMCache
 
 
 class SetupView(ft.Container):
-    def __init__(self):
+    def __init__(self, on_save: Optional[Callable[[], None]] = None):
         super().__init__(expand=True, padding=30)
+        # 配置保存后的回调 (对话页据此按新配置重建执行器)
+        self.on_save = on_save
 
         # 控件
         self.api_provider = ft.Dropdown(
@@ -21,6 +25,10 @@ class SetupView(ft.Container):
         self.model_name = ft.TextField(label="模型名称 (例如 gpt-4o, gemini-2.5-flash)", value="gemini-2.5-flash",
                                        width=400)
         self.temperature = ft.Slider(min=0, max=1, divisions=10, label="温度: {value}", value=0.1, width=400)
+        self.cache_enabled = ft.Switch(label="缓存相同问题的模型回复", value=True)
+        self.cache_ttl = ft.TextField(label="缓存有效期 (小时)", value="168", width=195)
+        self.cache_max = ft.TextField(label="缓存条目上限", value="5000", width=195)
+        self.cache_stats = ft.Text(size=12, color=ft.colors.GREY_700)
 
         self.init_ui()
         self.load_data()
@@ -37,6 +45,11 @@ class SetupView(ft.Container):
             ft.Text("随机性 (Temperature)"),
             self.temperature,
             ft.Divider(),
+            ft.Text("回复缓存", size=20, weight=ft.FontWeight.W_500),
+            self.cache_enabled,
+            ft.Row([self.cache_ttl, self.cache_max], spacing=10),
+            ft.Row([self.cache_stats, ft.TextButton("清空缓存", on_click=self.clear_cache)]),
+            ft.Divider(),
             ft.ElevatedButton("保存配置", icon=ft.icons.SAVE, on_click=self.save_data, height=50, width=150),
         ], scroll=ft.ScrollMode.AUTO)
 
@@ -47,15 +60,60 @@ class SetupView(ft.Container):
         self.base_url.value = settings.get("api_base_url", "")
         self.model_name.value = settings.get("model_name", "gemini-1.5-flash")
         self.temperature.value = settings.get("temperature", 0.1)
+        self.cache_enabled.value = settings.get("llm_cache_enabled", True)
+        self.cache_ttl.value = str(settings.get("llm_cache_ttl_hours", 168))
+        self.cache_max.value = str(settings.get("llm_cache_max_entries", 5000))
+        self.refresh_cache_stats()
+
+    def refresh_cache_stats(self):
+        if not config_manager.llm_cache_path.exists():
+            self.cache_stats.value = "暂无缓存"
+            return
+        cache = LLMCache(str(config_manager.llm_cache_path))
+        try:
+            stats = cache.stats()
+        finally:
+            cache.close()
+        self.cache_stats.value = (f"{stats['entries']} 条缓存，命中 {stats['hits']} / "
+                                  f"{stats['hits'] + stats['misses']} 次 ({stats['hit_rate']:.0%})")
+
+    def clear_cache(self, e):
+        if config_manager.llm_cache_path.exists():
+            cache = LLMCache(str(config_manager.llm_cache_path))
+            try:
+                cache.clear()
+            finally:
+                cache.close()
+        self.refresh_cache_stats()
+        e.page.update()
 
     def save_data(self, e):
+        try:
+            cache_ttl = float((self.cache_ttl.value or "").strip() or 168)
+            cache_max = int((self.cache_max.value or "").strip() or 5000)
+        except ValueError:
+            cache_ttl = cache_max = 0
+        # not (x > 0) 同时排除 nan
+        if not (cache_ttl > 0 and cache_max > 0):
+            self.show_message(e.page, "缓存有效期须为正数 (小时)，缓存条目上限须为正整数", error=True)
+            return
+
         config_manager.save_settings({
             "api_provider": self.api_provider.value,
             "api_key": self.api_key.value,
             "api_base_url": self.base_url.value,
             "model_name": self.model_name.value,
-            "temperature": self.temperature.value
+            "temperature": self.temperature.value,
+            "llm_cache_enabled": self.cache_enabled.value,
+            "llm_cache_ttl_hours": cache_ttl,
+            "llm_cache_max_entries": cache_max
         })
-        e.page.snack_bar = ft.SnackBar(ft.Text("配置已保存！"))
-        e.page.snack_bar.open = True
-        e.page.update()
\ No newline at end of file
+        if self.on_save:
+            self.on_save()
+        self.show_message(e.page, "配置已保存！")
+
+    @staticmethod
+    def show_message(page, text, error=False):
+        page.snack_bar = ft.SnackBar(ft.Text(text), bgcolor=ft.colors.RED_400 if error else None)
+        page.snack_bar.open = True
+        page.update()
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from rank_bm25 import BM25Okapi
+
+from src.core.bm25_index import BM25Index, top_k_indices
+
+VOCAB = [f"w{i}" for i in range(400)]
+
+
+def zipf_corpus(n_docs, seed=0):
+    """词频服从 Zipf 分布的语料，含空文档，高频词与稀有词都有"""
+    rng = np.random.default_rng(seed)
+    probs = 1 / np.arange(1, len(VOCAB) + 1)
+    probs /= probs.sum()
+    return [[VOCAB[i] for i in rng.choice(len(VOCAB), size=rng.integers(0, 80), p=probs)]
+            for _ in range(n_docs)]
+
+
+def queries(seed=1):
+    rng = np.random.default_rng(seed)
+    qs = [
+        ["w0"],
+        ["w3", "w3", "w150"],          # 重复词
+        ["w1", "unknown", "w390"],     # 未登录词
+        ["unknown"],
+        [],
+    ]
+    for _ in range(40):
+        # 高频词 + 稀有词: 走 MaxScore 剪枝
+        qs.append([VOCAB[i] for i in rng.integers(0, 6, 2)] + [VOCAB[i] for i in rng.integers(100, 400, 2)])
+    for _ in range(20):
+        # 大量高频词: 走全量打分
+        qs.append([VOCAB[i] for i in rng.choice(20, 10, replace=False)])
+    return qs
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    return zipf_corpus(3000)
+
+
+@pytest.fixture(scope="module")
+def index(corpus):
+    return BM25Index.build(corpus)
+
+
+def test_get_scores_matches_bm25okapi(corpus, index):
+    model = BM25Okapi(corpus)
+    for q in queries():
+        expected = model.get_scores(q)
+        assert np.allclose(index.get_scores(q), expected, rtol=1e-12, atol=1e-12), q
+
+
+def test_from_bm25okapi(corpus, index):
+    converted = BM25Index.from_bm25okapi(BM25Okapi(corpus))
+    for q in queries():
+        assert np.allclose(converted.get_scores(q), index.get_scores(q), rtol=1e-12, atol=1e-12), q
+
+
+def exhaustive(index, q, k, exclude=None):
+    scores = index.get_scores(q)
+    if exclude is not None:
+        scores[exclude] = 0
+    ids = top_k_indices(scores, k)
+    return ids, scores[ids]
+
+
+@pytest.mark.parametrize("k", [1, 10, 50, 5000])
+def test_top_k_matches_exhaustive(index, k):
+    for q in queries():
+        ids, scores = index.top_k(q, k)
+        ref_ids, ref_scores = exhaustive(index, q, k)
+        assert ids.tolist() == ref_ids.tolist(), q
+        # 剪枝结果按规范顺序重算，与全量打分逐位一致
+        assert np.array_equal(scores, ref_scores), q
+
+
+@pytest.mark.parametrize("k", [5, 20])
+def test_top_k_with_blacklist(index, k):
+    rng = np.random.default_rng(2)
+    exclude = np.zeros(index.corpus_size, dtype=bool)
+    exclude[rng.choice(index.corpus_size, index.corpus_size // 5, replace=False)] = True
+    for q in queries():
+        # 屏蔽未屏蔽时的前几名，迫使门槛估计不能依赖它们
+        exclude_top = exclude.copy()
+        exclude_top[index.top_k(q, k)[0]] = True
+        for mask in (exclude, exclude_top):
+            ids, scores = index.top_k(q, k, exclude=mask)
+            ref_ids, ref_scores = exhaustive(index, q, k, mask)
+            assert not mask[ids].any()
+            assert ids.tolist() == ref_ids.tolist(), q
+            assert np.array_equal(scores, ref_scores), q
+
+
+def test_top_k_ties_prefer_lower_doc_id():
+    index = BM25Index.build([["c"]] * 10 + [["a", "b"]] * 5 + [["c"]] * 10)
+    ids, scores = index.top_k(["a"], 3)
+    assert ids.tolist() == [10, 11, 12]
+    assert len(set(scores.tolist())) == 1
+
+
+def test_save_and_load(tmp_path, corpus, index):
+    index.save(str(tmp_path))
+    assert BM25Index.exists(str(tmp_path))
+    loaded = BM25Index.load(str(tmp_path))
+    for q in queries():
+        assert np.array_equal(loaded.get_scores(q), index.get_scores(q)), q
+        ids, scores = loaded.top_k(q, 10)
+        ref_ids, ref_scores = index.top_k(q, 10)
+        assert ids.tolist() == ref_ids.tolist()
+        assert np.array_equal(scores, ref_scores)
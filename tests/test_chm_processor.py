@@ -0,0 +1,118 @@
+import pytest
+
+from src.services.chm_processor import CHMProcessor, HeadingCounter
+from src.services.chm_reader import DirectorySource
+from src.services.rules_data import RulesReader
+
+HHC = """<html><body><ul>
+<li><object type="text/sitemap"><param name="Name" value="Big"><param name="Local" value="big.htm"></object>
+<ul>
+<li><object type="text/sitemap"><param name="Name" value="Tail"><param name="Local" value="big.htm#tail"></object>
+</ul>
+<li><object type="text/sitemap"><param name="Name" value="Other"><param name="Local" value="other.htm"></object>
+<li><object type="text/sitemap"><param name="Name" value="Other"><param name="Local" value="other2.htm"></object>
+<li><object type="text/sitemap"><param name="Name" value="Web"><param name="Local" value="http://example.com/"></object>
+</ul></body></html>"""
+
+
+def big_page():
+    sections = [f'{"<a name=tail></a>" if i == 10 else ""}<h2>Sec {i}</h2><p>text {i}</p>' for i in range(12)]
+    return "<html><body>" + "".join(sections) + "</body></html>"
+
+
+def sitemap(*nodes):
+    """(名称, Local) 列表 -> 单层 HHC"""
+    items = "".join(f'<li><object type="text/sitemap"><param name="Name" value="{name}">'
+                    f'<param name="Local" value="{local}"></object>' for name, local in nodes)
+    return f"<html><body><ul>{items}</ul></body></html>"
+
+
+def make_processor(tmp_path, hhc, pages):
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "toc.hhc").write_text(hhc, encoding="utf-8")
+    for name, html in pages.items():
+        (source / name).write_text(html, encoding="utf-8")
+    processor = CHMProcessor()
+    processor._source = DirectorySource(str(source))
+    processor._source_spec = ("dir", str(source))
+    processor.config = processor._generate_config_logic("toc.hhc")
+    return processor
+
+
+@pytest.fixture
+def processor(tmp_path):
+    return make_processor(tmp_path, HHC, {"big.htm": big_page(), "other.htm": "<p>other page</p>",
+                                          "other2.htm": "<p>second other page</p>"})
+
+
+def package(processor, tmp_path):
+    processor.generate_library(str(tmp_path / "lib"), workers=1)
+    return [(e["title"], e["source"]) for e in RulesReader(str(tmp_path / "lib"))]
+
+
+def test_tree_processing_rules(processor):
+    rules = processor.config["tree_processing_rules"]
+    assert list(rules) == ["Big", "Big > Tail", "Other", "Other (2)"]
+    assert dict(rules.items()) == {
+        "Big": {"path": "big.htm", "anchor": "", "action": "process", "split_by": "h2"},
+        # 分割策略按节点所在页面决定，不按锚点切片
+        "Big > Tail": {"path": "big.htm", "anchor": "tail", "action": "process", "split_by": "h2"},
+        "Other": {"path": "other.htm", "anchor": "", "action": "process", "split_by": None},
+        "Other (2)": {"path": "other2.htm", "anchor": "", "action": "process", "split_by": None},
+    }
+    assert rules["Other (2)"]["path"] == "other2.htm"
+    with pytest.raises(KeyError):
+        rules["Web"]
+
+
+def test_package_follows_rules(processor, tmp_path):
+    titles = package(processor, tmp_path)
+    assert titles[:10] == [(f"Big - Sec {i}", "big.htm") for i in range(10)]
+    assert titles[10:] == [("Big > Tail - Sec 10", "big.htm"), ("Big > Tail - Sec 11", "big.htm"),
+                           ("Other", "other.htm"), ("Other", "other2.htm")]
+
+
+def test_package_with_modified_rules(processor, tmp_path):
+    rules = processor.config["tree_processing_rules"]
+    rule = rules["Big > Tail"]
+    rule["action"] = "skip"
+    rules["Big > Tail"] = rule
+    rules["Big"] = dict(rules["Big"], split_by=None)
+    del rules["Other (2)"]
+    assert len(rules) == 3 and rules["Big > Tail"]["action"] == "skip"
+
+    titles = package(processor, tmp_path)
+    # 跳过的节点仍是切片边界，其内容不并入前一个节点
+    assert titles == [("Big", "big.htm"), ("Other", "other.htm")]
+
+
+def test_heading_counter_ignores_comments_script_and_cdata():
+    html = ("<H2 class=x>a</H2><h2/><!-- <h1>x</h1> --><script>var s = '<h1>';</script>"
+            "<style>h1 { }</style><![CDATA[<h3>]]><h3>b</h3><header></header><hr>")
+    assert HeadingCounter.count(html) == [0, 2, 1, 0, 0, 0]
+
+
+def test_decoded_pages_are_bounded(processor):
+    processor.DECODED_CACHE = 2
+    for name in ("big.htm", "other.htm", "big.htm", "other2.htm"):
+        processor._read_file_safe(name)
+    assert list(processor._decoded) == ["big.htm", "other2.htm"]
+
+
+def test_formatted_split_headings_are_not_repeated(tmp_path):
+    """html2text 输出的标题带强调、转义与链接语法，与 strip_tags 得到的子标题按规范化文本比较"""
+    body = "".join(f"<h3>Sub {j}</h3><p>{'lorem ipsum ' * 60}</p>" for j in range(3))
+    page = "".join(f"<h2><b>Part {i}</b> &amp; co_op <a href='x.htm'>1.</a></h2>{body}" for i in range(10))
+    processor = make_processor(tmp_path, sitemap(("Fmt", "fmt.htm")), {"fmt.htm": page})
+    titles = [title for title, _ in package(processor, tmp_path)]
+    assert titles[:3] == ["Fmt - Part 0 & co_op 1.", "Fmt - Part 0 & co_op 1. > Sub 1",
+                          "Fmt - Part 0 & co_op 1. > Sub 2"]
+    assert len(set(titles)) == len(titles) == 30
+
+
+def test_duplicate_titles_on_one_page(tmp_path):
+    """同一页面上重名的目录节点: (source, title) 在整个页面内唯一"""
+    hhc = sitemap(("Dup", "dup.htm#a"), ("Dup", "dup.htm#b"))
+    processor = make_processor(tmp_path, hhc, {"dup.htm": "<a name=a></a><p>one</p><a name=b></a><p>two</p>"})
+    assert package(processor, tmp_path) == [("Dup", "dup.htm"), ("Dup (2)", "dup.htm")]
@@ -0,0 +1,454 @@
+"""
+CHMFile 读取测试。夹具 CHM 在测试中生成: 成员放在 MSCompressed 段，由下面的 LZX 编码器压缩，
+每 RESET_FRAMES 帧重置一次。编码器按 BLOCK_PLAN 轮换 verbatim / aligned / 未压缩块 (块可跨帧)，
+用贪心 LZ77 产出匹配 (含重叠复制、R0-R2 重复偏移与窗口回绕)，并可做 Intel E8 转换；
+各条路径实际用到的次数记在 write_chm 返回的统计中，测试据此确认夹具确实覆盖了它们。
+"""
+import random
+import struct
+from collections import Counter
+
+import pytest
+
+from src.services.chm_reader import CHMError, CHMFile, open_source
+
+FRAME_SIZE = 0x8000
+RESET_FRAMES = 4
+CHUNK_SIZE = 512
+
+# 16 位窗口: 32 个位置槽，主树 256 个字面量 + 32 * 8 个匹配符号
+WINDOW_BITS = 16
+WINDOW_SIZE = 1 << WINDOW_BITS
+NUM_SLOTS = 2 * WINDOW_BITS
+MAIN_ELEMENTS = 256 + NUM_SLOTS * 8
+MIN_MATCH, MAX_MATCH = 2, 257
+# 位置槽的额外位数与基准 (格式化偏移 = 偏移 + 2)
+SLOT_EXTRA = [0 if s < 4 else min((s - 2) // 2, 17) for s in range(NUM_SLOTS)]
+SLOT_BASE = [sum(1 << e for e in SLOT_EXTRA[:s]) for s in range(NUM_SLOTS)]
+
+VERBATIM, ALIGNED, UNCOMPRESSED = 1, 2, 3
+# 每个重置区间内依次使用的块类型与长度
+BLOCK_PLAN = [(VERBATIM, 12000), (ALIGNED, 20000), (UNCOMPRESSED, 3001), (ALIGNED, 7000), (VERBATIM, 9000)]
+# 相邻压缩块交替使用两套码长，覆盖码长的差分编码；各树均不超额
+MAIN_LENS = ([9] * MAIN_ELEMENTS, [7] * 64 + [10] * 192 + [10] * (MAIN_ELEMENTS - 256))
+LENGTH_LENS = ([8] * 249, [5] * 8 + [9] * 241)
+ALIGNED_LENS = ([3] * 8, [2, 3, 3, 3, 3, 4, 4, 3])
+
+
+class _BitWriter:
+    """与 _BitReader 对应: 16 位小端字，字内高位在前"""
+
+    def __init__(self):
+        self.out = bytearray()
+        self.acc = 0
+        self.bits = 0
+
+    def write(self, value: int, n: int):
+        for i in range(n - 1, -1, -1):
+            self.acc = (self.acc << 1) | ((value >> i) & 1)
+            self.bits += 1
+            if self.bits == 16:
+                self.out += struct.pack("<H", self.acc)
+                self.acc = self.bits = 0
+
+    def align(self, force: bool = False):
+        """补齐到字边界；force 时已对齐也补一个整字 (未压缩块头之后的规则)"""
+        if self.bits or force:
+            self.write(0, 16 - self.bits)
+
+    def raw(self, data: bytes):
+        assert self.bits == 0
+        self.out += data
+
+    def getvalue(self) -> bytes:
+        self.align()
+        return bytes(self.out)
+
+
+def _canonical_codes(lengths):
+    """范式 Huffman: 按 (码长, 符号) 顺序分配码字，返回 符号 -> (码字, 码长)"""
+    codes, code = {}, 0
+    for bits in range(1, max(lengths) + 1):
+        for sym, n in enumerate(lengths):
+            if n == bits:
+                codes[sym] = (code, bits)
+                code += 1
+        code <<= 1
+    return codes
+
+
+def _write_lengths(bw: _BitWriter, prev, new):
+    """码长差分编码: pretree 的 20 个符号码长都为 5，每个码长写一个符号 (旧 - 新) % 17"""
+    pre_lens = [5] * 20
+    for n in pre_lens:
+        bw.write(n, 4)
+    codes = _canonical_codes(pre_lens)
+    for old, value in zip(prev, new):
+        bw.write(*codes[(old - value) % 17])
+
+
+def _e8_encode(frame: bytes, curpos: int, filesize: int, stats: Counter) -> bytes:
+    """Intel E8 预处理 (解码端的逆变换): E8 之后的相对地址改写为绝对地址"""
+    out = bytearray(frame)
+    if len(out) <= 6:
+        return frame
+    i = 0
+    while i < len(out) - 10:
+        if out[i] != 0xE8:
+            i += 1
+            continue
+        pos = curpos + i
+        rel = struct.unpack_from("<i", out, i + 1)[0]
+        if -pos <= rel < filesize:
+            value = rel + pos if rel < filesize - pos else rel - filesize
+            struct.pack_into("<I", out, i + 1, value & 0xFFFFFFFF)
+            stats["e8"] += 1
+        i += 5
+    return bytes(out)
+
+
+class _LZXEncoder:
+    """按重置区间编码 LZX 流，返回各帧的压缩数据"""
+
+    def __init__(self, e8_filesize: int = 0):
+        self.e8_filesize = e8_filesize
+        self.stats = Counter()
+
+    def encode(self, stream: bytes):
+        frames = []
+        interval = RESET_FRAMES * FRAME_SIZE
+        for start in range(0, len(stream), interval):
+            frames += self._interval(stream[start:start + interval])
+        return frames
+
+    def _interval(self, data: bytes):
+        if self.e8_filesize:
+            data = b"".join(_e8_encode(data[i:i + FRAME_SIZE], i, self.e8_filesize, self.stats)
+                            for i in range(0, len(data), FRAME_SIZE))
+        self.data = data
+        self.frames, self.bw, self.frame_end = [], _BitWriter(), FRAME_SIZE
+        self.R = [1, 1, 1]
+        self.main_lens, self.length_lens = [0] * MAIN_ELEMENTS, [0] * 249
+        self.chains = {}
+        # 区间起点: E8 标志位 (+ 32 位文件大小)
+        if self.e8_filesize:
+            self.bw.write(1, 1)
+            self.bw.write(self.e8_filesize >> 16, 16)
+            self.bw.write(self.e8_filesize & 0xFFFF, 16)
+        else:
+            self.bw.write(0, 1)
+
+        pos, i = 0, 0
+        while pos < len(data):
+            block_type, length = BLOCK_PLAN[i % len(BLOCK_PLAN)]
+            end = min(pos + length, len(data))
+            # 奇数长度的未压缩块不在帧边界结束，补齐字节总在块所在的帧内
+            if block_type == UNCOMPRESSED and end % FRAME_SIZE == 0 and (end - pos) & 1:
+                end -= 1
+            if end <= pos:
+                end = min(pos + length, len(data))
+                block_type = VERBATIM
+            self.stats[("block", block_type)] += 1
+            if (pos // FRAME_SIZE) != ((end - 1) // FRAME_SIZE):
+                self.stats["span"] += 1
+            self._block(block_type, pos, end, i % 2)
+            pos, i = end, i + 1
+        self.frames.append(self.bw.getvalue())
+        return self.frames
+
+    def _next_frame(self, pos):
+        """pos 到达帧边界时结束当前帧，之后的位流写入新帧"""
+        if pos == self.frame_end:
+            self.frames.append(self.bw.getvalue())
+            self.bw = _BitWriter()
+            self.frame_end += FRAME_SIZE
+
+    def _block(self, block_type, start, end, variant):
+        self._next_frame(start)
+        bw = self.bw
+        bw.write(block_type, 3)
+        bw.write((end - start) >> 8, 16)
+        bw.write((end - start) & 0xFF, 8)
+        if block_type == UNCOMPRESSED:
+            bw.align(force=True)
+            bw.raw(struct.pack("<III", *self.R))
+            pos = start
+            while pos < end:
+                self._next_frame(pos)
+                chunk_end = min(end, self.frame_end)
+                self.bw.raw(self.data[pos:chunk_end])
+                pos = chunk_end
+            self.bw.raw(b"\0" * ((end - start) & 1))
+            for p in range(start, end):
+                self._insert(p)
+            return
+
+        aligned_codes = None
+        if block_type == ALIGNED:
+            for n in ALIGNED_LENS[variant]:
+                bw.write(n, 3)
+            aligned_codes = _canonical_codes(ALIGNED_LENS[variant])
+        main_lens, length_lens = MAIN_LENS[variant], LENGTH_LENS[variant]
+        _write_lengths(bw, self.main_lens[:256], main_lens[:256])
+        _write_lengths(bw, self.main_lens[256:], main_lens[256:])
+        _write_lengths(bw, self.length_lens, length_lens)
+        self.main_lens, self.length_lens = list(main_lens), list(length_lens)
+        main_codes, length_codes = _canonical_codes(main_lens), _canonical_codes(length_lens)
+
+        pos = start
+        while pos < end:
+            self._next_frame(pos)
+            bw = self.bw
+            # 匹配不能越过块尾或帧尾
+            length, slot, extra = self._match(pos, min(end, self.frame_end) - pos)
+            if length < MIN_MATCH:
+                bw.write(*main_codes[self.data[pos]])
+                self.stats["literal"] += 1
+                self._insert(pos)
+                pos += 1
+                continue
+            bw.write(*main_codes[256 + slot * 8 + min(length - MIN_MATCH, 7)])
+            if length - MIN_MATCH >= 7:
+                bw.write(*length_codes[length - MIN_MATCH - 7])
+                self.stats["long"] += 1
+            if slot > 2:
+                n = SLOT_EXTRA[slot]
+                if block_type == ALIGNED and n >= 3:
+                    bw.write(extra >> 3, n - 3)
+                    bw.write(*aligned_codes[extra & 7])
+                    self.stats["aligned_offset"] += 1
+                else:
+                    bw.write(extra, n)
+            for p in range(pos, pos + length):
+                self._insert(p)
+            pos += length
+
+    def _insert(self, pos):
+        key = self.data[pos:pos + 3]
+        if len(key) == 3:
+            self.chains.setdefault(key, []).append(pos)
+
+    def _length(self, pos, offset, limit):
+        data, n = self.data, 0
+        while n < limit and data[pos + n] == data[pos - offset + n]:
+            n += 1
+        return n
+
+    def _match(self, pos, limit):
+        """贪心选取最长匹配，等长时优先重复偏移；返回 (长度, 位置槽, 额外位的值)，并更新 R0-R2"""
+        limit = min(limit, MAX_MATCH)
+        best, best_offset, best_rep = 0, 0, None
+        for k, offset in enumerate(self.R):
+            if offset <= pos:
+                n = self._length(pos, offset, limit)
+                if n > best:
+                    best, best_offset, best_rep = n, offset, k
+        for q in reversed(self.chains.get(self.data[pos:pos + 3], [])[-16:]):
+            offset = pos - q
+            if offset > WINDOW_SIZE - 3:
+                break
+            n = self._length(pos, offset, limit)
+            if n > best and n >= 3:
+                best, best_offset, best_rep = n, offset, None
+        if best < MIN_MATCH:
+            return 0, 0, 0
+
+        self.stats["match"] += 1
+        if best_offset < best:
+            self.stats["overlap"] += 1
+        if pos % WINDOW_SIZE < best_offset:
+            self.stats["wrap"] += 1
+        R = self.R
+        if best_rep is not None:
+            self.stats[("rep", best_rep)] += 1
+            R[0], R[best_rep] = R[best_rep], R[0]
+            return best, best_rep, 0
+        R[:] = [best_offset, R[0], R[1]]
+        formatted = best_offset + 2
+        slot = max(s for s in range(3, NUM_SLOTS) if SLOT_BASE[s] <= formatted)
+        return best, slot, formatted - SLOT_BASE[slot]
+
+
+def _encint(value: int) -> bytes:
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(out))
+
+
+def write_chm(path, files: dict, plain: dict = None, e8_filesize: int = 0) -> Counter:
+    """files: 压缩成员 名称 -> 内容; plain: 未压缩段 (section 0) 中的成员。返回编码器统计"""
+    stream, entries = b"", []
+    for name, data in files.items():
+        entries.append(("/" + name, 1, len(stream), len(data)))
+        stream += data
+
+    encoder = _LZXEncoder(e8_filesize)
+    offsets, content = [], b""
+    for frame in encoder.encode(stream):
+        offsets.append(len(content))
+        content += frame
+    reset_table = struct.pack("<IIIIQQQ", 2, len(offsets), 8, 0x28, len(stream), len(content), FRAME_SIZE)
+    reset_table += struct.pack(f"<{len(offsets)}Q", *offsets)
+    # version 2: 重置间隔与窗口以 0x8000 为单位
+    control = struct.pack("<I4sIIIII", 6, b"LZXC", 2, RESET_FRAMES, WINDOW_SIZE // 0x8000, 1, 0)
+
+    section0 = b""
+    for name, data in [(CHMFile.CONTENT, content), (CHMFile.CONTROL_DATA, control),
+                       (CHMFile.RESET_TABLE, reset_table)] + list((plain or {}).items()):
+        name = name if name.startswith(":") else "/" + name
+        entries.append((name, 0, len(section0), len(data)))
+        section0 += data
+
+    # PMGL 目录块按链表串联
+    chunks, body = [], b""
+    for name, section, offset, length in sorted(entries):
+        name = name.encode('utf-8')
+        entry = _encint(len(name)) + name + _encint(section) + _encint(offset) + _encint(length)
+        if 0x14 + len(body) + len(entry) > CHUNK_SIZE:
+            chunks.append(body)
+            body = b""
+        body += entry
+    chunks.append(body)
+    directory = b""
+    for i, body in enumerate(chunks):
+        next_chunk = i + 1 if i + 1 < len(chunks) else -1
+        header = struct.pack("<4sIIii", b"PMGL", CHUNK_SIZE - 0x14 - len(body), 0, i - 1, next_chunk)
+        directory += header + body + b"\0" * (CHUNK_SIZE - 0x14 - len(body))
+    itsp = struct.pack("<4sIIIIIIii", b"ITSP", 1, 0x54, 10, CHUNK_SIZE, 2, 1, -1, 0)
+    itsp = itsp.ljust(0x20, b"\0") + struct.pack("<iiiI", 0, len(chunks) - 1, -1, len(chunks))
+    itsp = itsp.ljust(0x54, b"\0")
+    directory = itsp + directory
+
+    header = struct.pack("<4sII", b"ITSF", 2, 0x58).ljust(0x48, b"\0")
+    header += struct.pack("<QQ", 0x58, len(directory))
+    with open(path, 'wb') as f:
+        f.write(header + directory + section0)
+    return encoder.stats
+
+
+def _records(rng, n):
+    """每条记录三列 (各 8 字节，以随机字节分隔)，第 k 列多数时候沿用前 k+1 条记录的值"""
+    rows = []
+    for i in range(n):
+        row = []
+        for k in range(3):
+            same = i > k and rng.random() < 0.8
+            row.append(rows[i - k - 1][k] if same else bytes(rng.getrandbits(8) for _ in range(8)))
+        rows.append(row)
+    return b"".join(b"".join(col + bytes([rng.getrandbits(8)]) for col in row) for row in rows)
+
+
+@pytest.fixture(scope="module")
+def members():
+    rng = random.Random(0)
+    words = ["法术", "豁免", "攻击检定", "spell", "saving throw", "<p>", "</p>\n"]
+    big = "".join(rng.choice(words) for _ in range(20000)).encode('utf-8')
+    return {
+        "index.hhc": b"<html><body><ul><li>Rules</li></ul></body></html>",
+        "html/Chapter1.htm": "<h1>第一章</h1><p>施法</p>".encode('gbk'),
+        # 跨越多个帧与重置区间
+        "html/big.htm": big,
+        # 长游程: 偏移 1 的重叠复制与长度树
+        "html/runs.htm": b"=" * 3000 + b"ab" * 2000 + b"-" * 5,
+        "html/binary.bin": bytes(rng.getrandbits(8) for _ in range(FRAME_SIZE + 123)),
+        # 定长记录，三列分别与前 1/2/3 条记录相同: 匹配偏移在 R0-R2 之间轮换
+        "html/table.bin": _records(rng, 3000),
+        # 与很久之前的内容重复: 偏移接近窗口大小，源数据绕回窗口末尾
+        "html/repeat.htm": big[:20000],
+        "html/empty.htm": b"",
+    }
+
+
+@pytest.fixture(scope="module")
+def chm(tmp_path_factory, members):
+    path = tmp_path_factory.mktemp("chm") / "test.chm"
+    stats = write_chm(path, members, plain={"#SYSTEM": b"\x03\x00\x00\x00", "plain.txt": b"stored"})
+    return str(path), stats
+
+
+@pytest.fixture(scope="module")
+def chm_path(chm):
+    return chm[0]
+
+
+def test_fixture_covers_lzx_paths(chm):
+    _, stats = chm
+    for key in ["literal", "match", "overlap", "long", "wrap", "span", "aligned_offset",
+                ("rep", 0), ("rep", 1), ("rep", 2),
+                ("block", VERBATIM), ("block", ALIGNED), ("block", UNCOMPRESSED)]:
+        assert stats[key] > 0, key
+
+
+def test_read_round_trip(chm_path, members):
+    with CHMFile(chm_path) as chm:
+        for name, data in members.items():
+            assert chm.size(name) == len(data)
+            assert chm.read(name) == data, name
+        assert chm.read("plain.txt") == b"stored"
+
+
+def test_random_access_across_frames(chm_path, members):
+    """帧缓存只留一帧时乱序读取: 跳到其他重置区间后必须从区间起点重新解码"""
+    rng = random.Random(1)
+    names = list(members) * 3
+    rng.shuffle(names)
+    with CHMFile(chm_path) as chm:
+        chm.FRAME_CACHE = 1
+        for name in names:
+            assert chm.read(name) == members[name], name
+
+
+def test_intel_e8_translation(tmp_path):
+    """E8 之后的相对地址: 区间内 / 区间前 / 越界三种都要原样还原"""
+    rng = random.Random(2)
+    filesize = 3 * FRAME_SIZE
+    code = bytearray()
+    while len(code) < 5 * FRAME_SIZE:
+        code += bytes(rng.getrandbits(8) for _ in range(rng.randrange(0, 8)))
+        # 解码端的 curpos 从重置区间起点算起
+        curpos = len(code) % (RESET_FRAMES * FRAME_SIZE)
+        rel = rng.choice([rng.randrange(-curpos - 1, 64), rng.randrange(filesize - 64, filesize),
+                          rng.randrange(-2 ** 31, 2 ** 31)])
+        code += b"\xe8" + struct.pack("<i", rel)
+    data = bytes(code)
+    path = tmp_path / "e8.chm"
+    stats = write_chm(path, {"code.bin": data, "tail.bin": b"\xe8\x01\x00"}, e8_filesize=filesize)
+    assert stats["e8"] > 1000
+    with CHMFile(str(path)) as chm:
+        assert chm.read("code.bin") == data
+        assert chm.read("tail.bin") == b"\xe8\x01\x00"
+
+
+def test_members(chm_path, members):
+    with CHMFile(chm_path) as chm:
+        assert set(chm.list()) == set(members) | {"plain.txt"}
+        # HHC 中的链接大小写与分隔符常与成员名不一致
+        assert chm.resolve("HTML\\chapter1.HTM") == "/html/Chapter1.htm"
+        assert chm.read("html\\CHAPTER1.htm") == members["html/Chapter1.htm"]
+        assert not chm.exists("missing.htm")
+        with pytest.raises(KeyError):
+            chm.read("missing.htm")
+
+
+def test_open_source(chm_path, members, tmp_path):
+    source = open_source(("chm", chm_path))
+    try:
+        assert source.read("index.hhc") == members["index.hhc"]
+    finally:
+        source.close()
+
+    (tmp_path / "html").mkdir()
+    (tmp_path / "html" / "a.htm").write_bytes(b"abc")
+    source = open_source(("dir", str(tmp_path)))
+    assert source.exists("html\\a.htm")
+    assert source.read("/html/a.htm") == b"abc"
+
+
+def test_not_a_chm(tmp_path):
+    path = tmp_path / "fake.chm"
+    path.write_bytes(b"MZ" + b"\0" * 200)
+    with pytest.raises(CHMError):
+        CHMFile(str(path))
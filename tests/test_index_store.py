@@ -0,0 +1,141 @@
+import os
+
+import numpy as np
+import pytest
+
+from src.core.index_store import IndexStore, Segment, SegmentWriter
+from tests.test_bm25_index import queries, zipf_corpus
+
+
+def write_segment(store, docs):
+    """docs: [(key, tokens)]，写成一个新段，返回段名"""
+    name, seg_dir = store.new_segment()
+    writer = SegmentWriter(seg_dir)
+    for key, tokens in docs:
+        writer.add(key, tokens, " ".join(tokens), {"full_path": key, "source": "test"})
+    writer.close()
+    return name
+
+
+def results(store, q, k, blacklist_paths=None):
+    return [(seg.chunks()[0][doc_id], score) for seg, doc_id, score in store.top_k(q, k, blacklist_paths)]
+
+
+def assert_same_results(store, fresh, blacklist_paths=None):
+    for q in queries():
+        got = results(store, q, 20, blacklist_paths)
+        expected = results(fresh, q, 20, blacklist_paths)
+        assert [key for key, _ in got] == [key for key, _ in expected], q
+        # idf 的平均值按不同顺序累加，只保证数值上相等
+        assert np.allclose([s for _, s in got], [s for _, s in expected], rtol=1e-12, atol=0), q
+
+
+@pytest.fixture
+def segmented(tmp_path):
+    """
+    三次导入: 初始 1200 篇; 替换其中 200 篇并新增 300 篇; 删除 150 篇。
+    返回 (分段索引, 按相同顺序一次性构建的索引)
+    """
+    corpus = zipf_corpus(1800, seed=3)
+    docs = {f"k{i}": corpus[i] for i in range(1200)}
+    store = IndexStore(str(tmp_path / "store"))
+    first = write_segment(store, docs.items())
+    store.commit([first])
+    keys = list(docs)
+
+    replaced = keys[100:300]
+    updates = [(key, corpus[1200 + i]) for i, key in enumerate(replaced)]
+    added = [(f"k{i}", corpus[i]) for i in range(1400, 1700)]
+    second = write_segment(store, updates + added)
+    store.commit([second], deletes={first: range(100, 300)})
+
+    deleted = keys[500:650]
+    store.commit(deletes={first: range(500, 650)})
+
+    # 存活文档按段顺序、段内 doc_id 顺序排列，与分段索引的同分排序一致
+    live = [(key, docs[key]) for key in keys if key not in set(replaced) | set(deleted)]
+    live += updates + added
+    fresh = IndexStore(str(tmp_path / "fresh"))
+    fresh.commit([write_segment(fresh, live)])
+    yield store, fresh
+    store.close()
+    fresh.close()
+
+
+def test_segmented_update_matches_fresh_build(segmented):
+    store, fresh = segmented
+    assert len(store.segments) == 2
+    assert len(store) == len(fresh)
+    assert store.live_chunks().keys() == fresh.live_chunks().keys()
+    assert_same_results(store, fresh)
+
+
+def test_merge_matches_fresh_build(segmented):
+    store, fresh = segmented
+    store.merge()
+    assert len(store.segments) == 1
+    assert store.segments[0].deleted is None
+    assert len(store) == len(fresh)
+    assert_same_results(store, fresh)
+
+    # 重新打开得到相同结果
+    reopened = IndexStore(store.store_dir)
+    try:
+        assert_same_results(reopened, fresh)
+    finally:
+        reopened.close()
+
+
+def test_blacklist_paths(segmented):
+    store, fresh = segmented
+    blacklist = [f"k{i}" for i in range(0, 1700, 7)]
+    assert_same_results(store, fresh, blacklist)
+    for q in queries():
+        assert not {key for key, _ in results(store, q, 20, blacklist)} & set(blacklist)
+
+
+def open_all(store, manifest):
+    for entry in manifest["segments"]:
+        Segment(os.path.join(store.store_dir, entry["name"]), entry["name"], entry["deletes"]).close()
+
+
+def test_reader_on_previous_manifest(segmented):
+    """读取端读到 manifest 后写入端又提交了一次: 上一版引用的段与删除标记仍可打开"""
+    store, _ = segmented
+    before_delete = store._read_manifest()
+    first = before_delete["segments"][0]["name"]
+    store.commit(deletes={first: [0, 1]})
+    open_all(store, before_delete)
+
+    before_merge = store._read_manifest()
+    store.merge()
+    open_all(store, before_merge)
+
+    # 再提交一次后才真正删除
+    store.commit(deletes={store.segments[0].name: [5]})
+    assert not os.path.exists(os.path.join(store.store_dir, first))
+    assert store._read_manifest()["retired"] == []
+
+
+def test_refresh_retries_after_cleanup(segmented, monkeypatch):
+    """读取端落后不止一次提交: 打开段失败时重新读取 manifest"""
+    store, fresh = segmented
+    reader = IndexStore(store.store_dir)
+    stale = store._read_manifest()
+    for _ in range(2):
+        store.commit(deletes={store.segments[0].name: [len(store.segments[0].chunks()[0]) - 1]})
+        store.merge()
+
+    reads = []
+    real_read = IndexStore._read_manifest
+
+    def read_manifest(self):
+        reads.append(1)
+        return stale if len(reads) == 1 else real_read(self)
+
+    monkeypatch.setattr(IndexStore, "_read_manifest", read_manifest)
+    reader.segments = []
+    assert reader.refresh(force=True)
+    assert len(reads) == 2
+    assert reader.live_chunks() == store.live_chunks()
+    reader.close()
@@ -0,0 +1,54 @@
+import json
+import os
+
+import pytest
+
+from src.services import rules_data
+from src.services.rules_data import RulesReader, RulesWriter
+
+
+def entries(n):
+    return [{"title": f"规则 {i}", "content": "x" * (i % 7)} for i in range(n)]
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_round_trip(tmp_path, compression):
+    with RulesWriter(str(tmp_path), compression) as writer:
+        writer.write_all(entries(600))
+    reader = RulesReader(str(tmp_path))
+    assert len(reader) == 600
+    assert list(reader) == entries(600)
+    assert reader.get(257) == entries(600)[257]
+    assert list(reader.iter_range(250, 260)) == entries(600)[250:260]
+
+
+def test_failed_write_keeps_existing_data(tmp_path):
+    with RulesWriter(str(tmp_path)) as writer:
+        writer.write_all(entries(10))
+    before = sorted(os.listdir(tmp_path))
+
+    with pytest.raises(RuntimeError):
+        with RulesWriter(str(tmp_path), "gzip") as writer:
+            writer.write_all(entries(1000))
+            raise RuntimeError("cancelled")
+
+    # 临时文件已删除，原有数据与索引不变
+    assert sorted(os.listdir(tmp_path)) == before
+    assert list(RulesReader(str(tmp_path))) == entries(10)
+
+
+def test_replace_format(tmp_path):
+    with RulesWriter(str(tmp_path)) as writer:
+        writer.write_all(entries(10))
+    with RulesWriter(str(tmp_path), "gzip") as writer:
+        writer.write_all(entries(20))
+    assert not os.path.exists(tmp_path / rules_data.DATA_NAME)
+    assert list(RulesReader(str(tmp_path))) == entries(20)
+
+
+def test_migrate_legacy(tmp_path):
+    with open(tmp_path / rules_data.LEGACY_FILE, 'w', encoding='utf-8') as f:
+        json.dump(entries(5), f, ensure_ascii=False)
+    assert rules_data.exists(str(tmp_path))
+    assert list(RulesReader(str(tmp_path))) == entries(5)
+    assert not os.path.exists(tmp_path / rules_data.LEGACY_FILE)